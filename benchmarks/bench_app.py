@@ -0,0 +1,331 @@
+# throughput and latency of the main routes, in-process or over HTTP against gunicorn.
+#
+#   python benchmarks/bench_app.py --tasks 10000 --users 100
+#   python benchmarks/bench_app.py --tasks 1000000 --users 5000 --server gunicorn --workers 4
+#   python benchmarks/bench_app.py --url http://127.0.0.1:5000 --no-seed   (a running server)
+#
+# the database (--database, a sqlite file) is seeded with --tasks tasks spread over --users
+# users, every user with the password "benchmark". then each scenario sends --requests
+# requests from --concurrency clients, each client logged in as its own user, and reports
+# req/s and the p50/p95/p99 latency in milliseconds.
+#
+#   --save NAME      stores the results as benchmarks/baselines/NAME.json
+#   --compare NAME   compares with a stored baseline and exits with 1 when a scenario lost
+#                    more than --tolerance of its req/s or its p95 grew by more than that
+#
+# benchmarks/baselines/reference.json was made with the defaults on a small machine, under
+# python 3.6 (runtime.txt deploys 3.5): it is a sample of the format, compare with a
+# baseline saved on the machine and python that run --compare (a mismatch is noted).
+import argparse
+import http.cookiejar
+import json
+import math
+import os
+import platform
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from project import create_app, db
+from project.models import Task, User
+from project.passwords import hash_password
+
+BASELINES = os.path.join(ROOT, 'benchmarks', 'baselines')
+PASSWORD = 'benchmark'
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+### database ###
+
+def seed(tasks, users, chunk_size=10000):
+    db.drop_all()
+    db.create_all()
+    password = hash_password(PASSWORD)     # one hash for everyone, at the configured cost
+    for start in range(0, users, chunk_size):
+        db.session.execute(User.__table__.insert(), [
+            {'name': 'benchuser{}'.format(n), 'email': 'benchuser{}@example.com'.format(n),
+             'password': password, 'role': 'user'}
+            for n in range(start + 1, min(start + chunk_size, users) + 1)
+        ])
+    today = date.today()
+    for start in range(0, tasks, chunk_size):
+        db.session.execute(Task.__table__.insert(), [
+            {'name': 'Benchmark task {}'.format(n), 'due_date': today + timedelta(days=n % 365),
+             'priority': n % 10 + 1, 'posted_date': today, 'status': 0 if n % 4 == 0 else 1,
+             'user_id': n % users + 1}
+            for n in range(start, min(start + chunk_size, tasks))
+        ])
+        db.session.commit()
+
+
+def open_task_ids(user_id, limit):
+    rows = db.session.query(Task.task_id).filter(Task.user_id == user_id, Task.status == 1).\
+        order_by(Task.task_id).limit(limit)
+    return [row.task_id for row in rows]
+
+
+### clients: request(method, path, data) -> (status, body) ###
+
+class InProcessClient(object):
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code, response.get_data()
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpClient(object):
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect
+        )
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode('ascii') if data is not None else None
+        request = urllib.request.Request(self.base_url + path, data=body, method=method)
+        try:
+            with self.opener.open(request) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+### scenarios: (name, function(client, state) -> status, status of a request that worked) ###
+# a form that fails validation is shown again with a 200: only the expected status counts
+
+def login(client, state):
+    return client.request('POST', '/', {
+        'csrf_token': state['csrf_token'], 'name': state['name'], 'password': PASSWORD
+    })[0]
+
+
+def add_task(client, state):
+    return client.request('POST', '/add/', {
+        'csrf_token': state['csrf_token'], 'name': 'Added by the benchmark',
+        'due_date': '31/12/2030', 'priority': '5', 'status': '1'
+    })[0]
+
+
+def complete_task(client, state):
+    task_ids = state['open_task_ids']
+    # once a client ran out of open tasks it keeps completing its last one (a no-op UPDATE)
+    task_id = task_ids.pop() if len(task_ids) > 1 else task_ids[0]
+    return client.request('GET', '/complete/{}/'.format(task_id))[0]
+
+
+def get(path):
+    def scenario(client, state):
+        return client.request('GET', path.format(**state))[0]
+    return scenario
+
+
+SCENARIOS = [
+    ('login', login, 302),
+    ('tasks page', get('/tasks/'), 200),
+    ('add task', add_task, 302),
+    ('complete task', complete_task, 302),
+    ('api tasks', get('/api/v1/tasks/?per_page=50'), 200),
+    ('api task', get('/api/v1/tasks/{task_id}'), 200),
+    ('api summary', get('/api/v1/summary'), 200),
+    ('api search', get('/api/v1/tasks/search?q=bench+task'), 200),
+]
+
+
+def prepare_client(app, make_client, user_id, requests):
+    client = make_client()
+    state = {'name': 'benchuser{}'.format(user_id)}
+    # the token stays valid for the whole session, logins included
+    match = CSRF_TOKEN.search(client.request('GET', '/')[1].decode('utf-8'))
+    state['csrf_token'] = match.group(1) if match else ''
+    if login(client, state) != 302:
+        raise SystemExit('could not log in as {}'.format(state['name']))
+    with app.app_context():
+        state['open_task_ids'] = open_task_ids(user_id, requests) or [1]
+        db.session.remove()
+    state['task_id'] = state['open_task_ids'][0]
+    return client, state
+
+
+def run(scenario, expected, clients, requests):
+    # requests are shared out between the clients, one thread each
+    latencies, errors = [], []
+    lock = threading.Lock()
+    per_client = [requests // len(clients) + (1 if n < requests % len(clients) else 0)
+                  for n in range(len(clients))]
+
+    def work(client, state, count):
+        mine, failed = [], 0
+        for _ in range(count):
+            started = time.perf_counter()
+            status = scenario(client, state)
+            mine.append(time.perf_counter() - started)
+            failed += status != expected
+        with lock:
+            latencies.extend(mine)
+            errors.append(failed)
+
+    threads = [threading.Thread(target=work, args=(client, state, count))
+               for (client, state), count in zip(clients, per_client)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': sum(errors),
+        'rps': requests / elapsed,
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+    }
+
+
+def percentile(values, p):
+    # nearest rank, values sorted
+    if not values:
+        return 0.0
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+### gunicorn ###
+
+def start_gunicorn(args, environment):
+    port = args.port
+    process = subprocess.Popen(
+        ['gunicorn', '--workers', str(args.workers), '--bind', '127.0.0.1:{}'.format(port), 'project:create_app()'],
+        cwd=ROOT, env=environment
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, 'http://127.0.0.1:{}'.format(port)
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit('gunicorn did not start on port {}'.format(port))
+
+
+### baselines ###
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in sorted(results.items()):
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        if result['rps'] < before['rps'] * (1 - tolerance):
+            regressions.append('{}: {:.0f} req/s, baseline {:.0f}'.format(name, result['rps'], before['rps']))
+        if result['p95'] > before['p95'] * (1 + tolerance):
+            regressions.append('{}: p95 {:.1f} ms, baseline {:.1f}'.format(name, result['p95'], before['p95']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Route throughput and latency benchmark')
+    parser.add_argument('--tasks', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--database', default=os.path.join(ROOT, 'benchmarks', 'bench.db'))
+    parser.add_argument('--no-seed', action='store_true', help='reuse the database as it is')
+    parser.add_argument('--scenario', action='append', help='only these scenarios (repeatable)')
+    parser.add_argument('--server', choices=['inprocess', 'gunicorn'], default='inprocess')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--url', help='benchmark a server that is already running')
+    parser.add_argument('--save', metavar='NAME', help='store the results as a baseline')
+    parser.add_argument('--compare', metavar='NAME', help='compare with a stored baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+    baseline = None
+    if args.compare:
+        # before seeding and running: a typo should not cost a whole benchmark run
+        path = os.path.join(BASELINES, args.compare + '.json')
+        if not os.path.exists(path):
+            saved = sorted(name[:-5] for name in os.listdir(BASELINES) if name.endswith('.json')) \
+                if os.path.isdir(BASELINES) else []
+            parser.error('no baseline {!r} in {} (saved: {}), store one with --save {}'.format(
+                args.compare, BASELINES, ', '.join(saved) or 'none', args.compare))
+        with open(path) as stream:
+            baseline = json.load(stream)
+
+    database_uri = 'sqlite:///' + os.path.abspath(args.database)
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_uri, 'SESSION_STORE': 'memory'})
+    if not args.no_seed:
+        with app.app_context():
+            started = time.time()
+            seed(args.tasks, args.users)
+            db.session.remove()
+            print('seeded {} tasks, {} users in {:.1f}s'.format(args.tasks, args.users, time.time() - started))
+
+    process = None
+    if args.url:
+        make_client = lambda: HttpClient(args.url)
+    elif args.server == 'gunicorn':
+        environment = dict(os.environ, DATABASE_URL=database_uri)
+        process, url = start_gunicorn(args, environment)
+        make_client = lambda: HttpClient(url)
+    else:
+        make_client = lambda: InProcessClient(app)
+
+    try:
+        clients = [prepare_client(app, make_client, n % args.users + 1, args.requests)
+                   for n in range(args.concurrency)]
+        results = {}
+        print('{:<16} {:>9} {:>9} {:>9} {:>9} {:>7}'.format('scenario', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+        for name, scenario, expected in SCENARIOS:
+            if args.scenario and name not in args.scenario:
+                continue
+            results[name] = result = run(scenario, expected, clients, args.requests)
+            print('{:<16} {rps:>9.0f} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f} {errors:>7}'.format(name, **result))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    record = {
+        'tasks': args.tasks, 'users': args.users, 'concurrency': args.concurrency,
+        'server': 'url' if args.url else args.server, 'python': platform.python_version(),
+        'results': results
+    }
+    if args.save:
+        os.makedirs(BASELINES, exist_ok=True)
+        with open(os.path.join(BASELINES, args.save + '.json'), 'w') as stream:
+            json.dump(record, stream, indent=2, sort_keys=True)
+    if baseline is not None:
+        for key in ('tasks', 'users', 'concurrency', 'server', 'python'):
+            if baseline.get(key) != record[key]:
+                print('note: the baseline has {} {}, this run {}'.format(key, baseline.get(key), record[key]))
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print('REGRESSION ' + line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+# micro-benchmark of the Task JSON serialization, in rows per second:
+#   orm+jsonify: what the API routes used to do (ORM instances, a hand built dict, jsonify)
+#   columns+dumps: project/serializers.py (column-only query, compact encoder)
+#
+#   python benchmarks/bench_serializer.py --rows 20000 --repeat 5
+import argparse
+import os
+import sys
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import jsonify
+
+from project import create_app, db
+from project.models import Task, User
+from project.serializers import task_rows, task_to_dict, dumps, ENCODER
+
+
+def orm_jsonify():
+    json_results = []
+    for result in db.session.query(Task).all():
+        json_results.append({
+            'task_id': result.task_id,
+            'task name': result.name,
+            'due date': str(result.due_date),
+            'priority': result.priority,
+            'posted date': str(result.posted_date),
+            'status': result.status,
+            'user id': result.user_id
+        })
+    return jsonify(items=json_results).get_data()
+
+
+def columns_dumps():
+    return dumps({'items': [task_to_dict(row) for row in task_rows()]})
+
+
+def seed(rows):
+    db.create_all()
+    db.session.add(User('bench', 'bench@example.com', 'x'))
+    db.session.execute(Task.__table__.insert(), [
+        {'name': 'Task number {}'.format(n), 'due_date': date(2017, 1, 1 + n % 28), 'priority': n % 10 + 1,
+         'posted_date': date(2016, 12, 1), 'status': n % 2, 'user_id': 1}
+        for n in range(rows)
+    ])
+    db.session.commit()
+
+
+def measure(function, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        db.session.remove()     # start from an empty identity map every time
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return rows / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Task JSON serialization benchmark')
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+    with app.test_request_context():
+        seed(args.rows)
+        baseline = measure(orm_jsonify, args.rows, args.repeat)
+        print('encoder: {}'.format(ENCODER))
+        print('{:>16} {:>12,.0f} rows/s'.format('orm+jsonify', baseline))
+        fast = measure(columns_dumps, args.rows, args.repeat)
+        print('{:>16} {:>12,.0f} rows/s  ({:.1f}x)'.format('columns+dumps', fast, fast / baseline))
+
+
+if __name__ == '__main__':
+    main()
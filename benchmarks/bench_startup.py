@@ -0,0 +1,45 @@
+# cold start time of a worker: a fresh interpreter that imports project and calls
+# create_app(), as a gunicorn worker does without --preload.
+#
+#   python benchmarks/bench_startup.py --repeat 10
+#
+# reports the median, over --repeat interpreters, of the phases in app.startup_seconds
+# (see project/__init__.py) and of the whole process, interpreter start-up included.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = '''
+import json
+from project import create_app
+app = create_app()
+print(json.dumps(app.startup_seconds))
+'''
+
+
+def start_once():
+    started = time.perf_counter()
+    output = subprocess.check_output([sys.executable, '-c', CHILD], cwd=ROOT)
+    phases = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    phases['process'] = time.perf_counter() - started
+    return phases
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Worker cold start benchmark')
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args(argv)
+    runs = [start_once() for _ in range(args.repeat)]
+    for phase in ('import', 'extensions', 'blueprints', 'total', 'process'):
+        print('{:<12} {:>8.1f} ms'.format(phase, statistics.median(run[phase] for run in runs) * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -24,21 +24,25 @@ with sqlite3.connect(DATABASE_PATH) as conn:
     c.execute("INSERT INTO tasks (name, due_date, priority, status)" \
               "VALUES('Finish Real Python Course 2', '25/11/2016', 10, 1)")
 """
-from project import db
+from project import create_app, db
 from project.models import Task, User
 from datetime import date
 
+# db needs an app to know which database to use
+create_app(blueprints=False).app_context().push()
+
 # Create all tables stored in this metadata
-# db = SQLAlchemy(app), configured in db_create.py in the form of dictionary
+# db = SQLAlchemy(), bound to the app by create_app() in project/__init__.py
 db.create_all()
 
-# insert data
-
-# User defines the format of the table 'users'
-db.session.add(User('admin', 'admin@min.com', 'admin', 'admin'))
-# Task defines the format of the table 'tasks'
-db.session.add(Task('Finish this tutorial', date(2016, 11, 30), 10, date(2016, 12, 8), 1, 1))
-db.session.add(Task('Finish Real Python', date(2016, 12, 1), 10, date(2016, 12, 8), 1, 1))
+# insert data, all in one flush (bigger imports: see db_migrate.py)
+db.session.add_all([
+    # User defines the format of the table 'users'
+    User('admin', 'admin@min.com', 'admin', 'admin'),
+    # Task defines the format of the table 'tasks'
+    Task('Finish this tutorial', date(2016, 11, 30), 10, date(2016, 12, 8), 1, 1),
+    Task('Finish Real Python', date(2016, 12, 1), 10, date(2016, 12, 8), 1, 1)
+])
 
 # commit the changes
 db.session.commit()
\ No newline at end of file
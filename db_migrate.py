@@ -1,38 +1,245 @@
-from views import db
-from _config import DATABASE_PATH
+# streaming importer for tasks and users
+#
+#   python db_migrate.py tasks tasks.csv          CSV with a header row
+#   python db_migrate.py tasks tasks.ndjson       one JSON object per line (the format of
+#                                                 /api/v1/tasks/export?format=ndjson)
+#   python db_migrate.py users users.csv
+#   python db_migrate.py legacy flasktaskr.db     users, then tasks, from an old sqlite file
+#
+# records are read one at a time and written in transactions of --chunk-size rows, so memory
+# use does not depend on the size of the input. every transaction also stores how far the
+# import got (table import_checkpoints), so an interrupted run picks up after the last chunk
+# that was committed: run the same command again (--restart starts over).
+# progress and throughput go to stderr after each chunk.
+import argparse
+import collections
+import csv
+import datetime
+import functools
+import itertools
+import json
+import os
 import sqlite3
-from datetime import datetime
+import sys
+import time
 
-with sqlite3.connect(DATABASE_PATH) as conn:
-    """
-    # migration from sqlite3 to SQLAlchemy
+from sqlalchemy import Column, Integer, MetaData, String, Table
+from sqlalchemy.exc import IntegrityError
 
-    c = conn.cursor()
-    # Rename the table
-    #c.execute("ALTER TABLE tasks RENAME TO old_tasks")
-    # recreate a new tasks table with updated schema by SQLAlchemy
-    db.create_all()
-    # retrieve data from the old_tasks sorted by the task_id
-    c.execute("SELECT name, due_date, priority, status FROM old_tasks ORDER BY task_id ASC")
-    # convert each row to a tuple
-    data = [(row[0], row[1], row[2], datetime.now(), row[3], 1) for row in c.fetchall()]
-    # load data to the new table
-    c.executemany("INSERT INTO tasks (name, due_date, priority, posted_date, status, user_id) \
-    VALUES (?, ?, ?, ?, ?, ?)", data)
-    c.execute("UPDATE tasks SET status=1")
-    # delete old_tasks table
-    c.execute("DROP TABLE old_tasks")
-    """
-    c = conn.cursor()
-    c.execute("ALTER TABLE users RENAME TO old_users")
-    # recreate a new users table with updated schema ('role' added)
+from project import create_app, db, changes, journal
+from project.models import Task, User
+
+checkpoints = Table(
+    'import_checkpoints', MetaData(),
+    Column('source', String, primary_key=True),
+    Column('position', Integer, nullable=False)
+)
+
+# keys of the export (project/serializers.py) and the column they belong to
+ALIASES = {'task name': 'name', 'due date': 'due_date', 'posted date': 'posted_date', 'user id': 'user_id'}
+
+
+class ImportFailed(Exception):
+    pass
+
+
+### readers: (position, record) pairs, position increases with every record ###
+
+def read_csv(path):
+    with open(path, newline='') as stream:
+        for position, record in enumerate(csv.DictReader(stream), 1):
+            yield position, dict((ALIASES.get(key, key), value) for key, value in record.items())
+
+
+def read_ndjson(path):
+    with open(path) as stream:
+        for position, line in enumerate(stream, 1):
+            if line.strip():
+                record = json.loads(line)
+                yield position, dict((ALIASES.get(key, key), value) for key, value in record.items())
+
+
+def read_legacy(path, table, after=0, batch_size=1000):
+    # keyset over rowid, so resuming does not rescan what was already imported
+    connection = sqlite3.connect(path)
+    connection.row_factory = sqlite3.Row
+    try:
+        cursor = connection.execute(
+            'SELECT rowid AS _position, * FROM {} WHERE rowid > ? ORDER BY rowid'.format(table), (after,)
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                record = dict(zip(row.keys(), row))
+                yield record.pop('_position'), record
+    finally:
+        connection.close()
+
+
+def legacy_table_exists(path, table):
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone() is not None
+    finally:
+        connection.close()
+
+
+def read_file(path):
+    if path.endswith('.ndjson') or path.endswith('.jsonl'):
+        return read_ndjson(path)
+    return read_csv(path)
+
+
+### records to rows ###
+
+def parse_date(value, date_format):
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.strptime(value, date_format).date()
+
+
+def task_row(record, date_format='%Y-%m-%d', user_id=1):
+    posted_date = record.get('posted_date')
+    status = record.get('status')
+    return {
+        'name': record['name'],
+        'due_date': parse_date(record['due_date'], date_format),
+        'priority': int(record['priority']),
+        'posted_date': parse_date(posted_date, date_format) if posted_date else datetime.date.today(),
+        'status': int(status) if status not in (None, '') else 1,
+        'user_id': int(record.get('user_id') or user_id)
+    }
+
+
+def user_row(record, keep_ids=False):
+    row = {
+        'name': record['name'],
+        'email': record['email'],
+        'password': record['password'],
+        'role': record.get('role') or 'user'
+    }
+    if keep_ids and record.get('id') is not None:
+        row['id'] = int(record['id'])
+    return row
+
+
+### checkpoints ###
+
+def checkpoint(source):
+    row = db.session.execute(
+        checkpoints.select().where(checkpoints.c.source == source)
+    ).first()
+    return row.position if row is not None else 0
+
+
+def save_checkpoint(source, position):
+    # in the same transaction as the rows it accounts for
+    if not db.session.execute(
+        checkpoints.update().where(checkpoints.c.source == source).values(position=position)
+    ).rowcount:
+        db.session.execute(checkpoints.insert().values(source=source, position=position))
+
+
+def report_progress(source, count, seconds):
+    print('{}: {} rows in {:.1f}s ({:.0f} rows/s)'.format(
+        source, count, seconds, count / seconds if seconds else 0), file=sys.stderr)
+
+
+def load(table, records, source, convert, chunk_size=1000, report=report_progress):
+    # insert (position, record) pairs in chunked transactions; returns the number of rows added
+    done = checkpoint(source)
+    records = ((position, record) for position, record in records if position > done)
+    count, started = 0, time.time()
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            return count
+        rows = []
+        for position, record in chunk:
+            try:
+                rows.append(convert(record))
+            except (KeyError, TypeError, ValueError) as e:
+                raise ImportFailed('{}, record {}: {!r}'.format(source, position, e))
+        try:
+            db.session.execute(table.insert(), rows)
+            save_checkpoint(source, chunk[-1][0])
+            if table is Task.__table__:
+                owners = collections.Counter(row['user_id'] for row in rows)
+                changes.bump(owners)
+                for user_id, added in owners.items():
+                    journal.record('created', None, user_id, added)
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            raise ImportFailed('{}, records {}-{}: {}'.format(source, chunk[0][0], chunk[-1][0], e.orig))
+        count += len(rows)
+        if report:
+            report(source, count, time.time() - started)
+
+
+def import_file(kind, path, chunk_size=1000, restart=False, report=report_progress, **options):
+    table, convert = (Task.__table__, task_row) if kind == 'tasks' else (User.__table__, user_row)
+    source = '{}:{}'.format(kind, os.path.abspath(path))
+    prepare(source, restart)
+    return load(table, read_file(path), source, functools.partial(convert, **options), chunk_size, report)
+
+
+def import_legacy(path, chunk_size=1000, restart=False, report=report_progress, **options):
+    # user ids are kept so the user_id of the old tasks still point at their owners:
+    # meant for a database without users yet
+    counts = {}
+    for kind, table, convert in (('users', User.__table__, functools.partial(user_row, keep_ids=True)),
+                                 ('tasks', Task.__table__, functools.partial(task_row, **options))):
+        if not legacy_table_exists(path, kind):
+            continue
+        source = 'legacy-{}:{}'.format(kind, os.path.abspath(path))
+        prepare(source, restart)
+        records = read_legacy(path, kind, checkpoint(source), chunk_size)
+        counts[kind] = load(table, records, source, convert, chunk_size, report)
+        if kind == 'users' and db.engine.dialect.name == 'postgresql':
+            # explicit ids do not advance the sequence
+            db.session.execute("SELECT setval(pg_get_serial_sequence('users', 'id'), "
+                               "COALESCE((SELECT MAX(id) FROM users), 1))")
+            db.session.commit()
+    return counts
+
+
+def prepare(source, restart):
     db.create_all()
-    # retrieve table data from old_users table
-    c.execute("SELECT name, email, password FROM old_users ORDER BY id ASC")
-    # save the above data into a list of tuples. 'role' is set to 'user'
-    data = [(row[0], row[1], row[2], 'user') for row in c.fetchall()]
-    # add data to 'users' table
-    c.executemany("INSERT INTO users (name, email, password, role) VALUES (?, ?, ?, ?)", data)
-    c.execute("DROP TABLE old_users")
+    checkpoints.create(db.engine, checkfirst=True)
+    if restart:
+        db.session.execute(checkpoints.delete().where(checkpoints.c.source == source))
+        db.session.commit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Import tasks and users in chunked, resumable transactions.')
+    parser.add_argument('kind', choices=['tasks', 'users', 'legacy'])
+    parser.add_argument('path', help='.csv, .ndjson/.jsonl, or the sqlite file for legacy')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='rows per transaction')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint of an earlier run')
+    parser.add_argument('--date-format', default='%Y-%m-%d', help='strptime format of the task dates')
+    parser.add_argument('--user-id', type=int, default=1, help='owner of tasks without a user_id')
+    args = parser.parse_args(argv)
+    create_app(blueprints=False).app_context().push()
+    try:
+        if args.kind == 'legacy':
+            counts = import_legacy(args.path, args.chunk_size, args.restart,
+                                   date_format=args.date_format, user_id=args.user_id)
+        else:
+            options = {'date_format': args.date_format, 'user_id': args.user_id} if args.kind == 'tasks' else {}
+            counts = {args.kind: import_file(args.kind, args.path, args.chunk_size, args.restart, **options)}
+    except ImportFailed as e:
+        print('import stopped: {} (rerun to resume after the last committed chunk)'.format(e), file=sys.stderr)
+        return 1
+    for kind, count in sorted(counts.items()):
+        print('imported {} {}'.format(count, kind))
+    return 0
 
 
+if __name__ == '__main__':
+    sys.exit(main())
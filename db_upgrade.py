@@ -0,0 +1,32 @@
+# brings an existing database up to the schema declared in project/models.py.
+# db.create_all() only creates missing tables, it never touches existing ones,
+# so indexes added to a model later have to be created here. missing tables are created as well,
+# and on sqlite the full-text index of task names (project/search.py).
+from sqlalchemy import inspect
+
+from project import create_app, db, search
+# only imported for its event listener, which seeds the change version rows of a new table
+from project import changes
+from project.models import Task, User
+
+
+def upgrade(engine):
+    created = []
+    db.metadata.create_all(engine)
+    inspector = inspect(engine)
+    for table in (Task.__table__, User.__table__):
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+                created.append(index.name)
+    with engine.begin() as connection:
+        if search.install(connection):
+            created.append('tasks_fts')
+    return created
+
+
+if __name__ == '__main__':
+    create_app(blueprints=False).app_context().push()
+    for name in upgrade(db.engine):
+        print('created index {}'.format(name))
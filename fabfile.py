@@ -5,7 +5,7 @@ from fabric.contrib.console import confirm
 
 def test():
     with settings(warn_only=True):
-        result = local("nosetests -v", capture=True)
+        result = local("nosetests -v --processes=-1", capture=True)
     if result.failed and not confirm("Tests failed. Continue?"):
         abort("Aborted at user request")
 
@@ -0,0 +1,17 @@
+# gunicorn settings of the Procfile: gevent workers, so every open
+# /api/v1/tasks/changes connection is an idle greenlet instead of a blocked thread.
+#
+#   gunicorn -c gunicorn_config.py --bind 0.0.0.0:$PORT 'project:create_app()'
+#
+# the rest of the app has to cooperate with gevent as well:
+# - bcrypt runs on the real threads of the gevent hub's threadpool (project/passwords.py),
+# - psycopg2 waits for postgresql through gevent (psycogreen) instead of blocking the
+#   worker, patched below in every worker. sqlite calls still block, keep it for development.
+# http://docs.gunicorn.org/en/19.6.0/settings.html#server-hooks
+
+worker_class = 'gevent'
+
+
+def post_fork(server, worker):
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
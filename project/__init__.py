@@ -1,43 +1,84 @@
-from flask import Flask, render_template, request
-from flask.ext.sqlalchemy import SQLAlchemy
+import time
+_import_started = time.time()
+
+from flask import Flask, current_app, render_template, request
 from flask.ext.bcrypt import Bcrypt
-import datetime
+from werkzeug.utils import import_string
+from project.database import SQLAlchemy
+from project.errorlog import ErrorLog
+from project.metrics import Metrics
+
+# application factory: create_app(config) builds an app from _config.py plus the settings
+# in config (a dict), so tests and scripts can each have their own.
+# importing project only creates the extensions, not bound to any app yet; the blueprints
+# and the modules behind them (views, forms...) are imported by the first create_app()
+# call. scripts that only need the database (db_create.py, scheduler.py...) call
+# create_app(blueprints=False) and never import them. the seconds spent on each phase are kept in app.startup_seconds and
+# served by /metrics; benchmarks/bench_startup.py measures cold starts. most of a cold
+# start is importing SQLAlchemy: `gunicorn --preload 'project:create_app()'` pays it once in
+# the master and forks workers that are ready (create_app() opens no database connection).
+# http://flask.pocoo.org/docs/0.10/patterns/appfactories/
+
+bcrypt = Bcrypt()
+db = SQLAlchemy()
+error_log = ErrorLog()
+metrics = Metrics()
+
+BLUEPRINTS = [
+    'project.users.views:users_blueprint',
+    'project.tasks.views:tasks_blueprint',
+    'project.api.views:api_blueprint',
+]
+
+_import_seconds = time.time() - _import_started
+
 
-app = Flask(__name__)
-app.config.from_pyfile('_config.py')
-bcrypt = Bcrypt(app)
-db = SQLAlchemy(app)
+def create_app(config=None, blueprints=True):
+    started = time.time()
+    app = Flask(__name__)
+    app.config.from_pyfile('_config.py')
+    if config:
+        app.config.update(config)
 
-from project.users.views import users_blueprint
-from project.tasks.views import tasks_blueprint
-from project.api.views import api_blueprint
+    from project import assets, auth, compression, sessions
+    # imported for their event listeners only: they add the change version rows and the
+    # search index whenever the tables are created
+    from project import changes, search
+    metrics.init_app(app)
+    bcrypt.init_app(app)
+    db.init_app(app)
+    error_log.init_app(app)
+    compression.init_app(app)
+    assets.init_app(app)
+    sessions.init_app(app)
+    auth.init_app(app)
+    extensions_done = time.time()
+
+    # register bluepints
+    if blueprints:
+        for blueprint in BLUEPRINTS:
+            app.register_blueprint(import_string(blueprint))
+    app.register_error_handler(404, page_not_found)
+    app.register_error_handler(500, internal_error)
+
+    finished = time.time()
+    app.startup_seconds = {
+        'import': _import_seconds,
+        'extensions': extensions_done - started,
+        'blueprints': finished - extensions_done,
+        'total': finished - started,
+    }
+    return app
 
-# register bluepints
-app.register_blueprint(users_blueprint)
-app.register_blueprint(tasks_blueprint)
-app.register_blueprint(api_blueprint)
 
 # redirector & logger for http errors
-@app.errorhandler(404)
+# error_log.emit() only queues the line, see project/errorlog.py
 def page_not_found(error):
-    if app.debug is not True:
-        now = datetime.datetime.utcnow()
-        r = request.url     # http://flask.pocoo.org/docs/0.11/api/#incoming-request-data
-                            # class flask.Request(environ, populate_request=True, shallow=False)
-        with open('error.log', 'a') as f:
-            current_timestamp = now.strftime("%d-%m-%Y %H:%M:%S")
-            f.write("\n404 error at {}: {}".format(current_timestamp, r))
+    if current_app.debug is not True:
+        error_log.emit(404, request)    # http://flask.pocoo.org/docs/0.11/api/#incoming-request-data
     return render_template('404.html'), 500
 
-@app.errorhandler(500)
 def internal_error(error):
-    if app.debug is not True:
-        now = datetime.datetime.utcnow()
-        r = request.url
-        with open('error.log', 'a') as f:
-            current_timestamp = now.strftime("%d-%m-%Y %H:%M:%S")
-            f.write("\n500 error at {}: {}".format(current_timestamp, r))
+    if current_app.debug is not True:
+        error_log.emit(500, request)
     return render_template('500.html'), 500
-
-
-
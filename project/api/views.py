@@ -1,8 +1,18 @@
+import csv
+import datetime
+import io
+import math
+import time
 from functools import wraps
-from flask import flash, redirect, jsonify, session, url_for, Blueprint, make_response
+from flask import jsonify, Blueprint, make_response, request, current_app, Response, stream_with_context
 
-from project import db
+from project import changes, journal, search, summary
+from project.auth import login_required, current_user
 from project.models import Task
+from project.pagination import keyset, encode_cursor, page_size, InvalidCursor
+from project.serializers import TASK_KEYS, task_rows, task_to_dict, task_values, dumps, json_response
+from project.queries import create_tasks, complete_tasks, delete_tasks, complete_task, delete_task, \
+    DONE, FORBIDDEN
 
 ### config ###
 # set blueprint to the 'api' directory. Also registered at project/__init__.py
@@ -10,66 +20,316 @@ api_blueprint = Blueprint('api', __name__)
 
 ### helper functions ###
 
-def login_required(test):
-    @wraps(test)
+# conditional GET for polling clients: the ETag is the change version of the tasks table
+# (see project/changes.py), so an unchanged table is answered with 304 Not Modified after one
+# primary key lookup, without querying or serializing any task.
+# http://werkzeug.pocoo.org/docs/0.11/wrappers/#werkzeug.wrappers.ETagRequestMixin
+def conditional(view):
+    @wraps(view)
     def wrap(*args, **kwargs):
-        if 'logged_in' in session:
-            return test(*args, **kwargs)
+        version, modified = changes.current()
+        etag = 'tasks-{}'.format(version)
+        last_modified = None
+        if modified is not None:
+            # HTTP dates have whole seconds: round up, and leave the header out while that
+            # second is not over yet, or a second change within it could never be seen
+            last_modified = datetime.datetime.utcfromtimestamp(
+                math.ceil((modified - datetime.datetime(1970, 1, 1)).total_seconds())
+            )
+            if last_modified > datetime.datetime.utcnow():
+                last_modified = None
+        if request.if_none_match:
+            # If-None-Match wins over If-Modified-Since (RFC 7232, 3.3). weak comparison,
+            # compressed responses carry a weak ETag (project/compression.py)
+            not_modified = request.if_none_match.contains_weak(etag)
         else:
-            flash('You need to login first.')
-            return redirect(url_for('users.login'))
+            not_modified = last_modified is not None and request.if_modified_since is not None \
+                and last_modified <= request.if_modified_since
+        response = Response(status=304) if not_modified else make_response(view(*args, **kwargs))
+        if response.status_code in (200, 304):
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            # cacheable, but always revalidated
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
     return wrap
 
-def open_tasks():
-    return db.session.query(Task).\
-        filter_by(status='1').order_by(Task.due_date.asc())
+# request body of the bulk endpoints: {"<key>": [...]} with 1 to API_MAX_BATCH_SIZE items
+def batch(key):
+    payload = request.get_json(silent=True)
+    items = payload.get(key) if isinstance(payload, dict) else None
+    if not isinstance(items, list) or not items:
+        raise ValueError('Expected a non-empty list in "{}"'.format(key))
+    if len(items) > current_app.config['API_MAX_BATCH_SIZE']:
+        raise ValueError('At most {} items per batch'.format(current_app.config['API_MAX_BATCH_SIZE']))
+    return items
 
-def closed_tasks():
-    return db.session.query(Task).\
-        filter_by(status='0').order_by(Task.due_date.asc())
+# same rules as tasks.forms.AddTaskForm, with ISO dates (YYYY-MM-DD)
+def new_task_row(item, today):
+    if not isinstance(item, dict):
+        raise ValueError('Expected an object')
+    name = item.get('name')
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError('name is required')
+    try:
+        due_date = datetime.datetime.strptime(item.get('due_date'), '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        raise ValueError('due_date must be YYYY-MM-DD')
+    try:
+        priority = int(item.get('priority'))
+    except (TypeError, ValueError):
+        priority = None
+    if priority is None or not 1 <= priority <= 10:
+        raise ValueError('priority must be between 1 and 10')
+    return {
+        'name': name,
+        'due_date': due_date,
+        'priority': priority,
+        'posted_date': today,
+        'status': 1,
+        'user_id': current_user.id
+    }
+
+def task_ids(items):
+    ids = []
+    for item in items:
+        if not isinstance(item, int) or isinstance(item, bool):
+            raise ValueError('task_ids must be integers')
+        if item not in ids:
+            ids.append(item)
+    return ids
 
 ### routes ###
 
 @api_blueprint.route('/api/v1/tasks/')
+@conditional
 def api_tasks():
-    # in flasktaskr.db/tasks table, returns the first 10 rows as a list
-    results = db.session.query(Task).limit(10).offset(0).all()  #all() returns the results as a list
-    json_results = []
-    # append each row as dictionary data into json_results
-    for result in results:
-        data = {
-            'task_id': result.task_id,
-            'task name': result.name,
-            'due date': str(result.due_date),
-            'priority': result.priority,
-            'posted date': str(result.posted_date),
-            'status': result.status,
-            'user id': result.user_id
-        }
-        json_results.append(data)
-    # json renderer
-    # flask.json.jsonify(*args, **kwargs)
-    # turns the JSON output into a Response object with the application/json mimetype.
-    # http://flask.pocoo.org/docs/0.11/api/#module-flask.json
-    return jsonify(items=json_results)
+    # keyset pagination: ?cursor=<next_cursor of the previous page>&per_page=<n>
+    per_page = page_size(
+        request.args.get('per_page'),
+        current_app.config['API_PAGE_SIZE'],
+        current_app.config['API_MAX_PAGE_SIZE']
+    )
+    try:
+        query = keyset(task_rows(), request.args.get('cursor'), per_page)
+    except InvalidCursor:
+        return make_response(jsonify(error='Invalid cursor'), 400)
+
+    # the body is streamed (chunked) row by row instead of being built in memory first,
+    # so a large page costs the same per row as a small one.
+    # http://flask.pocoo.org/docs/0.11/patterns/streaming/
+    def generate():
+        yield '{"items":['
+        last = None
+        for count, result in enumerate(query):
+            if count == per_page:
+                # the extra row only tells us that there is a next page
+                yield '],"next_cursor":{}}}'.format(dumps(encode_cursor(last)))
+                return
+            yield (',' if count else '') + dumps(task_to_dict(result))
+            last = result
+        yield '],"next_cursor":null}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
 @api_blueprint.route('/api/v1/tasks/<int:task_id>')
+@conditional
 def task(task_id):
-    result = db.session.query(Task).filter_by(task_id=task_id).first()
+    result = task_rows().filter(Task.task_id == task_id).first()
     if result:
-        result = {
-            'task_id': result.task_id,
-            'task name': result.name,
-            'due date': str(result.due_date),
-            'priority': result.priority,
-            'posted date': str(result.posted_date),
-            'status': result.status,
-            'user id': result.user_id
-        }
+        result = task_to_dict(result)
         code = 200
     else:
         result = {"error": 'Element does not exist!'}
         code = 404
-    # http://flask.pocoo.org/docs/0.11/api/#flask.make_response
-    return make_response(jsonify(items=result), code)
+    return json_response({'items': result}, code)
+
+# full-text search over task names, best matches first: ?q=<words>&cursor=<next_cursor>
+# every word matches as a prefix. see project/search.py
+@api_blueprint.route('/api/v1/tasks/search')
+def search_tasks():
+    q = request.args.get('q', '')
+    if not search.words(q):
+        return make_response(jsonify(error='q must contain at least one word'), 400)
+    per_page = page_size(
+        request.args.get('per_page'),
+        current_app.config['API_PAGE_SIZE'],
+        current_app.config['API_MAX_PAGE_SIZE']
+    )
+    try:
+        page = search.search(q, request.args.get('cursor'), per_page)
+    except InvalidCursor:
+        return make_response(jsonify(error='Invalid cursor'), 400)
+    return json_response({
+        'items': [task_to_dict(row) for row in page.items],
+        'next_cursor': page.next_cursor
+    })
+
+# every task as CSV or NDJSON (one JSON object per line).
+# rows come from a server-side cursor in batches of EXPORT_BATCH_SIZE (yield_per) and each
+# batch is sent as soon as it is encoded, so memory use does not depend on the size of the
+# table and the header/first rows go out right away.
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+@api_blueprint.route('/api/v1/tasks/export')
+@login_required
+def export_tasks():
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return make_response(jsonify(error='format must be one of: csv, ndjson'), 400)
+    batch_size = current_app.config['EXPORT_BATCH_SIZE']
+    rows = task_rows().order_by(Task.task_id).yield_per(batch_size)
+
+    def generate():
+        buffer = io.StringIO()
+
+        def flush():
+            chunk = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return chunk
+
+        # both formats have the keys of the API, see project/serializers.py
+        if export_format == 'csv':
+            writer = csv.writer(buffer)
+            writer.writerow(TASK_KEYS)
+            write = lambda row: writer.writerow(task_values(row))
+            yield flush()
+        else:
+            write = lambda row: buffer.write(dumps(task_to_dict(row)) + '\n')
+        for count, row in enumerate(rows, 1):
+            write(row)
+            if count % batch_size == 0:
+                yield flush()
+        if buffer.tell():
+            yield flush()
+
+    response = Response(stream_with_context(generate()), mimetype=EXPORT_FORMATS[export_format])
+    response.headers['Content-Disposition'] = 'attachment; filename=tasks.' + export_format
+    return response
+
+# feed of task changes from project/journal.py, resumable with ?since=<seq> (or the
+# Last-Event-ID header EventSource sends when it reconnects). without a sequence number the
+# feed starts at the current end of the journal. users get the changes of their own tasks,
+# admins those of everyone.
+# - Accept: text/event-stream gets server-sent events (id: seq, event: created/completed/
+#   deleted, data: the entry as JSON) with a comment line every CHANGES_HEARTBEAT seconds;
+#   the stream ends after CHANGES_STREAM_SECONDS and EventSource reconnects where it stopped.
+# - otherwise a long poll: waits up to ?wait= seconds (at most CHANGES_POLL_TIMEOUT) for
+#   entries and answers {"items": [...], "last_seq": n}.
+# either way {"reset": true} (an event named reset) means the client fell behind the
+# journal and should reload /api/v1/tasks/ before following the feed again from last_seq.
+# a waiting client holds a worker: serve the app with gevent workers (see Procfile), where
+# it is an idle greenlet instead of a blocked thread.
+# https://html.spec.whatwg.org/multipage/server-sent-events.html
+@api_blueprint.route('/api/v1/tasks/changes')
+@login_required
+def task_changes():
+    config = current_app.config
+    user_id = None if current_user.is_admin else current_user.id
+    seq = request.args.get('since', request.headers.get('Last-Event-ID'))
+    try:
+        seq = journal.last_seq() if seq is None else int(seq)
+    except ValueError:
+        return make_response(jsonify(error='since must be a sequence number'), 400)
+
+    if request.accept_mimetypes.best == 'text/event-stream':
+        heartbeat = config['CHANGES_HEARTBEAT']
+        deadline = time.time() + config['CHANGES_STREAM_SECONDS']
+
+        def generate(seq):
+            yield 'retry: 2000\n\n'
+            while time.time() < deadline:
+                entries, seq = journal.wait(seq, user_id, min(heartbeat, max(deadline - time.time(), 0)))
+                if entries is None:
+                    yield 'event: reset\ndata: {}\n\n'.format(dumps({'reset': True, 'last_seq': seq}))
+                elif not entries:
+                    yield ': keep-alive\n\n'
+                for entry in entries or ():
+                    yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(entry['seq'], entry['event'], dumps(entry))
+
+        response = Response(stream_with_context(generate(seq)), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'    # nginx: pass events on right away
+        return response
+
+    try:
+        timeout = min(max(float(request.args.get('wait', config['CHANGES_POLL_TIMEOUT'])), 0),
+                      config['CHANGES_POLL_TIMEOUT'])
+    except ValueError:
+        return make_response(jsonify(error='wait must be a number of seconds'), 400)
+    entries, seq = journal.wait(seq, user_id, timeout)
+    if entries is None:
+        return json_response({'reset': True, 'last_seq': seq})
+    return json_response({'items': entries, 'last_seq': seq})
+
+# open/closed task counts of the logged in user (and of everyone, for admins)
+# served from the cache in project/summary.py
+@api_blueprint.route('/api/v1/summary')
+@login_required
+def api_summary():
+    result = summary.counts_for(current_user.id)
+    if current_user.is_admin:
+        result['all'] = summary.totals()
+    return jsonify(items=result)
+
+# single-task mutations share the conditional UPDATE/DELETE helpers with tasks/views.py
+def mutation_response(result, task_id, done, forbidden):
+    if result == DONE:
+        return jsonify(items={'task_id': task_id, 'result': done})
+    elif result == FORBIDDEN:
+        return make_response(jsonify(error=forbidden), 403)
+    return make_response(jsonify(error='Element does not exist!'), 404)
+
+@api_blueprint.route('/api/v1/tasks/<int:task_id>/complete', methods=['POST'])
+@login_required
+def api_complete(task_id):
+    result = complete_task(task_id, current_user.id, current_user.is_admin)
+    return mutation_response(result, task_id, 'completed', 'You can only update tasks that belong to you.')
+
+@api_blueprint.route('/api/v1/tasks/<int:task_id>', methods=['DELETE'])
+@login_required
+def api_delete(task_id):
+    result = delete_task(task_id, current_user.id, current_user.is_admin)
+    return mutation_response(result, task_id, 'deleted', 'You can only delete tasks that belong to you.')
+
+# bulk endpoints: each batch is a single transaction with set-based statements.
+# see project/queries.py
+
+@api_blueprint.route('/api/v1/tasks/bulk', methods=['POST'])
+@login_required
+def bulk_create():
+    today = datetime.datetime.utcnow().date()
+    try:
+        items = batch('tasks')
+    except ValueError as e:
+        return make_response(jsonify(error=str(e)), 400)
+    rows, errors = [], {}
+    for index, item in enumerate(items):
+        try:
+            rows.append(new_task_row(item, today))
+        except ValueError as e:
+            errors[str(index)] = str(e)
+    # all or nothing
+    if errors:
+        return make_response(jsonify(error='Invalid tasks', items=errors), 400)
+    return make_response(jsonify(created=create_tasks(rows)), 201)
+
+def bulk_mutation(mutate, done):
+    try:
+        ids = task_ids(batch('task_ids'))
+    except ValueError as e:
+        return make_response(jsonify(error=str(e)), 400)
+    allowed, forbidden, not_found = mutate(ids, current_user.id, current_user.is_admin)
+    return jsonify(**{done: allowed, 'forbidden': forbidden, 'not_found': not_found})
+
+@api_blueprint.route('/api/v1/tasks/bulk/complete', methods=['POST'])
+@login_required
+def bulk_complete():
+    return bulk_mutation(complete_tasks, 'completed')
 
+@api_blueprint.route('/api/v1/tasks/bulk/delete', methods=['POST'])
+@login_required
+def bulk_delete():
+    return bulk_mutation(delete_tasks, 'deleted')
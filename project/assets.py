@@ -0,0 +1,45 @@
+import hashlib
+import os
+import threading
+
+from flask import request
+
+# fingerprinted static files: url_for('static', filename=...) appends ?v=<content hash>,
+# so the URL changes whenever the file does and browsers can keep it for a year without
+# revalidating. a request with a stale or missing ?v= gets the normal short cache lifetime.
+
+
+def init_app(app):
+    fingerprints = {}
+    lock = threading.Lock()
+
+    def fingerprint(filename):
+        path = os.path.join(app.static_folder, filename)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        with lock:
+            cached = fingerprints.get(path)
+        if cached is None or cached[0] != mtime:
+            with open(path, 'rb') as f:
+                cached = (mtime, hashlib.md5(f.read()).hexdigest()[:12])
+            with lock:
+                fingerprints[path] = cached
+        return cached[1]
+
+    @app.url_defaults
+    def add_fingerprint(endpoint, values):
+        if endpoint == 'static' and 'v' not in values and 'filename' in values:
+            version = fingerprint(values['filename'])
+            if version:
+                values['v'] = version
+
+    @app.after_request
+    def cache_fingerprinted(response):
+        if request.endpoint == 'static' and response.status_code == 200 \
+                and request.args.get('v') == fingerprint(request.view_args['filename']):
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config['STATIC_MAX_AGE']
+            response.headers['Cache-Control'] += ', immutable'
+        return response
@@ -0,0 +1,107 @@
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
+
+from flask import current_app, flash, g, jsonify, make_response, redirect, request, session, url_for
+from sqlalchemy import event
+from werkzeug.local import LocalProxy
+
+from project import db, changes
+from project.database import RoutingSession
+from project.models import User
+
+# login_required and the logged in user for every blueprint.
+# current_user is loaded at most once per request, from an in-process cache keyed by user id
+# (IDENTITY_CACHE_TTL seconds), so most requests check the role without touching the database.
+# it is a read-only snapshot of the users row; query User when you need to change it.
+# current_user is None-like (falsy) for anonymous requests.
+# changing or deleting a User through the ORM bumps the 'users' change version
+# (project/changes.py) in the same transaction and forgets the user in this process. every
+# IDENTITY_VERSION_POLL seconds each worker reads that version and empties its cache when it
+# moved, so a revoked role stops working everywhere within that time, not after the TTL.
+
+Identity = namedtuple('Identity', ['id', 'name', 'email', 'role'])
+Identity.is_admin = property(lambda self: self.role == 'admin')
+
+_lock = threading.Lock()
+_identities = {}
+# the users version the cache was filled under, and when it was last read
+_version = {'seen': None, 'checked': 0}
+
+
+def _check_version(now):
+    if now - _version['checked'] < current_app.config['IDENTITY_VERSION_POLL']:
+        return
+    version, _ = changes.current('users')
+    with _lock:
+        if version != _version['seen']:
+            _identities.clear()
+        _version.update(seen=version, checked=now)
+
+
+def load_identity(user_id):
+    now = time.time()
+    _check_version(now)
+    found = _identities.get(user_id)
+    if found is not None and found[1] > now:
+        return found[0]
+    row = db.session.query(User.id, User.name, User.email, User.role).\
+        filter(User.id == user_id).first()
+    if row is None:
+        # deleted user: nothing is cached, the session simply stops working
+        return None
+    identity = Identity(*row)
+    with _lock:
+        _identities[user_id] = (identity, now + current_app.config['IDENTITY_CACHE_TTL'])
+    return identity
+
+
+def forget(user_id=None):
+    # drop one user (after changing the row) or everyone from the cache
+    with _lock:
+        if user_id is None:
+            _identities.clear()
+            # the cache is empty: no need to read the version before the next poll is due
+            _version.update(seen=None, checked=time.time())
+        else:
+            _identities.pop(user_id, None)
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def _users_changed(db_session, flush_context, instances):
+    changed = [user.id for user in db_session.deleted if isinstance(user, User)]
+    changed += [user.id for user in db_session.dirty
+                if isinstance(user, User) and db_session.is_modified(user)]
+    if changed:
+        changes.bump(changed, 'users')
+        for user_id in changed:
+            forget(user_id)
+
+
+def _current_user():
+    if 'current_user' not in g:
+        user_id = session.get('user_id') if session.get('logged_in') else None
+        g.current_user = load_identity(user_id) if user_id is not None else None
+    return g.current_user
+
+
+current_user = LocalProxy(_current_user)
+
+
+def login_required(view):
+    @wraps(view)
+    def wrap(*args, **kwargs):
+        if current_user:
+            return view(*args, **kwargs)
+        if request.blueprint == 'api':
+            return make_response(jsonify(error='You need to login first.'), 401)
+        flash('You need to login first.')
+        return redirect(url_for('users.login'))
+    return wrap
+
+
+def init_app(app):
+    @app.context_processor
+    def inject_current_user():
+        return {'current_user': current_user}
@@ -0,0 +1,77 @@
+from datetime import datetime
+
+from sqlalchemy import event, func, select
+from sqlalchemy.dialects import postgresql
+
+from project import db
+from project.models import ChangeVersion
+
+# change versions of the tasks and users tables, shared by all worker processes through the database.
+# every write to tasks calls bump() before its commit, so the version moves atomically
+# with the data. reads are one primary key range with a Core select (no ORM objects),
+# cheap enough to run before deciding whether a request can be answered with 304.
+# the version is kept in PARTITIONS rows ('tasks:0'...), a write bumps the rows of the
+# owners of the tasks it changed (of the users it changed, for 'users'): writers of different users rarely wait on the same row
+# lock. the version of the table is the sum of its rows, which grows with every bump.
+# the rows are added with the table; a database upgraded from a single row gets them from
+# the first writer of each partition.
+# changing PARTITIONS can make the sum repeat an old value: clients may get one stale 304
+
+PARTITIONS = 16
+
+_table = ChangeVersion.__table__
+
+
+def _key(name, user_id):
+    return '{}:{}'.format(name, (user_id or 0) % PARTITIONS)
+
+
+def _keys(name):
+    return [_key(name, partition) for partition in range(PARTITIONS)]
+
+
+@event.listens_for(_table, 'after_create')
+def _seed(target, connection, **kw):
+    connection.execute(_table.insert(), [
+        {'name': key, 'version': 0, 'modified': datetime.utcnow()}
+        for name in ('tasks', 'users') for key in _keys(name)
+    ])
+
+
+def _insert_missing(key, now):
+    # an INSERT that leaves the row alone when another writer added it first
+    # (a failed plain INSERT would end the whole transaction on postgresql)
+    values = {'name': key, 'version': 0, 'modified': now}
+    dialect = db.session.connection().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(_table).values(**values).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return _table.insert().prefix_with('OR IGNORE').values(**values)
+    return _table.insert().values(**values)
+
+
+def _bump_row(key, now):
+    statement = _table.update().where(_table.c.name == key).\
+        values(version=_table.c.version + 1, modified=now)
+    if not db.session.execute(statement).rowcount:
+        db.session.execute(_insert_missing(key, now))
+        db.session.execute(statement)
+
+
+def bump(user_ids, name='tasks'):
+    # user_ids: owners of the changed tasks. rows are locked in key order, so two writers
+    # bumping the same rows cannot deadlock
+    now = datetime.utcnow()
+    for key in sorted(set(_key(name, user_id) for user_id in user_ids)):
+        _bump_row(key, now)
+
+
+def current(name='tasks'):
+    # (version, modified) or (0, None) while nothing was ever changed
+    row = db.session.execute(
+        select([func.sum(_table.c.version), func.max(_table.c.modified)]).
+        where(_table.c.name.in_(_keys(name)))
+    ).first()
+    if not row[0]:
+        return 0, None
+    return row[0], row[1]
@@ -0,0 +1,82 @@
+import gzip
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# response compression for the pages and the API (after_request).
+# a response is compressed when the client accepts it, its mimetype is in COMPRESS_MIMETYPES
+# and its body is at least COMPRESS_MIN_SIZE bytes; brotli is preferred when the brotli
+# package is installed. files sent by send_file (static assets) are left alone.
+# streamed responses (the API listing, the export) are gzipped chunk by chunk as they are
+# sent: each chunk is flushed (Z_SYNC_FLUSH) so the client gets it right away, and the body
+# is never held in memory as a whole. their size is not known up front, so
+# COMPRESS_MIN_SIZE does not apply to them.
+
+
+def init_app(app):
+    @app.after_request
+    def compress(response):
+        return compress_response(app.config, response)
+
+
+def choose_encoding(accept_encodings):
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def gzip_stream(chunks, level, close=None):
+    # wbits 16 + MAX_WBITS: gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        for chunk in chunks:
+            if chunk:
+                yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        # e.g. stream_with_context, which tears down the request context on close
+        if close is not None:
+            close()
+
+
+def compress_response(config, response):
+    if not config['COMPRESS_ENABLED'] \
+            or not 200 <= response.status_code < 300 \
+            or response.direct_passthrough \
+            or 'Content-Encoding' in response.headers \
+            or response.mimetype not in config['COMPRESS_MIMETYPES']:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        # brotli has no incremental API in every version of the package: gzip only
+        if not request.accept_encodings['gzip']:
+            return response
+        encoding = 'gzip'
+        response.response = gzip_stream(response.iter_encoded(), config['COMPRESS_LEVEL'],
+                                        getattr(response.response, 'close', None))
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < config['COMPRESS_MIN_SIZE']:
+            return response
+        if encoding == 'br':
+            data = brotli.compress(data, quality=config['COMPRESS_BROTLI_QUALITY'])
+        else:
+            data = gzip.compress(data, compresslevel=config['COMPRESS_LEVEL'])
+        response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    # the bytes differ from the uncompressed representation, so a strong ETag becomes weak
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
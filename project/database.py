@@ -0,0 +1,93 @@
+import threading
+import time
+import weakref
+from functools import partial
+
+from flask import current_app, g, has_request_context, request, session
+from flask.ext.sqlalchemy import SQLAlchemy as BaseSQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event
+from sqlalchemy.pool import StaticPool
+
+# Flask-SQLAlchemy with per-backend engine settings.
+# server databases (DATABASE_URL=postgresql://...) get a connection pool sized by
+# SQLALCHEMY_POOL_SIZE / SQLALCHEMY_MAX_OVERFLOW. sqlite keeps one connection per session
+# (the pool options do not apply to it) and every new connection gets SQLITE_PRAGMAS:
+# WAL lets readers and a writer work at the same time, busy_timeout makes a blocked writer
+# wait instead of failing with "database is locked".
+# https://www.sqlite.org/wal.html
+#
+# read replica routing: when SQLALCHEMY_BINDS has a READ_REPLICA_BIND entry, requests to the
+# READ_ONLY_ENDPOINTS run all their queries on that engine. a client that committed a write
+# in the last REPLICA_STICKY_SECONDS stays on the primary, so it reads its own writes even
+# while the replica is lagging behind.
+
+
+def apply_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas:
+        cursor.execute('PRAGMA {}={}'.format(name, value))
+    cursor.close()
+
+
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_request_context() and getattr(g, 'use_replica', False):
+            state = get_state(self.app)
+            return state.db.get_engine(self.app, bind=self.app.config['READ_REPLICA_BIND'])
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def remember_write(db_session):
+    if has_request_context():
+        g.committed = True
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+
+    def __init__(self, *args, **kwargs):
+        self._tuned = weakref.WeakSet()
+        self._tuning_lock = threading.Lock()
+        super(SQLAlchemy, self).__init__(*args, **kwargs)
+
+    def init_app(self, app):
+        super(SQLAlchemy, self).init_app(app)
+        app.before_request(self._route_request)
+        app.after_request(self._stick_to_primary)
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def _route_request(self):
+        config = current_app.config
+        replica = config['READ_REPLICA_BIND']
+        g.use_replica = replica in (config['SQLALCHEMY_BINDS'] or {}) \
+            and request.endpoint in config['READ_ONLY_ENDPOINTS'] \
+            and time.time() - session.get('last_write', 0) > config['REPLICA_STICKY_SECONDS']
+
+    def _stick_to_primary(self, response):
+        if getattr(g, 'committed', False):
+            session['last_write'] = time.time()
+        return response
+
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername.startswith('sqlite'):
+            for option in ('pool_size', 'pool_timeout', 'pool_recycle', 'max_overflow'):
+                options.pop(option, None)
+            if info.database in (None, '', ':memory:'):
+                # an in-memory database lives as long as its connection: keep a single one
+                # and share it between threads, or each thread would see its own empty database
+                options['poolclass'] = StaticPool
+                options.setdefault('connect_args', {})['check_same_thread'] = False
+        super(SQLAlchemy, self).apply_driver_hacks(app, info, options)
+
+    def get_engine(self, app, bind=None):
+        engine = super(SQLAlchemy, self).get_engine(app, bind)
+        if engine.dialect.name == 'sqlite' and engine not in self._tuned:
+            with self._tuning_lock:
+                if engine not in self._tuned:
+                    pragmas = sorted(self.get_app(app).config['SQLITE_PRAGMAS'].items())
+                    event.listen(engine, 'connect', partial(apply_pragmas, pragmas))
+                    self._tuned.add(engine)
+        return engine
@@ -0,0 +1,165 @@
+import atexit
+import datetime
+import json
+import os
+import queue
+import threading
+
+from flask import current_app
+
+# error log for the 404/500 handlers in project/__init__.py.
+# logging a line is a non-blocking put on a bounded queue; a background thread drains the
+# queue in batches, writes each batch with one write() and one flush(), and rotates the file
+# once it grows past ERROR_LOG_MAX_BYTES (error.log -> error.log.1 -> ... ERROR_LOG_BACKUP_COUNT).
+# when the queue is full (the disk cannot keep up) lines are dropped and counted rather than
+# slowing down the requests. so are batches that cannot be written (unwritable path, full
+# disk): the writer carries on with the next batch. each line is a JSON object.
+# every app has its own writer (app.extensions['error_log']) with the settings of that app,
+# started by the first line it logs; apps of one process should not share ERROR_LOG_PATH.
+
+
+class ErrorLog(object):
+
+    def __init__(self):
+        self._writers = []
+        atexit.register(self.stop)
+
+    def init_app(self, app):
+        writer = app.extensions['error_log'] = _Writer(app.config)
+        self._writers.append(writer)
+
+    @property
+    def dropped(self):
+        return sum(writer.dropped for writer in self._writers)
+
+    def emit(self, status, request):
+        current_app.extensions['error_log'].emit(status, request)
+
+    def flush(self):
+        # blocks until everything emitted so far is on disk
+        for writer in self._writers:
+            writer.flush()
+
+    def stop(self):
+        # the next line logged starts the writer again, with the settings of its app then
+        for writer in self._writers:
+            writer.stop()
+
+
+# seconds stop() waits for the writer thread
+STOP_WAIT = 5
+
+
+class _Writer(object):
+
+    def __init__(self, config):
+        self.dropped = 0
+        self._config = config
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        config = self._config
+        self._path = config['ERROR_LOG_PATH']
+        self._max_bytes = config['ERROR_LOG_MAX_BYTES']
+        self._backup_count = config['ERROR_LOG_BACKUP_COUNT']
+        self._batch_size = config['ERROR_LOG_BATCH_SIZE']
+        self._queue = queue.Queue(config['ERROR_LOG_QUEUE_SIZE'])
+        self._thread = threading.Thread(target=self._run, name='error-log')
+        self._thread.daemon = True
+        self._thread.start()
+        self._pid = os.getpid()
+
+    def _running(self):
+        # threads do not survive a fork (gunicorn --preload), so restart in the child
+        if self._thread is None or self._pid != os.getpid():
+            with self._lock:
+                if self._thread is None or self._pid != os.getpid():
+                    self._start()
+        return self._queue
+
+    def emit(self, status, request):
+        record = {
+            'time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'status': status,
+            'method': request.method,
+            'url': request.url,
+            'remote_addr': request.remote_addr
+        }
+        try:
+            self._running().put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.join()
+
+    def stop(self):
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                return
+            try:
+                # a full queue drains in well under STOP_WAIT seconds while the thread runs
+                self._queue.put(None, timeout=STOP_WAIT)
+                self._thread.join(STOP_WAIT)
+            except queue.Full:
+                pass
+            self._thread = None
+
+    def _run(self):
+        stream = None
+        while True:
+            records = [self._queue.get()]
+            try:
+                while len(records) < self._batch_size:
+                    try:
+                        records.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = None in records
+                lines = ''.join(json.dumps(r) + '\n' for r in records if r is not None)
+                if lines:
+                    try:
+                        stream = self._write(stream, lines)
+                    except OSError:
+                        # unwritable path, full disk...: the batch is lost, the next one
+                        # opens the file again
+                        self.dropped += sum(1 for r in records if r is not None)
+                        stream = self._close(stream)
+            finally:
+                for _ in records:
+                    self._queue.task_done()
+            if stop:
+                self._close(stream)
+                return
+
+    def _write(self, stream, lines):
+        if stream is None:
+            stream = open(self._path, 'a')
+        if stream.tell() and stream.tell() + len(lines) > self._max_bytes:
+            stream = self._close(stream)
+            self._rotate()
+            stream = open(self._path, 'a')
+        stream.write(lines)
+        stream.flush()
+        return stream
+
+    def _close(self, stream):
+        if stream is not None:
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+    def _rotate(self):
+        for n in range(self._backup_count - 1, 0, -1):
+            source = '{}.{}'.format(self._path, n)
+            if os.path.exists(source):
+                os.rename(source, '{}.{}'.format(self._path, n + 1))
+        if self._backup_count:
+            os.rename(self._path, self._path + '.1')
+        else:
+            os.remove(self._path)
@@ -0,0 +1,107 @@
+import datetime
+import json
+import time
+
+from flask import current_app
+from sqlalchemy import and_, func, select
+
+from project import db
+from project.models import TaskChange
+
+# journal of task changes, read by /api/v1/tasks/changes.
+# the mutation helpers in project/queries.py, new_task and the importer add an entry per
+# owner of the changed tasks before they commit, so an entry exists exactly when its change
+# does, whichever process (web worker, db_migrate.py) made it. entries live in the
+# task_changes table: seq is its autoincrement primary key and orders the feed for every
+# worker alike. readers ask for the entries after the last seq they saw, a primary key
+# range (or a (user_id, seq) range for users who only see their own tasks), and a long poll
+# repeats that every CHANGES_POLL_INTERVAL seconds, without holding a connection in between.
+# about CHANGES_JOURNAL_SIZE entries are kept; a reader that fell further behind is told to
+# reload (since() returns None).
+# server databases hand out seq values before commit, so a transaction can commit after
+# one with a higher seq: there entries are only read once they are CHANGES_SETTLE_SECONDS
+# old, by when the transactions that took the lower seqs are over. sqlite commits one
+# writer at a time, in seq order.
+
+_table = TaskChange.__table__
+# entries added by this process, the journal is trimmed every TRIM_EVERY of them
+_recorded = {'count': 0}
+TRIM_EVERY = 100
+
+
+def record(event, task_ids, user_id, count=None):
+    # event: 'created', 'completed' or 'deleted' of tasks of the user user_id, in the
+    # transaction of the change (the caller commits). task_ids is None when not known
+    # (bulk inserts), count says how many tasks changed
+    db.session.execute(_table.insert().values(
+        event=event,
+        user_id=user_id,
+        task_ids=None if task_ids is None else json.dumps(task_ids),
+        count=len(task_ids) if count is None else count,
+        created=datetime.datetime.utcnow()
+    ))
+    _recorded['count'] += 1
+    if _recorded['count'] % TRIM_EVERY == 0:
+        # db.get_app(): scripts such as db_migrate.py may run without an app context
+        _trim(db.get_app().config['CHANGES_JOURNAL_SIZE'])
+
+
+def _trim(size):
+    newest = db.session.execute(select([func.max(_table.c.seq)])).scalar()
+    if newest is not None:
+        db.session.execute(_table.delete().where(_table.c.seq <= newest - size))
+
+
+def _visible(query):
+    settle = current_app.config['CHANGES_SETTLE_SECONDS']
+    if settle and db.session.connection().dialect.name != 'sqlite':
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=settle)
+        query = query.where(_table.c.created <= cutoff)
+    return query
+
+
+def _entry(row):
+    return {
+        'seq': row.seq,
+        'event': row.event,
+        'task_ids': None if row.task_ids is None else json.loads(row.task_ids),
+        'count': row.count,
+        'user_id': row.user_id,
+        'time': row.created.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    }
+
+
+def last_seq():
+    return db.session.execute(_visible(select([func.max(_table.c.seq)]))).scalar() or 0
+
+
+def since(seq, user_id=None):
+    # (entries after seq, seq to resume from), entries are [] when there are none yet and
+    # None when seq is too old (or unknown). user_id: only the entries of that user
+    oldest, newest = db.session.execute(
+        _visible(select([func.min(_table.c.seq), func.max(_table.c.seq)]))
+    ).first()
+    newest = newest or 0
+    if seq > newest or (oldest is not None and seq < oldest - 1):
+        return None, newest
+    query = select([_table]).where(and_(_table.c.seq > seq, _table.c.seq <= newest))
+    if user_id is not None:
+        query = query.where(_table.c.user_id == user_id)
+    limit = current_app.config['CHANGES_PAGE_SIZE']
+    rows = db.session.execute(query.order_by(_table.c.seq).limit(limit)).fetchall()
+    # the other users' entries up to newest are done with as well, unless the page is full
+    return [_entry(row) for row in rows], rows[-1].seq if len(rows) == limit else newest
+
+
+def wait(seq, user_id, timeout):
+    # like since(), but polls up to timeout seconds while there is nothing new
+    deadline = time.time() + timeout
+    while True:
+        entries, seq_after = since(seq, user_id)
+        # end the read transaction: the connection goes back to the pool while waiting
+        db.session.rollback()
+        remaining = deadline - time.time()
+        if entries != [] or remaining <= 0:
+            return entries, seq_after
+        seq = seq_after
+        time.sleep(min(current_app.config['CHANGES_POLL_INTERVAL'], remaining))
@@ -0,0 +1,218 @@
+import bisect
+import hmac
+import threading
+import time
+
+from flask import abort, current_app, g, has_request_context, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# opt-in request instrumentation (METRICS_ENABLED, or enable(app) at runtime).
+# for every request it records the wall time, the number and total time of SQL statements
+# (SQLAlchemy engine events, every engine including the replica) and the time spent
+# rendering Jinja templates, then
+# - adds them to the response as a Server-Timing header (shown by the browser dev tools),
+# - adds them to per-endpoint histograms, served by /metrics in the Prometheus text format.
+# when disabled none of the hooks are installed, so requests and statements pay nothing;
+# /metrics answers 404. histograms are per app and worker process. /metrics also reports the
+# startup time of the app (app.startup_seconds).
+# /metrics is only served to the addresses in METRICS_ALLOWED_IPS (loopback by default) and
+# to scrapers that send "Authorization: Bearer <METRICS_TOKEN>", others get 403.
+# https://www.w3.org/TR/server-timing/
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+HISTOGRAMS = (
+    # name, help, buckets, per-request value
+    ('flasktaskr_request_seconds', 'Wall time of the request', SECONDS_BUCKETS, 'elapsed'),
+    ('flasktaskr_sql_seconds', 'Time spent in SQL statements', SECONDS_BUCKETS, 'sql_time'),
+    ('flasktaskr_sql_statements', 'SQL statements executed', STATEMENT_BUCKETS, 'sql_count'),
+    ('flasktaskr_render_seconds', 'Time spent rendering templates', SECONDS_BUCKETS, 'render_time'),
+)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)    # the last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+
+class TimedTemplate(Template):
+    # jinja2 template class that adds its render time to the request
+
+    def render(self, *args, **kwargs):
+        if not has_request_context() or 'metrics' not in g:
+            return Template.render(self, *args, **kwargs)
+        started = time.time()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            g.metrics['render_time'] += time.time() - started
+
+
+# a connection runs one statement at a time: its start time is kept in conn.info until
+# after_cursor_execute, or until handle_error for a statement that raised
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['metrics_started'] = time.time()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('metrics_started', None)
+    if started is not None and has_request_context() and 'metrics' in g:
+        g.metrics['sql_count'] += 1
+        g.metrics['sql_time'] += time.time() - started
+
+
+def _handle_error(exception_context):
+    if exception_context.connection is not None:
+        exception_context.connection.info.pop('metrics_started', None)
+
+
+def _swap_template_class(app, template_class):
+    # templates are cached with the class they were loaded with
+    app.jinja_env.template_class = template_class
+    if app.jinja_env.cache is not None:
+        app.jinja_env.cache.clear()
+
+
+class Metrics(object):
+    # one extension for every app of the process: the state of an app (enabled, its
+    # histograms) lives in app.extensions['metrics'], and the hooks find it with current_app
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # apps with the hooks installed; the engine listeners stay while there is one
+        self._enabled_apps = 0
+
+    def init_app(self, app):
+        app.extensions['metrics'] = {'enabled': False, 'histograms': {}}
+        app.add_url_rule('/metrics', 'metrics', self.view)
+        if app.config['METRICS_ENABLED']:
+            self.enable(app)
+
+    def is_enabled(self, app):
+        return app.extensions['metrics']['enabled']
+
+    def enable(self, app):
+        state = app.extensions['metrics']
+        with self._lock:
+            if state['enabled']:
+                return
+            app.before_request_funcs.setdefault(None, []).insert(0, self._start)
+            # after_request functions run last registered first: ours runs after all the others
+            app.after_request_funcs.setdefault(None, []).insert(0, self._server_timing)
+            app.teardown_request_funcs.setdefault(None, []).append(self._record)
+            _swap_template_class(app, TimedTemplate)
+            if not self._enabled_apps:
+                event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+                event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+                event.listen(Engine, 'handle_error', _handle_error)
+            self._enabled_apps += 1
+            state['enabled'] = True
+
+    def disable(self, app):
+        state = app.extensions['metrics']
+        with self._lock:
+            if not state['enabled']:
+                return
+            app.before_request_funcs[None].remove(self._start)
+            app.after_request_funcs[None].remove(self._server_timing)
+            app.teardown_request_funcs[None].remove(self._record)
+            _swap_template_class(app, Template)
+            self._enabled_apps -= 1
+            if not self._enabled_apps:
+                event.remove(Engine, 'before_cursor_execute', _before_cursor_execute)
+                event.remove(Engine, 'after_cursor_execute', _after_cursor_execute)
+                event.remove(Engine, 'handle_error', _handle_error)
+            state['enabled'] = False
+
+    def reset(self, app):
+        with self._lock:
+            app.extensions['metrics']['histograms'] = {}
+
+    def _start(self):
+        g.metrics = {'started': time.time(), 'sql_count': 0, 'sql_time': 0.0, 'render_time': 0.0}
+
+    def _server_timing(self, response):
+        if 'metrics' in g:
+            values = g.metrics
+            response.headers['Server-Timing'] = \
+                'app;dur={:.1f}, db;dur={:.1f};desc="{} queries", render;dur={:.1f}'.format(
+                    (time.time() - values['started']) * 1000, values['sql_time'] * 1000,
+                    values['sql_count'], values['render_time'] * 1000
+                )
+        return response
+
+    def _record(self, exception=None):
+        values = getattr(g, 'metrics', None)
+        if values is None:
+            return
+        del g.metrics
+        if request.endpoint == 'metrics':
+            return
+        values['elapsed'] = time.time() - values['started']
+        endpoint = request.endpoint or '<unmatched>'
+        with self._lock:
+            all_histograms = current_app.extensions['metrics']['histograms']
+            histograms = all_histograms.get(endpoint)
+            if histograms is None:
+                histograms = all_histograms[endpoint] = [Histogram(h[2]) for h in HISTOGRAMS]
+            for histogram, definition in zip(histograms, HISTOGRAMS):
+                histogram.observe(values[definition[3]])
+
+    def exposition(self):
+        # the metrics of the current app
+        lines = []
+        with self._lock:
+            all_histograms = current_app.extensions['metrics']['histograms']
+            for index, (name, description, buckets, value) in enumerate(HISTOGRAMS):
+                lines.append('# HELP {} {}'.format(name, description))
+                lines.append('# TYPE {} histogram'.format(name))
+                for endpoint, histograms in sorted(all_histograms.items()):
+                    histogram = histograms[index]
+                    for bound, total in histogram.cumulative():
+                        lines.append('{}_bucket{{endpoint="{}",le="{}"}} {}'.format(name, endpoint, bound, total))
+                    lines.append('{}_sum{{endpoint="{}"}} {}'.format(name, endpoint, histogram.sum))
+                    lines.append('{}_count{{endpoint="{}"}} {}'.format(name, endpoint, histogram.count))
+        # how long the app took to start, see create_app() in project/__init__.py
+        lines.append('# HELP flasktaskr_startup_seconds Time spent starting the app, by phase')
+        lines.append('# TYPE flasktaskr_startup_seconds gauge')
+        for phase, seconds in sorted(getattr(current_app, 'startup_seconds', {}).items()):
+            lines.append('flasktaskr_startup_seconds{{phase="{}"}} {}'.format(phase, seconds))
+        return '\n'.join(lines) + '\n'
+
+    def _authorized(self):
+        config = current_app.config
+        if request.remote_addr in config['METRICS_ALLOWED_IPS']:
+            return True
+        token = config['METRICS_TOKEN']
+        if not token:
+            return False
+        # compare_digest: the time taken does not tell how much of the token matched
+        return hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'),
+                                   ('Bearer ' + token).encode('utf-8'))
+
+    def view(self):
+        if not self.is_enabled(current_app):
+            abort(404)
+        if not self._authorized():
+            abort(403)
+        return current_app.response_class(self.exposition(), mimetype='text/plain; version=0.0.4')
@@ -11,6 +11,16 @@ class Task(db.Model):
     status = db.Column(db.Integer)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id')) # binds to the table 'users', value 'id' in User class
 
+    # (status, due_date) serves open_tasks()/closed_tasks(): filter on status, already sorted by due_date.
+    # (user_id, status) serves the per-user counts of project/summary.py, from the index alone.
+    # (due_date, task_id) serves the keyset pages of /api/v1/tasks/, which do not filter on status.
+    # ownership checks (project/queries.py) go by task_id and use the primary key.
+    # existing databases get them through db_upgrade.py
+    __table_args__ = (
+        db.Index('ix_tasks_status_due_date', 'status', 'due_date'),
+        db.Index('ix_tasks_user_id_status', 'user_id', 'status'),
+        db.Index('ix_tasks_due_date_task_id', 'due_date', 'task_id'),
+    )
 
     def __init__(self, name, due_date, priority, posted_date, status, user_id):
         self.name = name
@@ -41,3 +51,97 @@ class User(db.Model):
 
     def __repr__(self):
         return '<User {0}>'.format(self.name)
+
+# one row per versioned table, bumped in the same transaction as every change to it.
+# the API derives its ETag / Last-Modified from here, see project/changes.py
+class ChangeVersion(db.Model):
+    __tablename__ = "change_versions"
+
+    name = db.Column(db.String, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    modified = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return '<ChangeVersion {0} {1}>'.format(self.name, self.version)
+
+# the change feed (project/journal.py, /api/v1/tasks/changes): one row per change and owner
+# of the changed tasks, added in the transaction of the change. seq orders the feed
+class TaskChange(db.Model):
+    __tablename__ = "task_changes"
+
+    seq = db.Column(db.Integer, primary_key=True)
+    event = db.Column(db.String, nullable=False)     # 'created', 'completed' or 'deleted'
+    user_id = db.Column(db.Integer, nullable=False)
+    task_ids = db.Column(db.Text)                    # JSON list, NULL when not known
+    count = db.Column(db.Integer, nullable=False)
+    created = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_task_changes_user_id_seq', 'user_id', 'seq'),
+        # seq values are never reused, even after the newest rows were deleted
+        {'sqlite_autoincrement': True},
+    )
+
+    def __repr__(self):
+        return '<TaskChange {0} {1}>'.format(self.seq, self.event)
+
+# reminders written by the scheduler (scheduler.py, project/reminders.py): at most one per
+# task and kind. the rows with sent NULL are an outbox, whatever delivers them sets sent.
+# no foreign key to tasks, a reminder outlives its task
+class Reminder(db.Model):
+    __tablename__ = "reminders"
+
+    id = db.Column(db.Integer, primary_key=True)
+    task_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String, nullable=False)     # 'due_soon' or 'overdue'
+    due_date = db.Column(db.Date, nullable=False)
+    created = db.Column(db.DateTime, nullable=False)
+    sent = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.UniqueConstraint('task_id', 'kind', name='uq_reminders_task_id_kind'),
+        db.Index('ix_reminders_sent', 'sent', 'id'),
+    )
+
+    def __repr__(self):
+        return '<Reminder {0} {1}>'.format(self.kind, self.task_id)
+
+# how far the scheduler got, per reminder kind: the (due_date, task_id) of the last task
+# it scanned in due date order, and the highest task_id it has seen
+class ReminderMark(db.Model):
+    __tablename__ = "reminder_marks"
+
+    kind = db.Column(db.String, primary_key=True)
+    due_date = db.Column(db.Date, nullable=False)
+    task_id = db.Column(db.Integer, nullable=False)
+    max_task_id = db.Column(db.Integer, nullable=False)
+    updated = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return '<ReminderMark {0} {1} {2}>'.format(self.kind, self.due_date, self.task_id)
+
+# server-side sessions in the app database (project/sessions.py, SESSION_STORE = 'database'),
+# shared by every worker and dyno
+class StoredSession(db.Model):
+    __tablename__ = "sessions"
+
+    sid = db.Column(db.String, primary_key=True)
+    user_id = db.Column(db.Integer, index=True)
+    data = db.Column(db.Text, nullable=False)
+    expires = db.Column(db.Float, nullable=False, index=True)
+
+    def __repr__(self):
+        return '<StoredSession {0}>'.format(self.user_id)
+
+# ids of the sessions ended by logout, in order: each worker reads the new ones to drop
+# them from its session cache
+class EndedSession(db.Model):
+    __tablename__ = "ended_sessions"
+
+    id = db.Column(db.Integer, primary_key=True)
+    sid = db.Column(db.String, nullable=False)
+    ended = db.Column(db.Float, nullable=False, index=True)
+
+    def __repr__(self):
+        return '<EndedSession {0}>'.format(self.id)
@@ -0,0 +1,84 @@
+import base64
+import json
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+from project.models import Task
+
+# keyset (a.k.a. cursor) pagination over (due_date, task_id)
+# instead of OFFSET n, each page starts right after the last row of the previous one,
+# so fetching page 1000 costs the same as fetching page 1.
+# https://use-the-index-luke.com/no-offset
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_token(values):
+    # tokens are opaque to clients: urlsafe base64 of a JSON list
+    raw = json.dumps(values)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_token(token):
+    padded = token + '=' * (-len(token) % 4)
+    try:
+        return json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError, UnicodeError):
+        raise InvalidCursor(token)
+
+
+def encode_cursor(row):
+    return encode_token([row.due_date.isoformat(), row.task_id])
+
+
+def decode_cursor(token):
+    try:
+        due_date, task_id = decode_token(token)
+        return datetime.strptime(due_date, '%Y-%m-%d').date(), int(task_id)
+    except (ValueError, TypeError):
+        raise InvalidCursor(token)
+
+
+def keyset(query, cursor=None, per_page=10, descending=False):
+    # restrict the query to the rows after the cursor and fetch one extra row,
+    # so the caller can tell whether a next page exists without a COUNT(*)
+    if cursor:
+        due_date, task_id = decode_cursor(cursor)
+        # the plain due_date bound is what starts the index range, the OR only finishes it
+        if descending:
+            after = and_(Task.due_date <= due_date,
+                         or_(Task.due_date < due_date,
+                             and_(Task.due_date == due_date, Task.task_id < task_id)))
+        else:
+            after = and_(Task.due_date >= due_date,
+                         or_(Task.due_date > due_date,
+                             and_(Task.due_date == due_date, Task.task_id > task_id)))
+        query = query.filter(after)
+    if descending:
+        order = (Task.due_date.desc(), Task.task_id.desc())
+    else:
+        order = (Task.due_date.asc(), Task.task_id.asc())
+    return query.order_by(None).order_by(*order).limit(per_page + 1)
+
+
+def paginate(query, cursor=None, per_page=10, descending=False):
+    rows = keyset(query, cursor, per_page, descending).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        next_cursor = encode_cursor(rows[per_page - 1])
+    return Page(rows[:per_page], next_cursor)
+
+
+def page_size(requested, default, maximum):
+    # clamp a client supplied ?per_page= to [1, maximum]
+    try:
+        size = int(requested) if requested is not None else default
+    except ValueError:
+        size = default
+    return max(1, min(size, maximum))
@@ -0,0 +1,97 @@
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from project import bcrypt
+
+# password hashing for the users blueprint.
+# the bcrypt cost comes from BCRYPT_LOG_ROUNDS at call time, so a changed setting applies to
+# new hashes right away and old hashes are upgraded on the next successful login.
+# with BCRYPT_HASH_WORKERS > 0 hashing runs on a bounded thread pool: bcrypt releases the GIL,
+# so under threaded workers (gunicorn --threads) a burst of logins is capped at that many cores
+# while the other request threads keep going. once BCRYPT_HASH_BACKLOG more requests are
+# waiting, further logins fail fast with HashingBusy instead of piling up.
+# under gevent workers (the Procfile) threading is monkey-patched: a ThreadPoolExecutor would
+# run bcrypt on greenlets, and so would hashing inline, blocking every other request of the
+# worker. there hashing always goes to the real threads of the gevent hub's threadpool,
+# BCRYPT_HASH_WORKERS of them (at least one).
+
+
+class HashingBusy(Exception):
+    pass
+
+
+_lock = threading.Lock()
+_pool = None
+_slots = None
+
+
+def _gevent_threadpool():
+    # the threadpool of the gevent hub when threading is monkey-patched, else None
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is None or not monkey.is_module_patched('threading'):
+        return None
+    from gevent import get_hub
+    return get_hub().threadpool
+
+
+def _executor(config):
+    global _pool, _slots
+    with _lock:
+        if _pool is None:
+            workers = max(config['BCRYPT_HASH_WORKERS'], 1)
+            _pool = _gevent_threadpool()
+            if _pool is not None:
+                _pool.maxsize = workers
+            else:
+                _pool = ThreadPoolExecutor(max_workers=workers)
+            _slots = threading.BoundedSemaphore(workers + config['BCRYPT_HASH_BACKLOG'])
+    return _pool, _slots
+
+
+def shutdown():
+    # drops the pool, e.g. after BCRYPT_HASH_WORKERS was changed (the hub's threadpool stays)
+    global _pool, _slots
+    with _lock:
+        if isinstance(_pool, ThreadPoolExecutor):
+            _pool.shutdown(wait=True)
+        _pool = _slots = None
+
+
+def offload(function, *args):
+    config = current_app.config
+    if not config['BCRYPT_HASH_WORKERS'] and _gevent_threadpool() is None:
+        return function(*args)
+    pool, slots = _executor(config)
+    if not slots.acquire(timeout=config['BCRYPT_HASH_WAIT']):
+        raise HashingBusy()
+    try:
+        if isinstance(pool, ThreadPoolExecutor):
+            return pool.submit(function, *args).result()
+        return pool.apply(function, args)
+    finally:
+        slots.release()
+
+
+def hash_password(password):
+    return offload(bcrypt.generate_password_hash, password, current_app.config['BCRYPT_LOG_ROUNDS'])
+
+
+def check_password(pw_hash, password):
+    return offload(bcrypt.check_password_hash, pw_hash, password)
+
+
+def hash_rounds(pw_hash):
+    # $2b$<rounds>$<salt and hash>
+    if isinstance(pw_hash, bytes):
+        pw_hash = pw_hash.decode('ascii', 'replace')
+    try:
+        return int(pw_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def needs_rehash(pw_hash):
+    return hash_rounds(pw_hash) != current_app.config['BCRYPT_LOG_ROUNDS']
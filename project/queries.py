@@ -0,0 +1,160 @@
+from collections import Counter
+
+from sqlalchemy.orm import joinedload
+
+from project import db, changes, journal, summary
+from project.models import Task
+
+# shared query layer for the blueprints.
+# task listings always load the poster (models.User, through the backref 'poster') in the
+# same SELECT with a LEFT OUTER JOIN, otherwise tasks.html fires one extra query per row
+# for {{ task.poster.name }}.
+# http://docs.sqlalchemy.org/en/latest/orm/loading_relationships.html#joined-eager-loading
+
+def tasks_with_posters():
+    return db.session.query(Task).options(joinedload('poster'))
+
+def open_tasks():
+    return tasks_with_posters().filter_by(status='1').order_by(Task.due_date.asc())
+
+def closed_tasks():
+    return tasks_with_posters().filter_by(status='0').order_by(Task.due_date.asc())
+
+# single-task mutations: the ownership check is part of the UPDATE/DELETE itself
+# (WHERE task_id = ? AND user_id = ?, the user_id condition is dropped for admins),
+# so there is one round trip and no window between the check and the write.
+# only when nothing matched do we look up the task to tell why.
+# the change is added to project/journal.py in the same transaction, and after the commit
+# the cached counts in project/summary.py are updated, both for the owners of the changed
+# tasks (for admins, who change other users' tasks, the owner is read first).
+DONE, FORBIDDEN, NOT_FOUND = 'done', 'forbidden', 'not_found'
+
+def _one(task_id, user_id, is_admin):
+    query = db.session.query(Task).filter(Task.task_id == task_id)
+    if not is_admin:
+        query = query.filter(Task.user_id == user_id)
+    return query
+
+def _owner(task_id, user_id, is_admin):
+    if not is_admin:
+        return user_id
+    return db.session.query(Task.user_id).filter(Task.task_id == task_id).scalar()
+
+def _explain_miss(task_id, user_id, is_admin):
+    task = db.session.query(Task.user_id).filter(Task.task_id == task_id).first()
+    db.session.rollback()
+    if task is None:
+        return NOT_FOUND
+    if not is_admin and task.user_id != user_id:
+        return FORBIDDEN
+    # matched ownership but not the status condition: already completed
+    return DONE
+
+def complete_task(task_id, user_id, is_admin):
+    owner = _owner(task_id, user_id, is_admin)
+    query = _one(task_id, user_id, is_admin).filter(Task.status == 1)
+    if not query.update({'status': '0'}, synchronize_session=False):
+        return _explain_miss(task_id, user_id, is_admin)
+    changes.bump([owner])
+    journal.record('completed', [task_id], owner)
+    db.session.commit()
+    summary.tasks_completed(owner)
+    return DONE
+
+def delete_task(task_id, user_id, is_admin):
+    owner = _owner(task_id, user_id, is_admin)
+    if not _one(task_id, user_id, is_admin).delete(synchronize_session=False):
+        return _explain_miss(task_id, user_id, is_admin)
+    changes.bump([owner])
+    journal.record('deleted', [task_id], owner)
+    db.session.commit()
+    summary.refresh(owner)
+    return DONE
+
+# set-based mutations for batches of tasks.
+# a batch is one transaction: one executemany INSERT, or one ownership SELECT followed by
+# one UPDATE/DELETE ... WHERE task_id IN (...), whatever the number of tasks in it.
+
+def create_tasks(rows):
+    # rows: dicts with the Task column names as keys
+    counts = Counter(row['user_id'] for row in rows)
+    if rows:
+        db.session.execute(Task.__table__.insert(), rows)
+        changes.bump(counts)
+        for user_id, count in counts.items():
+            # executemany does not return the new ids
+            journal.record('created', None, user_id, count)
+    db.session.commit()
+    for user_id, count in counts.items():
+        summary.tasks_added(user_id, count)
+    return len(rows)
+
+def partition_by_owner(task_ids, user_id, is_admin):
+    # one query for the whole batch instead of one per task.
+    # also returns the (owner, status) of the allowed tasks, by task id. on server databases
+    # the rows stay locked until the commit (FOR UPDATE), so the statuses read here are the
+    # ones the batch changes; sqlite ignores it, see complete_tasks
+    found = dict(
+        (row.task_id, row) for row in
+        db.session.query(Task.task_id, Task.user_id, Task.status).
+        filter(Task.task_id.in_(task_ids)).with_for_update()
+    )
+    allowed, forbidden, not_found, owners = [], [], [], {}
+    for task_id in task_ids:
+        if task_id not in found:
+            not_found.append(task_id)
+        elif is_admin or found[task_id].user_id == user_id:
+            allowed.append(task_id)
+            owners[task_id] = (found[task_id].user_id, found[task_id].status)
+        else:
+            forbidden.append(task_id)
+    return allowed, forbidden, not_found, owners
+
+def _owned(task_ids, user_id, is_admin):
+    query = db.session.query(Task).filter(Task.task_id.in_(task_ids))
+    if not is_admin:
+        # repeated in the statement itself so a concurrent change of owner cannot slip through
+        query = query.filter(Task.user_id == user_id)
+    return query
+
+def _by_owner(task_ids, owners):
+    by_owner = {}
+    for task_id in task_ids:
+        by_owner.setdefault(owners[task_id][0], []).append(task_id)
+    return by_owner
+
+def complete_tasks(task_ids, user_id, is_admin):
+    allowed, forbidden, not_found, owners = partition_by_owner(task_ids, user_id, is_admin)
+    # only the open ones change
+    open_ids = [task_id for task_id in allowed if owners[task_id][1] == 1]
+    opened = _by_owner(open_ids, owners)
+    completed = 0
+    if open_ids:
+        completed = _owned(open_ids, user_id, is_admin).filter(Task.status == 1).\
+            update({'status': '0'}, synchronize_session=False)
+        changes.bump(opened)
+        for owner, ids in opened.items():
+            journal.record('completed', ids, owner)
+    db.session.commit()
+    if completed == len(open_ids):
+        for owner, ids in opened.items():
+            summary.tasks_completed(owner, len(ids))
+    else:
+        # sqlite does not lock what the SELECT read: another writer completed some of them
+        # in between. the feed has those twice, which is harmless; the owners are counted again
+        for owner in opened:
+            summary.refresh(owner)
+    return allowed, forbidden, not_found
+
+def delete_tasks(task_ids, user_id, is_admin):
+    allowed, forbidden, not_found, owners = partition_by_owner(task_ids, user_id, is_admin)
+    deleted = _by_owner(allowed, owners)
+    if allowed:
+        _owned(allowed, user_id, is_admin).delete(synchronize_session=False)
+        changes.bump(deleted)
+        for owner, ids in deleted.items():
+            journal.record('deleted', ids, owner)
+    db.session.commit()
+    for owner in deleted:
+        summary.refresh(owner)
+    return allowed, forbidden, not_found
@@ -0,0 +1,161 @@
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, exists, func, or_, select
+
+from project import db
+from project.models import Reminder, ReminderMark, Task
+
+# due date reminders, written by the scheduler process (scheduler.py) into the reminders
+# outbox: 'due_soon' for open tasks due within REMINDER_LEAD_DAYS, 'overdue' for open tasks
+# whose due date has passed (by at most REMINDER_LOOKBACK_DAYS).
+# a pass does not rescan the tasks. each kind keeps a mark in reminder_marks:
+# - the (due_date, task_id) of the last task it scanned. the next pass carries on after it,
+#   a range scan of ix_tasks_status_due_date in keyset order, REMINDER_BATCH_SIZE rows at a time;
+# - the highest task_id it has seen. tasks added since then with a due date the scan has
+#   already passed are caught up by a primary key range scan that only reads the new rows.
+#   server databases hand out ids before commit, so a task can commit after one with a
+#   higher id that the mark already went past: the range starts REMINDER_CATCH_UP_MARGIN ids
+#   below the mark, and the tasks in it that already have their reminder are skipped.
+# every batch is one transaction with its reminders and the new mark, so a scheduler that
+# stops halfway resumes after the last batch it committed. (task_id, kind) is unique: a
+# task gets each reminder once.
+
+DUE_SOON, OVERDUE = 'due_soon', 'overdue'
+
+_tasks = Task.__table__
+_reminders = Reminder.__table__
+_marks = ReminderMark.__table__
+
+
+def windows(today, lead_days, lookback_days):
+    # first and last due date of the open tasks each kind reminds of
+    return {
+        DUE_SOON: (today, today + timedelta(days=lead_days)),
+        OVERDUE: (today - timedelta(days=lookback_days), today - timedelta(days=1)),
+    }
+
+
+def _load_mark(kind, first):
+    row = db.session.execute(select([_marks]).where(_marks.c.kind == kind)).first()
+    if row is not None:
+        return {'due_date': row.due_date, 'task_id': row.task_id, 'max_task_id': row.max_task_id}
+    # first pass: the scan starts at the beginning of the window, the tasks there now are its job
+    max_task_id = db.session.execute(select([func.max(_tasks.c.task_id)])).scalar() or 0
+    mark = {'due_date': first, 'task_id': 0, 'max_task_id': max_task_id}
+    db.session.execute(_marks.insert().values(kind=kind, updated=datetime.utcnow(), **mark))
+    db.session.commit()
+    return mark
+
+
+def _save_mark(kind, mark):
+    db.session.execute(_marks.update().where(_marks.c.kind == kind).values(updated=datetime.utcnow(), **mark))
+
+
+def _remind(kind, rows):
+    # reminders for the rows (task_id, user_id, due_date) that do not have one yet
+    if not rows:
+        return 0
+    existing = set(row.task_id for row in db.session.execute(
+        select([_reminders.c.task_id]).
+        where(and_(_reminders.c.kind == kind, _reminders.c.task_id.in_([row.task_id for row in rows])))
+    ))
+    now = datetime.utcnow()
+    new = [{'task_id': row.task_id, 'user_id': row.user_id, 'kind': kind, 'due_date': row.due_date,
+            'created': now} for row in rows if row.task_id not in existing]
+    if new:
+        db.session.execute(_reminders.insert(), new)
+    return len(new)
+
+
+def scan_query(first, last, mark, batch_size):
+    # open tasks of the window after the mark, in (due_date, task_id) order
+    return select([_tasks.c.task_id, _tasks.c.user_id, _tasks.c.due_date]).\
+        where(and_(_tasks.c.status == 1,
+                   # the start of the index range, the condition below only finishes it
+                   _tasks.c.due_date >= max(first, mark['due_date']),
+                   _tasks.c.due_date <= last,
+                   or_(_tasks.c.due_date > mark['due_date'],
+                       and_(_tasks.c.due_date == mark['due_date'], _tasks.c.task_id > mark['task_id'])))).\
+        order_by(_tasks.c.due_date, _tasks.c.task_id).limit(batch_size)
+
+
+def _scan(kind, first, last, mark, batch_size):
+    count = 0
+    while True:
+        rows = db.session.execute(scan_query(first, last, mark, batch_size)).fetchall()
+        if not rows:
+            return count
+        count += _remind(kind, rows)
+        mark.update(due_date=rows[-1].due_date, task_id=rows[-1].task_id)
+        _save_mark(kind, mark)
+        db.session.commit()
+        if len(rows) < batch_size:
+            return count
+
+
+def _catch_up(kind, first, last, mark, batch_size, margin):
+    # tasks added since the last pass that are due in the window, but before the mark
+    count = 0
+    after = max(mark['max_task_id'] - margin, 0)
+    while True:
+        rows = db.session.execute(
+            select([_tasks.c.task_id, _tasks.c.user_id, _tasks.c.due_date, _tasks.c.status]).
+            where(_tasks.c.task_id > after).
+            order_by(_tasks.c.task_id).limit(batch_size)
+        ).fetchall()
+        if not rows:
+            return count
+        behind = [row for row in rows
+                  if row.status == 1 and first <= row.due_date <= last
+                  and (row.due_date, row.task_id) <= (mark['due_date'], mark['task_id'])]
+        count += _remind(kind, behind)
+        after = rows[-1].task_id
+        mark['max_task_id'] = max(mark['max_task_id'], after)
+        _save_mark(kind, mark)
+        db.session.commit()
+        if len(rows) < batch_size:
+            return count
+
+
+def tick(today=None):
+    # one pass over both kinds; the number of reminders written, by kind.
+    # today is a UTC date, like the marks and posted_date, whatever the timezone of the server
+    config = current_app.config
+    today = today or datetime.utcnow().date()
+    counts = {}
+    for kind, (first, last) in sorted(windows(today, config['REMINDER_LEAD_DAYS'],
+                                              config['REMINDER_LOOKBACK_DAYS']).items()):
+        mark = _load_mark(kind, first)
+        counts[kind] = _catch_up(kind, first, last, mark, config['REMINDER_BATCH_SIZE'],
+                                 config['REMINDER_CATCH_UP_MARGIN']) + \
+            _scan(kind, first, last, mark, config['REMINDER_BATCH_SIZE'])
+    drop_stale()
+    return counts
+
+
+# the outbox side: whatever delivers the reminders (mail, push...) reads the unsent ones
+# oldest first from ix_reminders_sent and marks them sent.
+# a task can be completed or deleted after its reminder was written: pending() leaves those
+# reminders out, and every pass of the scheduler deletes them (drop_stale())
+
+def _task_open():
+    return exists().where(and_(_tasks.c.task_id == _reminders.c.task_id, _tasks.c.status == 1))
+
+
+def pending(limit=100):
+    return db.session.query(Reminder).filter(Reminder.sent.is_(None), _task_open()).\
+        order_by(Reminder.id).limit(limit).all()
+
+
+def drop_stale():
+    # unsent reminders of tasks that are no longer open; a primary key lookup per reminder
+    db.session.execute(_reminders.delete().where(and_(_reminders.c.sent.is_(None), ~_task_open())))
+    db.session.commit()
+
+
+def mark_sent(reminder_ids):
+    if reminder_ids:
+        db.session.query(Reminder).filter(Reminder.id.in_(reminder_ids)).\
+            update({'sent': datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
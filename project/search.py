@@ -0,0 +1,122 @@
+import re
+
+from flask import current_app
+from sqlalchemy import Float, Integer, and_, event, literal_column, or_, select, text
+
+from project import db
+from project.models import Task
+from project.pagination import Page, InvalidCursor, encode_token, decode_token
+from project.serializers import task_rows
+
+# full-text search over task names.
+# on sqlite the names are indexed in an FTS5 table (tasks_fts) that only stores the index and
+# reads the text from tasks (external content). triggers on tasks keep it in sync with every
+# INSERT, DELETE and UPDATE of name, including the Core statements of the bulk helpers.
+# a search is a lookup in that index, ranked with bm25 (best first). every word of the query
+# is matched as a prefix of a word of the name: "gro sho" finds "Go grocery shopping".
+# other databases, and sqlite builds without FTS5, fall back to LIKE, without ranking.
+# bm25 depends on statistics of the whole table, so every insert or delete moves the ranks
+# of all matches and a (rank, task_id) cursor would skip or repeat rows. the first page
+# takes the ids of the best SEARCH_MAX_RESULTS matches instead, and the cursor carries the
+# rest of them in that order: later pages are primary key lookups of a fixed list. tasks
+# added after the first page are not in it, deleted ones drop out.
+# https://www.sqlite.org/fts5.html#external_content_tables
+
+SEARCH_DDL = [
+    # prefix indexes make "word*" queries of 2 and 3 characters index lookups as well
+    "CREATE VIRTUAL TABLE tasks_fts USING fts5(name, content='tasks', content_rowid='task_id', prefix='2 3')",
+    "CREATE TRIGGER tasks_fts_insert AFTER INSERT ON tasks BEGIN "
+    "INSERT INTO tasks_fts (rowid, name) VALUES (new.task_id, new.name); END",
+    "CREATE TRIGGER tasks_fts_delete AFTER DELETE ON tasks BEGIN "
+    "INSERT INTO tasks_fts (tasks_fts, rowid, name) VALUES ('delete', old.task_id, old.name); END",
+    "CREATE TRIGGER tasks_fts_update AFTER UPDATE OF name ON tasks BEGIN "
+    "INSERT INTO tasks_fts (tasks_fts, rowid, name) VALUES ('delete', old.task_id, old.name); "
+    "INSERT INTO tasks_fts (rowid, name) VALUES (new.task_id, new.name); END",
+    # index the rows that were there before
+    "INSERT INTO tasks_fts (tasks_fts) VALUES ('rebuild')"
+]
+
+
+# whether the sqlite library has FTS5, the same for every connection of the process
+_fts5 = {}
+
+
+def fts5_available(connection):
+    if 'available' not in _fts5:
+        _fts5['available'] = bool(connection.execute(
+            "SELECT sqlite_compileoption_used('ENABLE_FTS5')").scalar())
+    return _fts5['available']
+
+
+def install(connection):
+    # creates the index on a sqlite database that does not have it yet; True when it did
+    if connection.dialect.name != 'sqlite' or not fts5_available(connection):
+        return False
+    if connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'tasks_fts'").first():
+        return False
+    for statement in SEARCH_DDL:
+        connection.execute(statement)
+    return True
+
+
+@event.listens_for(Task.__table__, 'after_create')
+def _create_index(target, connection, **kw):
+    install(connection)
+
+
+@event.listens_for(Task.__table__, 'before_drop')
+def _drop_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute('DROP TABLE IF EXISTS tasks_fts')
+
+
+def words(q):
+    return re.findall(r'\w+', q or '', re.UNICODE)
+
+
+def _like_prefix(term):
+    # a LIKE pattern for the term at the start of the name or of a later word, with the
+    # wildcards of LIKE (% and _) in the term taken literally
+    term = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return or_(Task.name.ilike(term + '%', escape='\\'), Task.name.ilike('% ' + term + '%', escape='\\'))
+
+
+def _matches(terms):
+    # (task_id, rank) of the matching tasks, lower rank is better
+    bind = db.session.get_bind()
+    if bind.dialect.name == 'sqlite' and fts5_available(bind):
+        # quoted, so words like AND/OR/NOT are not taken as operators
+        match = ' '.join('"{}"*'.format(term) for term in terms)
+        return text(
+            'SELECT rowid AS task_id, rank FROM tasks_fts WHERE tasks_fts MATCH :match'
+        ).columns(task_id=Integer, rank=Float).bindparams(match=match).alias('matches')
+    return select([Task.task_id.label('task_id'), literal_column('0.0', Float).label('rank')]).\
+        where(and_(*[_like_prefix(term) for term in terms])).alias('matches')
+
+
+def _ranked_ids(terms):
+    matches = _matches(terms)
+    return [row.task_id for row in db.session.execute(
+        select([matches.c.task_id]).order_by(matches.c.rank, matches.c.task_id).
+        limit(current_app.config['SEARCH_MAX_RESULTS'])
+    )]
+
+
+def _decode(cursor):
+    ids = decode_token(cursor)
+    if not isinstance(ids, list) or not ids or not all(isinstance(task_id, int) for task_id in ids):
+        raise InvalidCursor(cursor)
+    return ids
+
+
+def search(q, cursor=None, per_page=10):
+    # a Page of task_rows(), best match first; an empty page when q has no words
+    terms = words(q)
+    if not terms:
+        return Page([], None)
+    ids = _decode(cursor) if cursor else _ranked_ids(terms)
+    ids, rest = ids[:per_page], ids[per_page:]
+    rows = task_rows().filter(Task.task_id.in_(ids)).all() if ids else []
+    position = dict((task_id, index) for index, task_id in enumerate(ids))
+    rows.sort(key=lambda row: position[row.task_id])
+    return Page(rows, encode_token(rest) if rest else None)
@@ -0,0 +1,59 @@
+import json
+
+from flask import current_app
+
+from project import db
+from project.models import Task
+
+# the one JSON representation of a task, shared by the API routes.
+# read-only API calls select plain columns (no ORM instances, identity map or change
+# tracking) and the dicts are encoded compactly, without indentation or sorted keys.
+# a faster encoder is used when one is installed (pip install orjson / ujson).
+
+try:
+    import orjson
+    ENCODER = 'orjson'
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+except ImportError:
+    try:
+        import ujson
+        ENCODER = 'ujson'
+
+        def dumps(obj):
+            return ujson.dumps(obj, ensure_ascii=False)
+    except ImportError:
+        ENCODER = 'json'
+        dumps = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False).encode
+
+TASK_COLUMNS = (
+    Task.task_id, Task.name, Task.due_date, Task.priority, Task.posted_date, Task.status, Task.user_id
+)
+
+
+def task_rows():
+    return db.session.query(*TASK_COLUMNS)
+
+
+# the keys of a task, in the order of task_values(): JSON objects and the CSV export header
+TASK_KEYS = ('task_id', 'task name', 'due date', 'priority', 'posted date', 'status', 'user id')
+
+
+def _iso(value):
+    # missing dates stay None: null in JSON, an empty field in CSV
+    return None if value is None else value.isoformat()
+
+
+def task_values(row):
+    # works for rows of task_rows() and for Task instances alike
+    return (row.task_id, row.name, _iso(row.due_date), row.priority, _iso(row.posted_date),
+            row.status, row.user_id)
+
+
+def task_to_dict(row):
+    return dict(zip(TASK_KEYS, task_values(row)))
+
+
+def json_response(obj, status=200):
+    return current_app.response_class(dumps(obj), status=status, mimetype='application/json')
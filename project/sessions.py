@@ -0,0 +1,373 @@
+import binascii
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, session
+from flask.sessions import SessionInterface, SessionMixin
+from sqlalchemy import and_, select
+from werkzeug.datastructures import CallbackDict
+
+from project.models import EndedSession, StoredSession
+
+# server-side sessions: the cookie only carries an opaque random session id, the data lives
+# in a store: DatabaseSessionStore (the app database, shared by every worker and dyno),
+# SQLiteSessionStore (a file, shared by the workers of one host) or MemorySessionStore (tests
+# and single process runs). SESSION_STORE = 'cookie' keeps Flask's signed cookie sessions.
+# an in-process LRU cache in front of the store answers most requests without touching it;
+# its entries live SESSION_CACHE_TTL seconds. sessions ended by a logout (everywhere) are
+# logged by the shared stores, and every SESSION_ENDED_POLL seconds each worker drops the
+# ones ended lately from its cache, so they stop working in other workers within that time.
+# sessions expire SESSION_TTL seconds after their last use.
+
+# ended sessions older than this are left out of the poll (their cache entries are gone,
+# give or take the clock difference between hosts) and purged after ENDED_KEEP seconds
+ENDED_MARGIN = 5
+ENDED_KEEP = 3600
+
+
+def new_sid():
+    return binascii.hexlify(os.urandom(20)).decode('ascii')
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid or new_sid()
+        self.new = new
+        self.modified = False
+
+
+class MemorySessionStore(object):
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            found = self._sessions.get(sid)
+        if found is None or found[2] <= time.time():
+            return None
+        return found[0], found[2]
+
+    def set(self, sid, data, user_id, expires):
+        with self._lock:
+            self._sessions[sid] = (data, user_id, expires)
+
+    def touch(self, sid, expires):
+        with self._lock:
+            if sid in self._sessions:
+                data, user_id, _ = self._sessions[sid]
+                self._sessions[sid] = (data, user_id, expires)
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def delete_user(self, user_id):
+        with self._lock:
+            sids = [sid for sid, found in self._sessions.items() if found[1] == user_id]
+            for sid in sids:
+                del self._sessions[sid]
+        return sids
+
+    def purge(self):
+        now = time.time()
+        with self._lock:
+            for sid in [sid for sid, found in self._sessions.items() if found[2] <= now]:
+                del self._sessions[sid]
+
+
+class SQLiteSessionStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS sessions '
+                '(sid TEXT PRIMARY KEY, user_id INTEGER, data TEXT NOT NULL, expires REAL NOT NULL)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_sessions_user_id ON sessions (user_id)')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_sessions_expires ON sessions (expires)')
+            connection.execute('CREATE TABLE IF NOT EXISTS ended_sessions (sid TEXT NOT NULL, ended REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_ended_sessions_ended ON ended_sessions (ended)')
+
+    def _connection(self):
+        # one connection per thread (and per process, connections must not cross a fork)
+        if getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return self._local.connection
+
+    def get(self, sid):
+        return self._connection().execute(
+            'SELECT data, expires FROM sessions WHERE sid = ? AND expires > ?', (sid, time.time())
+        ).fetchone()
+
+    def set(self, sid, data, user_id, expires):
+        with self._connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO sessions (sid, user_id, data, expires) VALUES (?, ?, ?, ?)',
+                (sid, user_id, data, expires)
+            )
+
+    def touch(self, sid, expires):
+        with self._connection() as connection:
+            connection.execute('UPDATE sessions SET expires = ? WHERE sid = ?', (expires, sid))
+
+    def delete(self, sid):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+            connection.execute('INSERT INTO ended_sessions (sid, ended) VALUES (?, ?)', (sid, time.time()))
+
+    def delete_user(self, user_id):
+        with self._connection() as connection:
+            sids = [row[0] for row in connection.execute(
+                'SELECT sid FROM sessions WHERE user_id = ?', (user_id,)
+            )]
+            connection.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+            now = time.time()
+            connection.executemany('INSERT INTO ended_sessions (sid, ended) VALUES (?, ?)',
+                                   [(sid, now) for sid in sids])
+        return sids
+
+    def ended_since(self, since):
+        return [row[0] for row in self._connection().execute(
+            'SELECT sid FROM ended_sessions WHERE ended > ?', (since,)
+        )]
+
+    def purge(self):
+        now = time.time()
+        with self._connection() as connection:
+            connection.execute('DELETE FROM sessions WHERE expires <= ?', (now,))
+            connection.execute('DELETE FROM ended_sessions WHERE ended <= ?', (now - ENDED_KEEP,))
+
+
+class DatabaseSessionStore(object):
+    # the sessions and ended_sessions tables of the app database (project/models.py), on
+    # connections of their own: sessions are saved after the request is done with db.session
+
+    _sessions = StoredSession.__table__
+    _ended = EndedSession.__table__
+
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, sid):
+        return self.db.engine.execute(
+            select([self._sessions.c.data, self._sessions.c.expires]).
+            where(and_(self._sessions.c.sid == sid, self._sessions.c.expires > time.time()))
+        ).first()
+
+    def set(self, sid, data, user_id, expires):
+        values = {'data': data, 'user_id': user_id, 'expires': expires}
+        with self.db.engine.begin() as connection:
+            if not connection.execute(
+                self._sessions.update().where(self._sessions.c.sid == sid).values(**values)
+            ).rowcount:
+                connection.execute(self._sessions.insert().values(sid=sid, **values))
+
+    def touch(self, sid, expires):
+        with self.db.engine.begin() as connection:
+            connection.execute(self._sessions.update().where(self._sessions.c.sid == sid).values(expires=expires))
+
+    def _end(self, connection, sids):
+        if sids:
+            now = time.time()
+            connection.execute(self._ended.insert(), [{'sid': sid, 'ended': now} for sid in sids])
+
+    def delete(self, sid):
+        with self.db.engine.begin() as connection:
+            connection.execute(self._sessions.delete().where(self._sessions.c.sid == sid))
+            self._end(connection, [sid])
+
+    def delete_user(self, user_id):
+        with self.db.engine.begin() as connection:
+            sids = [row.sid for row in connection.execute(
+                select([self._sessions.c.sid]).where(self._sessions.c.user_id == user_id)
+            )]
+            connection.execute(self._sessions.delete().where(self._sessions.c.user_id == user_id))
+            self._end(connection, sids)
+        return sids
+
+    def ended_since(self, since):
+        return [row.sid for row in self.db.engine.execute(
+            select([self._ended.c.sid]).where(self._ended.c.ended > since)
+        )]
+
+    def purge(self):
+        now = time.time()
+        with self.db.engine.begin() as connection:
+            connection.execute(self._sessions.delete().where(self._sessions.c.expires <= now))
+            connection.execute(self._ended.delete().where(self._ended.c.ended <= now - ENDED_KEEP))
+
+
+class LRUCache(object):
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class ServerSideSessionInterface(SessionInterface):
+
+    session_class = ServerSideSession
+
+    def __init__(self, store, ttl, cache_size=1024, cache_ttl=5, ended_poll=1):
+        self.store = store
+        self.ttl = ttl
+        self.cache = LRUCache(cache_size, cache_ttl)
+        self.ended_poll = ended_poll
+        self._ended_checked = 0
+        self._ended_lock = threading.Lock()
+        self._saves = 0
+
+    def _drop_ended(self):
+        # sessions ended in other workers leave the cache; the memory store has no others
+        if not hasattr(self.store, 'ended_since') or time.time() - self._ended_checked < self.ended_poll:
+            return
+        if not self._ended_lock.acquire(False):
+            return      # another thread is on it
+        try:
+            checked = time.time()
+            for sid in self.store.ended_since(checked - self.cache.ttl - ENDED_MARGIN):
+                self.cache.discard(sid)
+            self._ended_checked = checked
+        finally:
+            self._ended_lock.release()
+
+    def _load(self, sid):
+        # (json data, expires) from the cache or the store
+        self._drop_ended()
+        found = self.cache.get(sid)
+        if found is None:
+            found = self.store.get(sid)
+            if found is not None:
+                found = tuple(found)
+                self.cache.set(sid, found)
+        return found
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid:
+            found = self._load(sid)
+            if found is not None:
+                session = self.session_class(json.loads(found[0]), sid)
+                session.expires = found[1]
+                return session
+        return self.session_class(new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if not session.new:
+                self.forget(session.sid)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+        now = time.time()
+        expires = now + self.ttl
+        if session.modified or session.new:
+            data = json.dumps(dict(session))
+            self.store.set(session.sid, data, session.get('user_id'), expires)
+            self.cache.set(session.sid, (data, expires))
+            self._purge_now_and_then()
+        elif getattr(session, 'expires', expires) - now < self.ttl / 2:
+            # sliding expiry, but at most one write per half lifetime
+            self.store.touch(session.sid, expires)
+            self.cache.discard(session.sid)
+        if session.new:
+            response.set_cookie(
+                app.session_cookie_name, session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain, path=path, secure=self.get_cookie_secure(app)
+            )
+
+    def _purge_now_and_then(self):
+        self._saves += 1
+        if self._saves % 1000 == 0:
+            self.store.purge()
+
+    def forget(self, sid):
+        self.store.delete(sid)
+        self.cache.discard(sid)
+
+    def regenerate(self, session):
+        # same data under a new id; the old id stops working
+        self.forget(session.sid)
+        session.sid = new_sid()
+        session.new = True
+
+    def end_user_sessions(self, user_id):
+        for sid in self.store.delete_user(user_id):
+            self.cache.discard(sid)
+
+
+def init_app(app):
+    config = app.config
+    if config['SESSION_STORE'] == 'cookie':
+        return
+    if config['SESSION_STORE'] == 'memory':
+        store = MemorySessionStore()
+    elif config['SESSION_STORE'] == 'sqlite':
+        store = SQLiteSessionStore(config['SESSION_DB_PATH'])
+    else:
+        from project import db
+        store = DatabaseSessionStore(db)
+    app.session_interface = ServerSideSessionInterface(
+        store, config['SESSION_TTL'], config['SESSION_CACHE_SIZE'], config['SESSION_CACHE_TTL'],
+        config['SESSION_ENDED_POLL']
+    )
+
+
+# helpers for the users blueprint; no-ops with cookie sessions
+
+def regenerate():
+    interface = current_app.session_interface
+    if isinstance(interface, ServerSideSessionInterface):
+        interface.regenerate(session)
+
+
+def end_user_sessions(user_id):
+    interface = current_app.session_interface
+    if isinstance(interface, ServerSideSessionInterface):
+        interface.end_user_sessions(user_id)
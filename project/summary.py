@@ -0,0 +1,137 @@
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import func
+
+from project import db
+from project.models import Task
+
+# per-user open/closed task counts for dashboards.
+# loaded once with a single GROUP BY user_id, status (answered from the (user_id, status)
+# index, without reading the tasks table), then kept current by the mutation helpers in
+# project/queries.py and by new_task. SUMMARY_CACHE_TTL bounds how stale the counts can get
+# through writes made by other processes.
+# one thread at a time loads (_load_lock), the others wait for its result. a write that
+# commits while a count query runs may or may not be in the result, so the users whose
+# counts were adjusted meanwhile are counted again afterwards instead of being lost.
+
+_lock = threading.Lock()
+_load_lock = threading.Lock()
+_counts = {}
+_loaded_at = None
+# one set per running count query, collecting the users adjusted while it runs
+_watching = []
+
+
+def _empty():
+    return {'open': 0, 'closed': 0}
+
+
+def _add(counts, status, count):
+    # status is 1 for open, 0 for closed
+    counts['open' if status == 1 else 'closed'] += count
+
+
+def count_query(user_id=None):
+    # (user_id, status, count) rows of everyone, or of one user
+    query = db.session.query(Task.user_id, Task.status, func.count())
+    if user_id is not None:
+        query = query.filter(Task.user_id == user_id)
+    return query.group_by(Task.user_id, Task.status)
+
+
+def _recount(user_id, store):
+    # runs count_query(user_id) and hands the counts to store() under _lock;
+    # returns the users adjusted while the query ran. a query that fails stores nothing:
+    # the cache stays as it was (not loaded, or stale) and the error goes to the caller
+    changed = set()
+    with _lock:
+        _watching.append(changed)
+    try:
+        counts = {}
+        for row_user_id, status, count in count_query(user_id):
+            _add(counts.setdefault(row_user_id, _empty()), status, count)
+        with _lock:
+            store(counts)
+    finally:
+        with _lock:
+            _watching.remove(changed)
+    return changed
+
+
+def _store_all(counts):
+    global _counts, _loaded_at
+    _counts, _loaded_at = counts, time.time()
+
+
+def _fresh():
+    with _lock:
+        return _loaded_at is not None and time.time() - _loaded_at < current_app.config['SUMMARY_CACHE_TTL']
+
+
+def _ensure_loaded():
+    if _fresh():
+        return
+    with _load_lock:
+        # loaded by another thread while this one waited
+        if _fresh():
+            return
+        for user_id in _recount(None, _store_all):
+            refresh(user_id)
+
+
+def counts_for(user_id):
+    _ensure_loaded()
+    with _lock:
+        return dict(_counts.get(user_id, _empty()))
+
+
+def totals():
+    _ensure_loaded()
+    total = _empty()
+    with _lock:
+        for counts in _counts.values():
+            total['open'] += counts['open']
+            total['closed'] += counts['closed']
+    return total
+
+
+def _adjust(user_id, opened=0, closed=0):
+    with _lock:
+        for changed in _watching:
+            changed.add(user_id)
+        # nothing to keep current until the first dashboard asks for counts
+        if _loaded_at is None:
+            return
+        counts = _counts.setdefault(user_id, _empty())
+        counts['open'] += opened
+        counts['closed'] += closed
+
+
+def tasks_added(user_id, count=1):
+    _adjust(user_id, opened=count)
+
+
+def tasks_completed(user_id, count=1):
+    _adjust(user_id, opened=-count, closed=count)
+
+
+def refresh(user_id):
+    # recount one user, e.g. after deletes where the status of the deleted rows is unknown
+    with _lock:
+        if _loaded_at is None:
+            return
+    def store(counts):
+        _counts[user_id] = counts.get(user_id, _empty())
+    # adjusted again while counting: count once more (a few times at most, the TTL does the rest)
+    for attempt in range(3):
+        if user_id not in _recount(user_id, store):
+            return
+
+
+def invalidate():
+    # the next read reloads everything (tests, or after changes made outside the helpers)
+    global _counts, _loaded_at
+    with _lock:
+        _counts, _loaded_at = {}, None
@@ -1,38 +1,54 @@
 import datetime
-from functools import wraps
-from flask import flash, redirect, render_template, request, session, url_for, Blueprint
+from flask import flash, redirect, render_template, request, url_for, Blueprint, current_app, abort
 from .forms import AddTaskForm
-from project import db
+from project import db, changes, journal, search, summary
+from project.auth import login_required, current_user
 from project.models import Task
+from project.pagination import paginate, InvalidCursor
+from project.queries import open_tasks, closed_tasks, complete_task, delete_task, DONE, FORBIDDEN
 
 tasks_blueprint = Blueprint('tasks', __name__)
 
-def login_required(test):
-    @wraps(test)
-    def wrap(*args, **kwargs):
-        if 'logged_in' in session:
-            return test(*args, **kwargs)
+# both tables are paginated with their own cursor (?open_cursor=, ?closed_cursor=),
+# so paging through one of them keeps the other where it was.
+# closed tasks are collapsed to the most recent CLOSED_TASKS_WINDOW unless ?closed=all.
+# ?q= adds a table of search results (project/search.py), paged with ?search_cursor=
+def render_tasks(form, error=None):
+    per_page = current_app.config['TASKS_PER_PAGE']
+    show_all_closed = request.args.get('closed') == 'all'
+    q = request.args.get('q', '').strip()
+    search_page = None
+    try:
+        if q:
+            search_page = search.search(q, request.args.get('search_cursor'), per_page)
+        open_page = paginate(open_tasks(), request.args.get('open_cursor'), per_page)
+        if show_all_closed:
+            closed_page = paginate(
+                closed_tasks(), request.args.get('closed_cursor'), per_page, descending=True
+            )
         else:
-            flash('You need to login first.')
-            return redirect(url_for('users.login'))
-    return wrap
-
-def open_tasks():
-    return db.session.query(Task).filter_by(status='1').order_by(Task.due_date.asc())
-
-def closed_tasks():
-    return db.session.query(Task).filter_by(status='0').order_by(Task.due_date.asc())
+            closed_page = paginate(
+                closed_tasks(), None, current_app.config['CLOSED_TASKS_WINDOW'], descending=True
+            )
+    except InvalidCursor:
+        abort(400)
+    return render_template(
+        'tasks.html',
+        form=form,
+        error=error,
+        open_page=open_page,
+        closed_page=closed_page,
+        show_all_closed=show_all_closed,
+        q=q,
+        search_page=search_page,
+        summary=summary.counts_for(current_user.id),
+        username=current_user.name
+    )
 
 @tasks_blueprint.route('/tasks/')
 @login_required
 def tasks():
-    return render_template(
-        'tasks.html',
-        form=AddTaskForm(request.form),
-        open_tasks=open_tasks(),
-        closed_tasks=closed_tasks(),
-        username=session['name']
-    )
+    return render_tasks(AddTaskForm(request.form))
 
 @tasks_blueprint.route('/add/', methods=['GET', 'POST'])
 @login_required
@@ -47,44 +63,38 @@ def new_task():
                 form.priority.data,
                 datetime.datetime.utcnow(),
                 '1',
-                session['user_id']
+                current_user.id
             )
             db.session.add(new_task)
+            db.session.flush()      # assigns new_task.task_id without a SELECT after the commit
+            changes.bump([current_user.id])
+            journal.record('created', [new_task.task_id], current_user.id)
             db.session.commit()
+            summary.tasks_added(current_user.id)
             flash('New entry was successfully posted. Thanks.')
             return redirect(url_for('tasks.tasks'))
-    return render_template(
-        'tasks.html',
-        form=form,
-        error=error,
-        open_tasks=open_tasks(),
-        closed_tasks=closed_tasks()
-    )
+    return render_tasks(form, error)
 
 @tasks_blueprint.route('/complete/<int:task_id>/')
 @login_required
 def complete(task_id):
-    new_id = task_id
-    task = db.session.query(Task).filter_by(task_id=new_id)
-    if session['user_id'] == task.first().user_id or session['role'] == 'admin':
-        task.update({"status": "0"})
-        db.session.commit()
+    result = complete_task(task_id, current_user.id, current_user.is_admin)
+    if result == DONE:
         flash('The task is complete. Nice.')
-        return redirect(url_for('tasks.tasks'))
-    else:
+    elif result == FORBIDDEN:
         flash('You can only update tasks that belong to you.')
-        return redirect(url_for('tasks.tasks'))
+    else:
+        flash('That task does not exist.')
+    return redirect(url_for('tasks.tasks'))
 
 @tasks_blueprint.route('/delete/<int:task_id>/')
 @login_required
 def delete_entry(task_id):
-    new_id = task_id
-    task = db.session.query(Task).filter_by(task_id=new_id)
-    if session['user_id'] == task.first().user_id or session['role'] == 'admin':
-        task.delete()
-        db.session.commit()
+    result = delete_task(task_id, current_user.id, current_user.is_admin)
+    if result == DONE:
         flash('The task was deleted. Why not add a new one? ')
-        return redirect(url_for('tasks.tasks'))
-    else:
+    elif result == FORBIDDEN:
         flash('You can only delete tasks that belong to you.')
-        return redirect(url_for('tasks.tasks'))
\ No newline at end of file
+    else:
+        flash('That task does not exist.')
+    return redirect(url_for('tasks.tasks'))
\ No newline at end of file
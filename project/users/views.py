@@ -1,32 +1,23 @@
-from functools import wraps
 from flask import flash, redirect, render_template, request, session, url_for, Blueprint
 from sqlalchemy.exc import IntegrityError
 from .forms import RegisterForm, LoginForm
-from project import db, bcrypt
+from project import db, sessions
+from project.auth import login_required, current_user
 from project.models import User
+from project.passwords import hash_password, check_password, needs_rehash, HashingBusy
 
 users_blueprint = Blueprint('users', __name__)
 
 
-# helper functions
-
-def login_required(test):
-    @wraps(test)
-    def wrap(*args, **kwargs):
-        if 'logged_in' in session:
-            return test(*args, **kwargs)
-        else:
-            flash('You need to login first.')
-            return redirect(url_for('users.login'))
-    return wrap
-
 @users_blueprint.route('/logout/')
 @login_required
 def logout():
+    # ?everywhere=1 also ends the user's sessions on other devices
+    if request.args.get('everywhere') == '1':
+        sessions.end_user_sessions(current_user.id)
     session.pop('logged_in', None)
     session.pop('user_id', None)
-    session.pop('role', None)
-    session.pop('name', None)
+    sessions.regenerate()     # the old session id stops working
     flash('Goodbye!')
     return redirect(url_for('users.login'))     # http://flask.pocoo.org/docs/0.10/api/#flask.redirect
                                                 # flask.redirect(location, code=302, Response=None)
@@ -38,14 +29,19 @@ def login():
     if request.method == 'POST':
         if form.validate_on_submit():
             user = User.query.filter_by(name=request.form['name']).first()
-            if user is not None and bcrypt.check_password_hash(
-                    user.password,
-                    request.form['password']
-            ):
+            try:
+                valid = user is not None and check_password(user.password, request.form['password'])
+                if valid and needs_rehash(user.password):
+                    # BCRYPT_LOG_ROUNDS changed since this hash was made
+                    user.password = hash_password(request.form['password'])
+                    db.session.commit()
+            except HashingBusy:
+                error = 'Too many logins right now. Please try again in a moment.'
+                return render_template('login.html', form=form, error=error), 503
+            if valid:
+                sessions.regenerate()
                 session['logged_in'] = True
-                session['user_id'] = user.id
-                session['role'] = user.role
-                session['name'] = user.name
+                session['user_id'] = user.id    # role and name come from project.auth.current_user
                 flash('Welcome!')
                 return redirect(url_for('tasks.tasks'))
             else:
@@ -60,11 +56,15 @@ def register():
     form = RegisterForm(request.form)
     if request.method == 'POST':
         if form.validate_on_submit():
+            try:
+                password = hash_password(form.password.data)
+            except HashingBusy:
+                error = 'Too many requests right now. Please try again in a moment.'
+                return render_template('register.html', form=form, error=error), 503
             new_user = User(
                 form.name.data,
                 form.email.data,
-                # form.password.data  # temporary addition for a test, to be removed and the next line to be uncommented
-                bcrypt.generate_password_hash(form.password.data)
+                password
             )
             try:
                 db.session.add(new_user)
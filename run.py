@@ -1,5 +1,6 @@
-from project import app
+from project import create_app
 import os
 
+app = create_app()
 port = int(os.environ.get('PORT', 5000))
 app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
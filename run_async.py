@@ -0,0 +1,16 @@
+# async entry point: one gevent process, where each open /api/v1/tasks/changes connection
+# is an idle greenlet instead of a blocked thread. run.py stays the plain development server.
+# the change journal is in the database, so any number of these can serve the feed; the
+# Procfile runs gunicorn gevent workers (WEB_CONCURRENCY of them, see gunicorn_config.py)
+from gevent import monkey
+monkey.patch_all()
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
+import os
+from gevent.pywsgi import WSGIServer
+from project import create_app
+
+app = create_app()
+port = int(os.environ.get('PORT', 5000))
+WSGIServer(('0.0.0.0', port), app).serve_forever()
@@ -0,0 +1,54 @@
+# reminder scheduler: a process of its own, next to the web server (run.py)
+#
+#   python scheduler.py              a pass every REMINDER_INTERVAL seconds
+#   python scheduler.py --once       a single pass, e.g. from cron
+#
+# a pass writes the due date reminders of project/reminders.py. how far it got is kept in the
+# database (reminder_marks), so a restarted scheduler carries on where it stopped.
+# run a single one: two would scan the same tasks (they still would not remind twice).
+# db_upgrade.py adds the reminder tables to an existing database.
+import argparse
+import sys
+import time
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from project import create_app, db, reminders
+
+
+def run_pass():
+    started = time.time()
+    try:
+        counts = reminders.tick()
+    except SQLAlchemyError as e:
+        # the batches committed so far stay, the next pass retries the rest
+        db.session.rollback()
+        print('reminder pass failed: {}'.format(e), file=sys.stderr)
+        return False
+    if any(counts.values()):
+        print('{} in {:.1f}s'.format(', '.join('{} {}'.format(count, kind) for kind, count in sorted(counts.items())),
+                                      time.time() - started), file=sys.stderr)
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write due date reminders for open tasks.')
+    parser.add_argument('--once', action='store_true', help='a single pass, then exit')
+    parser.add_argument('--interval', type=float, help='seconds between passes (default REMINDER_INTERVAL)')
+    args = parser.parse_args(argv)
+    app = create_app(blueprints=False)
+    with app.app_context():
+        if args.once:
+            return 0 if run_pass() else 1
+        interval = args.interval or app.config['REMINDER_INTERVAL']
+        try:
+            while True:
+                started = time.time()
+                run_pass()
+                time.sleep(max(0, interval - (time.time() - started)))
+        except KeyboardInterrupt:
+            return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,183 @@
+import atexit
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import contextmanager
+from functools import partial
+
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session
+
+from project import create_app, db, bcrypt, auth, summary
+from project.database import RoutingSession
+
+# shared test harness, every TestCase in tests/ derives from AppTestCase and uses app,
+# built by create_app() with TEST_CONFIG.
+#
+# the database is an in-memory sqlite one, private to the test process, and its schema is
+# created once. each test then runs inside a transaction that is rolled back when it ends:
+# db.session is bound to that transaction and every commit of the code under test only
+# releases a SAVEPOINT in it, so no test leaves rows behind and none pays for a
+# create_all()/drop_all(). tests that change the schema or use db.engine directly (a
+# statement on another connection would end the transaction) are marked @not_transactional
+# and get a freshly created schema instead; so are classes with a database_uri of their own.
+# http://docs.sqlalchemy.org/en/rel_1_1/orm/session_transaction.html#joining-a-session-into-an-external-transaction-such-as-for-test-suites
+#
+# files (error log, file databases) go to a temporary directory of the process, so the
+# suite can run in parallel, one process per core:
+#   nosetests --processes=-1
+# passwords are hashed at the lowest bcrypt cost.
+
+WORKDIR = tempfile.mkdtemp(prefix='flasktaskr-tests-')
+atexit.register(shutil.rmtree, WORKDIR, True)
+
+TEST_CONFIG = {
+    # propagate exceptions to the test client
+    # http://flask.pocoo.org/docs/0.11/api/#flask.Flask.testing
+    'TESTING': True,
+    'DEBUG': False,
+    'WTF_CSRF_ENABLED': False,
+    'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+    'BCRYPT_LOG_ROUNDS': 4,
+    'SESSION_STORE': 'memory',
+    # statement counts do not depend on timing; tests of the users version lower it
+    'IDENTITY_VERSION_POLL': 3600,
+}
+
+app = create_app(TEST_CONFIG)
+# db.session outside of requests, in the tests themselves, without an app context
+# (one pushed for the whole test would be shared by its requests, g included)
+db.app = app
+
+# statements of the harness itself, left out of recorded_statements()
+SAVEPOINT_STATEMENTS = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+# the in-memory engine the schema was created on
+_schema = {'engine': None, 'created': False}
+
+
+def worker_path(name):
+    # worker processes forked by the runner share WORKDIR, each one has a directory in it
+    directory = os.path.join(WORKDIR, str(os.getpid()))
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, name)
+
+
+def password_hash(password):
+    return bcrypt.generate_password_hash(password, app.config['BCRYPT_LOG_ROUNDS'])
+
+
+def not_transactional(test):
+    test.transactional = False
+    return test
+
+
+class TransactionSession(RoutingSession):
+    # a session on the connection of the test, always inside a SAVEPOINT:
+    # commit releases it and rollback goes back to it, then the next one starts
+
+    def __init__(self, db, connection):
+        RoutingSession.__init__(self, db, bind=connection)
+        self._closing = False
+        event.listen(self, 'after_transaction_end', self._restart_savepoint)
+        self.begin_nested()
+
+    def get_bind(self, mapper=None, clause=None):
+        return self.bind
+
+    def _restart_savepoint(self, session, transaction):
+        if transaction.nested and not transaction._parent.nested and not self._closing:
+            self.expire_all()
+            self.begin_nested()
+
+    def close(self):
+        # like closing a real session, whatever was not committed goes away
+        self._closing = True
+        try:
+            if self.transaction is not None and self.transaction.nested:
+                self.rollback()
+            RoutingSession.close(self)
+        finally:
+            self._closing = False
+
+
+class AppTestCase(unittest.TestCase):
+
+    transactional = True
+    # a database of the test class instead of the in-memory one (never transactional):
+    # a server URI, or the name of a sqlite file in the directory of the process
+    database_uri = None
+    database_file = None
+
+    def setUp(self):
+        app.config['ERROR_LOG_PATH'] = worker_path('error.log')
+        self.app = app.test_client()
+        summary.invalidate()
+        auth.forget()
+        db.session.remove()
+        test = getattr(self, self._testMethodName)
+        if self.database_uri or self.database_file:
+            self.use_config(SQLALCHEMY_DATABASE_URI=self.database_uri or 'sqlite:///' + worker_path(self.database_file))
+            self.fresh_schema()
+        elif self.transactional and getattr(test, 'transactional', True):
+            self.create_schema()
+            self.begin_transaction()
+        else:
+            _schema['created'] = False      # the next test starts from a new one
+            self.fresh_schema()
+
+    ### database ###
+
+    def create_schema(self):
+        # a new in-memory database when the URI was changed and back
+        if _schema['engine'] is not db.engine or not _schema['created']:
+            db.drop_all()
+            db.create_all()
+            _schema.update(engine=db.engine, created=True)
+
+    def fresh_schema(self):
+        db.drop_all()
+        db.create_all()
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+
+    def begin_transaction(self):
+        connection = db.engine.connect()
+        # pysqlite opens transactions on its own and gets SAVEPOINT wrong: this one is
+        # started here and the driver stays out of the way until the connection goes back
+        # http://docs.sqlalchemy.org/en/rel_1_1/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl
+        driver_connection = connection.connection.connection
+        driver_connection.isolation_level = None
+        transaction = connection.begin()
+        connection.execute('BEGIN')
+        original = db.session
+        db.session = scoped_session(partial(TransactionSession, db, connection),
+                                    scopefunc=original.registry.scopefunc)
+        # run last registered first
+        self.addCleanup(connection.close)
+        self.addCleanup(setattr, driver_connection, 'isolation_level', '')
+        self.addCleanup(transaction.rollback)
+        self.addCleanup(setattr, db, 'session', original)
+        self.addCleanup(db.session.remove)
+
+    @contextmanager
+    def recorded_statements(self):
+        # the SQL statements sent while the block runs
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if not statement.startswith(SAVEPOINT_STATEMENTS):
+                statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+    ### configuration ###
+
+    def use_config(self, **settings):
+        # for this test only
+        for key, value in settings.items():
+            self.addCleanup(app.config.__setitem__, key, app.config[key])
+            app.config[key] = value
@@ -1,31 +1,17 @@
-import os
+import json
 import unittest
-from datetime import date
+from unittest import mock
+from datetime import date, datetime
 
-from project import app, db
-from project._config import basedir
-from project.models import Task
+from sqlalchemy import event
 
-TEST_DB = 'test.db'
+from base import AppTestCase, app, password_hash
+from project import db, changes, journal, search, summary
+from project.models import ChangeVersion, Task, TaskChange, User
 
-class APITests(unittest.TestCase):
+class APITests(AppTestCase):
 
-    ### setup and teardown ###
-    # for more detailed description see test_tasks.py
-    def setUp(self):
-        app.config['TESTING'] = True
-        app.config['DEBUG'] = False
-        app.config['WTF_CSRF_ENABLED'] = False
-        app.config['SQLALCHEMY_DATABASE_URI'] = \
-            'sqlite:///' + os.path.join(basedir, TEST_DB)
-        self.app = app.test_client()
-        db.create_all()
-
-        self.assertEquals(app.debug, False)
-
-    def tearDown(self):
-        db.session.remove()
-        db.drop_all()
+    # test client, database and per-test transaction: see tests/base.py
 
     ### helper functions ###
 
@@ -54,8 +40,30 @@ class APITests(unittest.TestCase):
         )
         db.session.commit()
 
+    def login_as(self, name, role='user'):
+        db.session.add(User(name, name + '@example.com', password_hash('password'), role))
+        db.session.commit()
+        self.app.get('/logout/')
+        return self.app.post('/', data=dict(name=name, password='password'))
+
+    def post_json(self, url, payload):
+        return self.app.post(url, data=json.dumps(payload), content_type='application/json')
+
+    def statuses(self):
+        return dict(db.session.query(Task.task_id, Task.status))
+
+    def get_summary(self):
+        response = self.app.get('api/v1/summary')
+        return json.loads(response.data.decode('utf-8'))['items']
+
     ### tests ###
 
+    def test_api_requires_login_with_a_json_401(self):
+        response = self.app.post('api/v1/tasks/1/complete')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(json.loads(response.data.decode())['error'], 'You need to login first.')
+
     def test_collection_endpoint_returns_correct_data(self):
         self.add_tasks()
         # calls api_tasks() in api/views.py which generates JSON
@@ -73,6 +81,16 @@ class APITests(unittest.TestCase):
         self.assertIn(b'Purchase Kitchen Timer', response.data)
         self.assertNotIn(b'Run around in circles', response.data)
 
+    def test_resource_endpoint_returns_compact_json(self):
+        self.add_tasks()
+        response = self.app.get('api/v1/tasks/1')
+        self.assertNotIn(b'\n', response.data)
+        self.assertNotIn(b'": ', response.data)
+        self.assertEquals(json.loads(response.data.decode('utf-8'))['items'], {
+            'task_id': 1, 'task name': 'Run around in circles', 'due date': '2016-12-15',
+            'priority': 10, 'posted date': '2016-12-10', 'status': 1, 'user id': 1
+        })
+
     def test_invalid_resource_endpoint_returns_error(self):
         self.add_tasks()
         response = self.app.get('api/v1/tasks/209', follow_redirects=True)
@@ -80,6 +98,465 @@ class APITests(unittest.TestCase):
         self.assertEquals(response.mimetype, 'application/json')
         self.assertIn(b'Element does not exist', response.data)
 
+    def test_collection_endpoint_is_paginated_with_a_cursor(self):
+        for day in range(1, 26):
+            db.session.add(Task("Task {}".format(day), date(2017, 1, day), 1, date(2016, 12, 1), 1, 1))
+        db.session.commit()
+        seen = []
+        cursor = ''
+        while True:
+            response = self.app.get('api/v1/tasks/?per_page=10&cursor=' + cursor)
+            self.assertEquals(response.status_code, 200)
+            page = json.loads(response.data.decode('utf-8'))
+            self.assertLessEqual(len(page['items']), 10)
+            seen.extend(item['task name'] for item in page['items'])
+            if page['next_cursor'] is None:
+                break
+            cursor = page['next_cursor']
+        # every task exactly once, in due date order
+        self.assertEquals(seen, ["Task {}".format(day) for day in range(1, 26)])
+
+    def test_collection_endpoint_orders_ties_by_task_id(self):
+        for name in ('first', 'second', 'third'):
+            db.session.add(Task(name, date(2017, 1, 1), 1, date(2016, 12, 1), 1, 1))
+        db.session.commit()
+        response = self.app.get('api/v1/tasks/?per_page=2')
+        page = json.loads(response.data.decode('utf-8'))
+        self.assertEquals([item['task name'] for item in page['items']], ['first', 'second'])
+        response = self.app.get('api/v1/tasks/?per_page=2&cursor=' + page['next_cursor'])
+        page = json.loads(response.data.decode('utf-8'))
+        self.assertEquals([item['task name'] for item in page['items']], ['third'])
+        self.assertIsNone(page['next_cursor'])
+
+    def test_collection_endpoint_rejects_invalid_cursor(self):
+        self.add_tasks()
+        response = self.app.get('api/v1/tasks/?cursor=not-a-cursor')
+        self.assertEquals(response.status_code, 400)
+        self.assertIn(b'Invalid cursor', response.data)
+
+    def test_complete_endpoint(self):
+        self.login_as('testuser1')
+        self.add_tasks()
+        response = self.app.post('api/v1/tasks/1/complete')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(self.statuses(), {1: 0, 2: 1})
+
+    def test_complete_endpoint_tells_forbidden_from_missing(self):
+        self.login_as('testuser1')
+        self.add_tasks()
+        self.login_as('testuser2')
+        self.assertEquals(self.app.post('api/v1/tasks/1/complete').status_code, 403)
+        self.assertEquals(self.app.post('api/v1/tasks/99/complete').status_code, 404)
+        self.assertEquals(self.statuses(), {1: 1, 2: 1})
+
+    def test_delete_endpoint(self):
+        self.login_as('testuser1')
+        self.add_tasks()
+        self.login_as('superuser', role='admin')
+        response = self.app.delete('api/v1/tasks/2')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(self.statuses(), {1: 1})
+        self.assertEquals(self.app.delete('api/v1/tasks/2').status_code, 404)
+
+    def test_summary_counts_follow_mutations(self):
+        self.login_as('testuser1')
+        self.add_tasks()
+        self.assertEquals(self.get_summary(), {'open': 2, 'closed': 0})
+        self.app.post('/add/', data=dict(name='Another', due_date='10/12/2017', priority='1'))
+        self.assertEquals(self.get_summary(), {'open': 3, 'closed': 0})
+        self.app.get('/complete/1/')
+        # completing twice does not count twice
+        self.app.post('api/v1/tasks/1/complete')
+        self.assertEquals(self.get_summary(), {'open': 2, 'closed': 1})
+        self.app.get('/delete/1/')
+        self.assertEquals(self.get_summary(), {'open': 2, 'closed': 0})
+        self.post_json('api/v1/tasks/bulk', {'tasks': [{'name': 'n', 'due_date': '2017-01-01', 'priority': 1}]})
+        self.post_json('api/v1/tasks/bulk/complete', {'task_ids': [2, 3]})
+        self.assertEquals(self.get_summary(), {'open': 1, 'closed': 2})
+        summary.invalidate()
+        self.assertEquals(self.get_summary(), {'open': 1, 'closed': 2})
+
+    def test_summary_includes_totals_for_admins(self):
+        self.login_as('testuser1')
+        self.add_tasks()
+        self.login_as('superuser', role='admin')
+        self.app.post('api/v1/tasks/2/complete')
+        self.assertEquals(self.get_summary(), {'open': 0, 'closed': 0, 'all': {'open': 1, 'closed': 1}})
+
+    def test_admin_changes_update_the_owners_counts_without_a_reload(self):
+        self.login_as('testuser1')
+        self.add_tasks()
+        self.add_tasks()
+        self.login_as('superuser', role='admin')
+        self.get_summary()
+        with self.recorded_statements() as statements:
+            self.app.post('api/v1/tasks/1/complete')
+            self.post_json('api/v1/tasks/bulk/complete', {'task_ids': [1, 2]})
+            self.post_json('api/v1/tasks/bulk/delete', {'task_ids': [3]})
+            self.app.delete('api/v1/tasks/4')
+            self.assertEquals(self.get_summary()['all'], {'open': 0, 'closed': 2})
+        # only the owner was counted again, never everyone
+        self.assertEquals([s for s in statements if 'GROUP BY' in s and 'WHERE' not in s], [])
+
+    def test_counts_adjusted_during_a_load_are_counted_again(self):
+        self.login_as('testuser1')
+        self.add_tasks()
+        count_query = summary.count_query
+        def racing_count_query(user_id=None):
+            query = count_query(user_id)
+            if user_id is None:
+                # a write commits on another thread while the full load runs
+                rows = query.all()
+                db.session.query(Task).filter(Task.task_id == 1).update({'status': 0})
+                db.session.commit()
+                summary.tasks_completed(1)
+                return rows
+            return query
+        summary.count_query = racing_count_query
+        self.addCleanup(setattr, summary, 'count_query', count_query)
+        self.assertEquals(self.get_summary(), {'open': 1, 'closed': 1})
+
+    def test_a_failed_count_is_not_cached(self):
+        self.login_as('testuser1')
+        self.add_tasks()
+        count_query = summary.count_query
+        def failing_count_query(user_id=None):
+            raise RuntimeError('connection lost')
+        summary.count_query = failing_count_query
+        self.addCleanup(setattr, summary, 'count_query', count_query)
+        with self.assertRaises(RuntimeError):
+            self.get_summary()
+        summary.count_query = count_query
+        self.assertEquals(self.get_summary(), {'open': 2, 'closed': 0})
+
+    def test_cached_summary_does_not_query_tasks(self):
+        self.login_as('testuser1')
+        self.add_tasks()
+        self.get_summary()
+        with self.recorded_statements() as statements:
+            self.get_summary()
+        self.assertEquals([s for s in statements if 'tasks' in s], [])
+
+    def test_collection_endpoint_answers_304_while_unchanged(self):
+        self.add_tasks()
+        response = self.app.get('api/v1/tasks/')
+        etag = response.headers['ETag']
+        with self.recorded_statements() as statements:
+            response = self.app.get('api/v1/tasks/', headers={'If-None-Match': etag})
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(response.data, b'')
+        # only the change version was looked up
+        self.assertEquals(len(statements), 1)
+        self.assertIn('change_versions', statements[0])
+
+    def test_etag_changes_with_the_tasks_table(self):
+        self.login_as('testuser1')
+        self.add_tasks()
+        etag = self.app.get('api/v1/tasks/1').headers['ETag']
+        self.app.post('api/v1/tasks/2/complete')
+        response = self.app.get('api/v1/tasks/1', headers={'If-None-Match': etag})
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEquals(response.headers['ETag'], etag)
+        self.assertIn(b'Run around in circles', response.data)
+
+    def test_writes_bump_the_version_row_of_the_owner_only(self):
+        self.login_as('testuser1')
+        self.add_tasks()
+        versions = db.session.query(ChangeVersion.name, ChangeVersion.version).\
+            filter(ChangeVersion.name.like('tasks:%'))
+        before = dict(versions)
+        self.app.post('api/v1/tasks/1/complete')
+        after = dict(versions)
+        self.assertEquals(len(after), changes.PARTITIONS)
+        self.assertEquals([name for name in after if after[name] != before[name]], ['tasks:1'])
+        self.assertEquals(changes.current()[0], sum(before.values()) + 1)
+
+    def test_missing_version_rows_are_added_by_the_first_writer(self):
+        db.session.query(ChangeVersion).delete()
+        db.session.commit()
+        self.assertEquals(changes.current(), (0, None))
+        # another writer adds the row between the UPDATE that missed it and the INSERT,
+        # which then leaves it alone
+        raced = []
+        def insert_first(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE change_versions') and not cursor.rowcount and not raced:
+                raced.append(statement)
+                conn.execute(ChangeVersion.__table__.insert().values(
+                    name='tasks:1', version=1, modified=datetime.utcnow()))
+        event.listen(db.engine, 'after_cursor_execute', insert_first)
+        self.addCleanup(event.remove, db.engine, 'after_cursor_execute', insert_first)
+        changes.bump([1])
+        changes.bump([17])
+        db.session.commit()
+        self.assertTrue(raced)
+        self.assertEquals(changes.current()[0], 3)
+
+    def test_if_modified_since(self):
+        self.login_as('testuser1')
+        self.post_json('api/v1/tasks/bulk', {'tasks': [{'name': 'n', 'due_date': '2017-01-01', 'priority': 1}]})
+        db.session.execute("UPDATE change_versions SET modified = '2016-12-01 10:00:00.5'")
+        db.session.commit()
+        response = self.app.get('api/v1/tasks/')
+        self.assertEquals(response.headers['Last-Modified'], 'Thu, 01 Dec 2016 10:00:01 GMT')
+        response = self.app.get('api/v1/tasks/', headers={'If-Modified-Since': 'Thu, 01 Dec 2016 10:00:01 GMT'})
+        self.assertEquals(response.status_code, 304)
+        response = self.app.get('api/v1/tasks/', headers={'If-Modified-Since': 'Thu, 01 Dec 2016 10:00:00 GMT'})
+        self.assertEquals(response.status_code, 200)
+
+    def test_bulk_create_inserts_all_tasks(self):
+        self.login_as('testuser1')
+        response = self.post_json('api/v1/tasks/bulk', {'tasks': [
+            {'name': 'Task {}'.format(n), 'due_date': '2017-01-01', 'priority': 3} for n in range(50)
+        ]})
+        self.assertEquals(response.status_code, 201)
+        self.assertEquals(json.loads(response.data.decode('utf-8'))['created'], 50)
+        self.assertEquals(db.session.query(Task).filter_by(user_id=1, status=1).count(), 50)
+
+    def test_bulk_create_is_all_or_nothing(self):
+        self.login_as('testuser1')
+        response = self.post_json('api/v1/tasks/bulk', {'tasks': [
+            {'name': 'fine', 'due_date': '2017-01-01', 'priority': 3},
+            {'name': 'bad date', 'due_date': '01/01/2017', 'priority': 3},
+            {'name': 'bad priority', 'due_date': '2017-01-01', 'priority': 11},
+        ]})
+        self.assertEquals(response.status_code, 400)
+        errors = json.loads(response.data.decode('utf-8'))['items']
+        self.assertEquals(sorted(errors), ['1', '2'])
+        self.assertEquals(db.session.query(Task).count(), 0)
+
+    def test_bulk_create_requires_a_batch(self):
+        self.login_as('testuser1')
+        response = self.post_json('api/v1/tasks/bulk', {'tasks': []})
+        self.assertEquals(response.status_code, 400)
+
+    def test_bulk_complete_checks_ownership_per_task(self):
+        self.login_as('testuser1')
+        self.add_tasks()
+        self.login_as('testuser2')
+        db.session.add(Task("Mine", date(2016, 12, 15), 1, date(2016, 12, 10), 1, 2))
+        db.session.commit()
+        response = self.post_json('api/v1/tasks/bulk/complete', {'task_ids': [1, 3, 99]})
+        self.assertEquals(response.status_code, 200)
+        result = json.loads(response.data.decode('utf-8'))
+        self.assertEquals(result['completed'], [3])
+        self.assertEquals(result['forbidden'], [1])
+        self.assertEquals(result['not_found'], [99])
+        self.assertEquals(self.statuses(), {1: 1, 2: 1, 3: 0})
+
+    def test_bulk_delete_as_admin(self):
+        self.login_as('testuser1')
+        self.add_tasks()
+        self.login_as('superuser', role='admin')
+        response = self.post_json('api/v1/tasks/bulk/delete', {'task_ids': [1, 2]})
+        result = json.loads(response.data.decode('utf-8'))
+        self.assertEquals(result['deleted'], [1, 2])
+        self.assertEquals(self.statuses(), {})
+
+    def test_bulk_delete_rejects_non_integer_ids(self):
+        self.login_as('testuser1')
+        response = self.post_json('api/v1/tasks/bulk/delete', {'task_ids': ['1']})
+        self.assertEquals(response.status_code, 400)
+
+    def search(self, query):
+        response = self.app.get('api/v1/tasks/search?' + query)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data.decode())
+
+    def test_search_matches_word_prefixes(self):
+        self.add_tasks()
+        self.assertEqual([t['task_id'] for t in self.search('q=purch kit')['items']], [2])
+        self.assertEqual([t['task_id'] for t in self.search('q=CIRCLE')['items']], [1])
+        self.assertEqual(self.search('q=timer+circles')['items'], [])
+        self.assertEqual(self.app.get('api/v1/tasks/search?q=+').status_code, 400)
+
+    def test_search_follows_inserts_updates_and_deletes(self):
+        self.login_as('alice')
+        self.add_tasks()
+        self.post_json('api/v1/tasks/bulk', {'tasks': [{'name': 'Buy a kitchen sink', 'due_date': '2017-01-01', 'priority': 1}]})
+        self.assertEqual([t['task name'] for t in self.search('q=kitchen')['items']],
+                         ['Purchase Kitchen Timer', 'Buy a kitchen sink'])
+        db.session.query(Task).filter_by(task_id=2).update({'name': 'Purchase egg timer'})
+        db.session.commit()
+        self.app.delete('api/v1/tasks/3')
+        self.assertEqual(self.search('q=kitchen')['items'], [])
+        self.assertEqual([t['task_id'] for t in self.search('q=egg')['items']], [2])
+
+    def test_search_ranks_and_paginates(self):
+        db.session.add_all([
+            Task('report', date(2017, 1, 1), 1, date(2017, 1, 1), 1, 1),
+            Task('write the quarterly report and the yearly report draft', date(2017, 1, 1), 1, date(2017, 1, 1), 1, 1),
+            Task('report report', date(2017, 1, 1), 1, date(2017, 1, 1), 1, 1)
+        ])
+        db.session.commit()
+        first = self.search('q=report&per_page=2')
+        self.assertEqual(len(first['items']), 2)
+        rest = self.search('q=report&per_page=2&cursor=' + first['next_cursor'])
+        self.assertIsNone(rest['next_cursor'])
+        ranked = [t['task_id'] for t in first['items'] + rest['items']]
+        self.assertEqual(sorted(ranked), [1, 2, 3])
+        # short names full of the word rank above the long one
+        self.assertEqual(ranked[-1], 2)
+        response = self.app.get('api/v1/tasks/search?q=report&cursor=nope')
+        self.assertEqual(response.status_code, 400)
+
+    def test_search_pages_do_not_move_when_tasks_are_added(self):
+        self.login_as('alice')
+        db.session.add_all([Task('report ' * n, date(2017, 1, 1), 1, date(2017, 1, 1), 1, 1) for n in range(1, 6)])
+        db.session.commit()
+        first = self.search('q=report&per_page=2')
+        # new matches change the bm25 rank of every match
+        db.session.add_all([Task('report {}'.format(n), date(2017, 1, 1), 1, date(2017, 1, 1), 1, 1)
+                            for n in range(20)])
+        db.session.commit()
+        seen = [t['task_id'] for t in first['items']]
+        deleted = min(set(range(1, 6)) - set(seen))
+        self.assertEqual(self.app.delete('api/v1/tasks/{}'.format(deleted)).status_code, 200)
+        cursor = first['next_cursor']
+        while cursor:
+            page = self.search('q=report&per_page=2&cursor=' + cursor)
+            seen += [t['task_id'] for t in page['items']]
+            cursor = page['next_cursor']
+        self.assertEqual(sorted(seen), sorted(set(range(1, 6)) - {deleted}))
+        self.assertEqual(self.app.get('api/v1/tasks/search?q=report&cursor=' + '"x"').status_code, 400)
+
+    def test_search_without_fts5_matches_escaped_word_prefixes(self):
+        self.addCleanup(search._fts5.clear)
+        search._fts5['available'] = False
+        self.assertFalse(search.install(db.session.connection()))
+        db.session.add_all([Task(name, date(2017, 1, 1), 1, date(2017, 1, 1), 1, 1)
+                            for name in ('Pack the bags', 'Backpack', 'fix a_c unit', 'fix abc unit')])
+        db.session.commit()
+        self.assertEqual([t['task name'] for t in self.search('q=pack')['items']], ['Pack the bags'])
+        self.assertEqual([t['task name'] for t in self.search('q=a_c')['items']], ['fix a_c unit'])
+
+    def test_search_is_an_index_lookup(self):
+        self.add_tasks()
+        plan = ' | '.join(row[-1] for row in db.session.execute(
+            "EXPLAIN QUERY PLAN SELECT rowid FROM tasks_fts WHERE tasks_fts MATCH '\"kit\"*'"))
+        self.assertIn('VIRTUAL TABLE INDEX', plan)
+
+    def test_export_streams_all_tasks_as_csv(self):
+        self.use_config(EXPORT_BATCH_SIZE=1)
+        self.login_as('alice')
+        self.add_tasks()
+        response = self.app.get('api/v1/tasks/export?format=csv')
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertEqual(response.data.decode().splitlines(), [
+            'task_id,task name,due date,priority,posted date,status,user id',
+            '1,Run around in circles,2016-12-15,10,2016-12-10,1,1',
+            '2,Purchase Kitchen Timer,2016-12-20,10,2016-12-24,1,1'
+        ])
+
+    def test_export_writes_missing_dates_as_empty_csv_fields_and_json_null(self):
+        self.login_as('alice')
+        # a row of an older import, the model would fill in posted_date
+        db.session.execute(Task.__table__.insert().values(
+            name='Undated', due_date=date(2017, 1, 1), priority=1, posted_date=None, status=1, user_id=1))
+        db.session.commit()
+        csv_lines = self.app.get('api/v1/tasks/export?format=csv').data.decode().splitlines()
+        self.assertEqual(csv_lines[1], '1,Undated,2017-01-01,1,,1,1')
+        line = json.loads(self.app.get('api/v1/tasks/export?format=ndjson').data.decode())
+        self.assertIsNone(line['posted date'])
+
+    def test_export_as_ndjson(self):
+        self.login_as('alice')
+        self.add_tasks()
+        response = self.app.get('api/v1/tasks/export?format=ndjson')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual([line['task_id'] for line in lines], [1, 2])
+        self.assertEqual(lines[0]['task name'], 'Run around in circles')
+        # the same keys as the CSV header
+        header = self.app.get('api/v1/tasks/export?format=csv').data.decode().splitlines()[0]
+        self.assertEqual(sorted(lines[0]), sorted(header.split(',')))
+        self.assertEqual(self.app.get('api/v1/tasks/export?format=xml').status_code, 400)
+
+    def get_changes(self, query=''):
+        response = self.app.get('api/v1/tasks/changes' + query)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data.decode())
+
+    def test_changes_feed_lists_mutations_after_a_sequence_number(self):
+        self.login_as('alice')
+        self.add_tasks()
+        start = self.get_changes('?wait=0')['last_seq']
+        self.post_json('api/v1/tasks/bulk', {'tasks': [{'name': 'n', 'due_date': '2017-01-01', 'priority': 1}]})
+        self.app.post('api/v1/tasks/1/complete')
+        self.app.delete('api/v1/tasks/1')
+        page = self.get_changes('?since={}'.format(start))
+        self.assertEqual([e['event'] for e in page['items']], ['created', 'completed', 'deleted'])
+        self.assertEqual([e['task_ids'] for e in page['items']], [None, [1], [1]])
+        self.assertEqual(page['last_seq'], start + 3)
+        # resuming from the last one: nothing new
+        self.assertEqual(self.get_changes('?wait=0&since={}'.format(page['last_seq']))['items'], [])
+
+    def test_changes_feed_requires_login_and_shows_own_tasks_only(self):
+        self.assertEqual(self.app.get('api/v1/tasks/changes?wait=0').status_code, 401)
+        self.login_as('alice')
+        self.add_tasks()
+        self.post_json('api/v1/tasks/bulk/complete', {'task_ids': [1, 2]})
+        self.login_as('bob')
+        self.post_json('api/v1/tasks/bulk', {'tasks': [{'name': 'n', 'due_date': '2017-01-01', 'priority': 1}]})
+        page = self.get_changes('?wait=0&since=0')
+        self.assertEqual([(e['event'], e['user_id']) for e in page['items']], [('created', 2)])
+        # an admin completing alice's tasks: the entries are alice's, with only what changed
+        self.post_json('api/v1/tasks/bulk', {'tasks': [{'name': 'm', 'due_date': '2017-01-01', 'priority': 1}]})
+        self.login_as('root', role='admin')
+        start = self.get_changes('?wait=0')['last_seq']
+        self.app.post('api/v1/tasks/3/complete')
+        db.session.add(Task('more', date(2017, 1, 1), 1, date(2017, 1, 1), 1, 1))
+        db.session.commit()
+        response = self.post_json('api/v1/tasks/bulk/complete', {'task_ids': [1, 2, 5]})
+        self.assertEqual(json.loads(response.data.decode())['completed'], [1, 2, 5])
+        page = self.get_changes('?wait=0&since={}'.format(start))
+        self.assertEqual([(e['user_id'], e['task_ids'], e['count']) for e in page['items']],
+                         [(2, [3], 1), (1, [5], 1)])
+
+    def test_changes_long_poll_waits_for_a_change(self):
+        self.use_config(CHANGES_POLL_INTERVAL=0.01)
+        self.login_as('alice')
+        start = self.get_changes('?wait=0')['last_seq']
+        waits = []
+        def sleep(seconds):
+            # a change made by another process while the poll waits
+            waits.append(seconds)
+            if len(waits) == 2:
+                journal.record('completed', [1], 1)
+                db.session.commit()
+        with mock.patch.object(journal.time, 'sleep', sleep):
+            page = self.get_changes('?wait=10&since={}'.format(start))
+        self.assertEqual(len(waits), 2)
+        self.assertEqual([e['seq'] for e in page['items']], [start + 1])
+
+    def test_changes_feed_tells_clients_that_fell_behind_to_reload(self):
+        self.login_as('alice')
+        self.add_tasks()
+        for task_id in (1, 2):
+            self.app.post('api/v1/tasks/{}/complete'.format(task_id))
+        newest = self.get_changes('?wait=0')['last_seq']
+        db.session.query(TaskChange).filter(TaskChange.seq < newest).delete()
+        db.session.commit()
+        self.assertTrue(self.get_changes('?since={}'.format(newest - 2))['reset'])
+        self.assertEqual(self.get_changes('?since={}'.format(newest - 1))['items'][0]['seq'], newest)
+        page = self.get_changes('?since={}'.format(newest + 5))
+        self.assertEqual(page, {'reset': True, 'last_seq': newest})
+        response = self.app.get('api/v1/tasks/changes?since=abc')
+        self.assertEqual(response.status_code, 400)
+
+    def test_changes_as_server_sent_events(self):
+        self.use_config(CHANGES_STREAM_SECONDS=0.2, CHANGES_POLL_INTERVAL=0.05)
+        self.login_as('alice')
+        self.add_tasks()
+        start = self.get_changes('?wait=0')['last_seq']
+        self.app.post('api/v1/tasks/1/complete')
+        response = self.app.get('api/v1/tasks/changes', headers={
+            'Accept': 'text/event-stream', 'Last-Event-ID': str(start)
+        })
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        body = response.data.decode()
+        self.assertIn('id: {}\nevent: completed\ndata: '.format(start + 1), body)
+        self.assertIn(': keep-alive', body)
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,134 @@
+import json
+import os
+import unittest
+from datetime import date
+
+from base import AppTestCase, app, password_hash, worker_path
+from project import db
+from project.models import Task, User
+
+# the same checks against every configured backend.
+# sqlite always runs; PostgreSQL runs when TEST_POSTGRES_URL points to an empty database,
+# e.g. TEST_POSTGRES_URL=postgresql://postgres@localhost/flasktaskr_test
+
+class BackendTests(object):
+
+    ### helper functions ###
+
+    def login_as(self, name, role='user'):
+        db.session.add(User(name, name + '@example.com', password_hash('password'), role))
+        db.session.commit()
+        self.app.get('/logout/')
+        return self.app.post('/', data=dict(name=name, password='password'))
+
+    def get_json(self, url):
+        return json.loads(self.app.get(url).data.decode('utf-8'))
+
+    ### tests ###
+
+    def test_task_lifecycle(self):
+        self.login_as('testuser1')
+        self.app.post('/add/', data=dict(name='Go to the bank', due_date='10/12/2017', priority='1'))
+        self.app.post('/api/v1/tasks/bulk', content_type='application/json', data=json.dumps({'tasks': [
+            {'name': 'Task {}'.format(n), 'due_date': '2017-01-0{}'.format(n), 'priority': 1} for n in range(1, 4)
+        ]}))
+        response = self.app.get('/complete/1/', follow_redirects=True)
+        self.assertIn(b'The task is complete. Nice.', response.data)
+        response = self.app.get('/delete/2/', follow_redirects=True)
+        self.assertIn(b'The task was deleted.', response.data)
+        self.assertEqual(self.get_json('/api/v1/summary')['items'], {'open': 2, 'closed': 1})
+        page = self.get_json('/api/v1/tasks/?per_page=2')
+        self.assertEqual([item['task name'] for item in page['items']], ['Task 2', 'Task 3'])
+        page = self.get_json('/api/v1/tasks/?per_page=2&cursor=' + page['next_cursor'])
+        self.assertEqual([item['task name'] for item in page['items']], ['Go to the bank'])
+
+    def test_ownership_is_enforced(self):
+        self.login_as('testuser1')
+        db.session.add(Task('Mine', date(2017, 1, 1), 1, date(2016, 12, 1), 1, 1))
+        db.session.commit()
+        self.login_as('testuser2')
+        response = self.app.get('/delete/1/', follow_redirects=True)
+        self.assertIn(b'You can only delete tasks that belong to you.', response.data)
+        response = self.app.get('/delete/2/', follow_redirects=True)
+        self.assertIn(b'That task does not exist.', response.data)
+
+
+# a file, the pragmas do not all apply to an in-memory database
+class SQLiteBackendTests(BackendTests, AppTestCase):
+
+    database_file = 'test.db'
+
+    def test_connections_are_tuned_with_pragmas(self):
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            values = {}
+            for name in ('journal_mode', 'synchronous', 'busy_timeout', 'mmap_size'):
+                cursor.execute('PRAGMA {}'.format(name))
+                values[name] = cursor.fetchone()[0]
+        finally:
+            connection.close()
+        self.assertEqual(values['journal_mode'], 'wal')
+        self.assertEqual(values['synchronous'], 1)     # NORMAL
+        self.assertEqual(values['busy_timeout'], app.config['SQLITE_PRAGMAS']['busy_timeout'])
+        self.assertEqual(values['mmap_size'], app.config['SQLITE_PRAGMAS']['mmap_size'])
+
+
+@unittest.skipUnless(os.environ.get('TEST_POSTGRES_URL'), 'TEST_POSTGRES_URL is not set')
+class PostgreSQLBackendTests(BackendTests, AppTestCase):
+
+    database_uri = os.environ.get('TEST_POSTGRES_URL')
+
+    def test_connections_are_pooled(self):
+        self.assertEqual(db.engine.pool.size(), app.config['SQLALCHEMY_POOL_SIZE'])
+
+
+# two sqlite files stand in for the primary and a replica that has not caught up yet
+class ReplicaRoutingTests(AppTestCase):
+
+    database_file = 'test.db'
+
+    def setUp(self):
+        self.use_config(SQLALCHEMY_BINDS={'replica': 'sqlite:///' + worker_path('test_replica.db')})
+        super(ReplicaRoutingTests, self).setUp()
+        db.metadata.create_all(self.replica())
+        self.addCleanup(db.metadata.drop_all, self.replica())
+        # the same user on both sides, and one task only the replica knows about
+        # (hashed at the configured cost, so logging in does not rehash: a write that would
+        # stick to the primary)
+        for engine in (db.engine, self.replica()):
+            engine.execute(User.__table__.insert(), name='testuser1', email='test1@gmail.com',
+                           password=password_hash('111111'), role='user')
+        self.replica().execute(Task.__table__.insert(), name='Only on the replica', due_date=date(2017, 1, 1),
+                               priority=1, posted_date=date(2016, 12, 1), status=1, user_id=1)
+
+    def replica(self):
+        return db.get_engine(app, bind='replica')
+
+    def test_read_only_views_use_the_replica(self):
+        self.app.post('/', data=dict(name='testuser1', password='111111'))
+        self.assertIn(b'Only on the replica', self.app.get('/api/v1/tasks/').data)
+        self.assertIn(b'Only on the replica', self.app.get('/api/v1/tasks/1').data)
+        self.assertIn(b'Only on the replica', self.app.get('/tasks/').data)
+
+    def test_writes_go_to_the_primary_and_stick_for_a_while(self):
+        self.app.post('/', data=dict(name='testuser1', password='111111'))
+        self.app.post('/add/', data=dict(name='Written to the primary', due_date='10/12/2017', priority='1'))
+        self.assertEqual(self.replica().execute('SELECT COUNT(*) FROM tasks').scalar(), 1)
+        self.assertEqual(db.engine.execute('SELECT COUNT(*) FROM tasks').scalar(), 1)
+        # read your own writes
+        response = self.app.get('/tasks/')
+        self.assertIn(b'Written to the primary', response.data)
+        self.assertNotIn(b'Only on the replica', response.data)
+        # other clients still read from the replica
+        self.assertIn(b'Only on the replica', app.test_client().get('/api/v1/tasks/').data)
+
+    def test_stickiness_expires(self):
+        self.use_config(REPLICA_STICKY_SECONDS=-1)
+        self.app.post('/', data=dict(name='testuser1', password='111111'))
+        self.app.post('/add/', data=dict(name='Written to the primary', due_date='10/12/2017', priority='1'))
+        self.assertIn(b'Only on the replica', self.app.get('/tasks/').data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,27 +1,17 @@
-import os, unittest
-from project import app, db
-from project._config import basedir
-from project.models import User
+import gzip, json, os, re, shutil, tempfile, threading, unittest, zlib
+from datetime import date
+from base import AppTestCase, app, not_transactional, worker_path
+from project import create_app, db, error_log, metrics
+from project.models import Task, User
 
-TEST_DB = 'test.db'
-
-class MainTests(unittest.TestCase):
+class MainTests(AppTestCase):
 
     ### setup and teardown ###
 
     def setUp(self):
-        app.config['TESTING'] = True
-        app.config['WTF_CSRF_ENABLED'] = True
-        app.config['DEBUG'] = False
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + \
-            os.path.join(basedir, TEST_DB)
-        self.app = app.test_client()
-        db.create_all()
-        self.assertEquals(app.debug, False)
-
-    def tearDown(self):
-        db.session.remove()
-        db.drop_all()
+        super(MainTests, self).setUp()
+        # the forms of these pages are checked with their CSRF token
+        self.use_config(WTF_CSRF_ENABLED=True)
 
     ### helper functions ###
 
@@ -31,12 +21,211 @@ class MainTests(unittest.TestCase):
                              follow_redirects=True
                              )
 
+    # another app from the factory, logging to the directory of the test process
+    def other_app(self, blueprints=True, **settings):
+        config = {'SESSION_STORE': 'memory', 'ERROR_LOG_PATH': worker_path('other-error.log')}
+        config.update(settings)
+        self.addCleanup(error_log.stop)
+        return create_app(config, blueprints=blueprints)
+
+    # point the error log to a fresh temporary file for this test
+    def temporary_error_log(self, **settings):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings['ERROR_LOG_PATH'] = os.path.join(directory, 'error.log')
+        self.use_config(**settings)
+        error_log.stop()
+        self.addCleanup(error_log.stop)
+        return settings['ERROR_LOG_PATH']
+
     ### tests ###
 
     def test_404_error(self):
         response = self.app.get('/this-route-does-not-exist/')
         self.assertIn(b'Sorry. There\'s nothing here.', response.data)
 
+    def test_404_error_is_logged(self):
+        path = self.temporary_error_log()
+        self.app.get('/this-route-does-not-exist/')
+        error_log.flush()
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['status'], 404)
+        self.assertEqual(records[0]['method'], 'GET')
+        self.assertTrue(records[0]['url'].endswith('/this-route-does-not-exist/'))
+
+    def test_error_log_is_rotated(self):
+        path = self.temporary_error_log(ERROR_LOG_MAX_BYTES=1000, ERROR_LOG_BACKUP_COUNT=2)
+        for n in range(40):
+            self.app.get('/missing/{}/'.format(n))
+            error_log.flush()
+        self.assertTrue(os.path.exists(path + '.1'))
+        self.assertTrue(os.path.exists(path + '.2'))
+        self.assertFalse(os.path.exists(path + '.3'))
+        for name in (path, path + '.1', path + '.2'):
+            self.assertLessEqual(os.path.getsize(name), 1000)
+        with open(path) as f:
+            self.assertIn('/missing/39/', f.read())
+
+    def test_error_log_survives_a_path_it_cannot_write(self):
+        directory = os.path.join(os.path.dirname(self.temporary_error_log()), 'missing')
+        path = os.path.join(directory, 'error.log')
+        self.use_config(ERROR_LOG_PATH=path)
+        dropped = error_log.dropped
+        self.app.get('/missing/1/')
+        self.app.get('/missing/2/')
+        # flush() returns although nothing could be written
+        flushed = threading.Thread(target=error_log.flush)
+        flushed.start()
+        flushed.join(5)
+        self.assertFalse(flushed.is_alive())
+        self.assertEqual(error_log.dropped, dropped + 2)
+        # and the writer keeps going once the path works again
+        os.mkdir(directory)
+        self.app.get('/missing/3/')
+        error_log.flush()
+        with open(path) as f:
+            self.assertIn('/missing/3/', f.read())
+
+    def test_apps_write_their_own_error_log(self):
+        path = self.temporary_error_log()
+        other_path = os.path.join(os.path.dirname(path), 'other.log')
+        other = self.other_app(ERROR_LOG_PATH=other_path)
+        other.test_client().get('/missing/other/')
+        self.app.get('/missing/first/')
+        error_log.flush()
+        with open(path) as f:
+            self.assertEqual([json.loads(line)['url'][-7:] for line in f], ['/first/'])
+        with open(other_path) as f:
+            self.assertEqual([json.loads(line)['url'][-7:] for line in f], ['/other/'])
+
+    def test_pages_are_gzipped_when_accepted(self):
+        response = self.app.get('/', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertIn(b'Please login to access your task list.', gzip.decompress(response.data))
+
+    def test_pages_are_not_compressed_unless_accepted(self):
+        response = self.app.get('/')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn(b'Please login to access your task list.', response.data)
+
+    def test_small_responses_are_not_compressed(self):
+        self.use_config(COMPRESS_MIN_SIZE=1000000)
+        response = self.app.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_streamed_responses_are_gzipped_chunk_by_chunk(self):
+        db.session.add_all([Task('task {}'.format(n), date(2017, 1, 1), 1, date(2016, 12, 1), 1, 1)
+                            for n in range(3)])
+        db.session.commit()
+        response = self.app.get('api/v1/tasks/', headers={'Accept-Encoding': 'gzip'})
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', response.headers)
+        # every chunk can be decompressed as soon as it arrives
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks = [decompressor.decompress(chunk) for chunk in response.response]
+        self.assertEqual(chunks[0], b'{"items":[')
+        items = json.loads(b''.join(chunks).decode())['items']
+        self.assertEqual([item['task name'] for item in items], ['task 0', 'task 1', 'task 2'])
+
+    def test_static_files_are_fingerprinted_and_cached(self):
+        page = self.app.get('/').data.decode('utf-8')
+        url = re.search(r'/static/css/main\.css\?v=\w+', page).group(0)
+        response = self.app.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', response.headers['Cache-Control'])
+        response.close()
+        response = self.app.get('/static/css/main.css?v=outdated')
+        self.assertNotIn('immutable', response.headers['Cache-Control'])
+        response.close()
+
+    def test_metrics_are_off_by_default(self):
+        self.assertFalse(metrics.is_enabled(app))
+        response = self.app.get('/')
+        self.assertNotIn('Server-Timing', response.headers)
+        self.assertIn(b'Sorry. There\'s nothing here.', self.app.get('/metrics').data)
+
+    # counts every statement, the SAVEPOINTs of the test transaction would be in it
+    @not_transactional
+    def test_requests_are_timed_when_metrics_are_enabled(self):
+        metrics.enable(app)
+        self.addCleanup(metrics.reset, app)
+        self.addCleanup(metrics.disable, app)
+        db.session.add(User('testuser1', 'test1@example.com', 'x'))
+        db.session.commit()
+        response = self.app.get('/register/')
+        self.assertRegex(response.headers['Server-Timing'],
+                         r'^app;dur=[\d.]+, db;dur=[\d.]+;desc="0 queries", render;dur=[\d.]+$')
+        self.app.get('/api/v1/tasks/1')
+        response = self.app.get('/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'})
+        self.assertEqual(response.mimetype, 'text/plain')
+        body = response.data.decode()
+        self.assertIn('flasktaskr_request_seconds_count{endpoint="users.register"} 1', body)
+        self.assertIn('flasktaskr_render_seconds_bucket{endpoint="users.register",le="+Inf"} 1', body)
+        # the change version lookup and the task query
+        self.assertIn('flasktaskr_sql_statements_sum{endpoint="api.task"} 2', body)
+        self.assertIn('flasktaskr_sql_statements_bucket{endpoint="api.task",le="1"} 0', body)
+        self.assertIn('flasktaskr_startup_seconds{phase="total"}', body)
+        self.assertNotIn('endpoint="metrics"', body)
+
+    def test_metrics_are_only_served_to_allowed_addresses_and_the_token(self):
+        metrics.enable(app)
+        self.addCleanup(metrics.reset, app)
+        self.addCleanup(metrics.disable, app)
+        remote = {'REMOTE_ADDR': '203.0.113.9'}
+        self.assertEqual(self.app.get('/metrics', environ_base=remote).status_code, 403)
+        self.use_config(METRICS_TOKEN='s3cret')
+        self.assertEqual(self.app.get('/metrics', environ_base=remote,
+                                      headers={'Authorization': 'Bearer nope'}).status_code, 403)
+        self.assertEqual(self.app.get('/metrics', environ_base=remote,
+                                      headers={'Authorization': 'Bearer s3cret'}).status_code, 200)
+        self.assertEqual(self.app.get('/metrics', environ_base={'REMOTE_ADDR': '::1'}).status_code, 200)
+
+    def test_statements_that_fail_leave_no_start_time_behind(self):
+        metrics.enable(app)
+        self.addCleanup(metrics.disable, app)
+        connection = db.session.connection()
+        with self.assertRaises(Exception):
+            connection.execute('SELECT * FROM no_such_table')
+        self.assertNotIn('metrics_started', connection.info)
+
+    def test_factory_builds_apps_with_their_own_config(self):
+        other = self.other_app(TASKS_PER_PAGE=7)
+        self.assertEqual(other.config['TASKS_PER_PAGE'], 7)
+        self.assertNotEqual(app.config['TASKS_PER_PAGE'], 7)
+        self.assertEqual(sorted(other.blueprints), ['api', 'tasks', 'users'])
+        self.assertEqual(sorted(other.startup_seconds), ['blueprints', 'extensions', 'import', 'total'])
+        self.assertIn(b'Please login to access your task list.', other.test_client().get('/').data)
+
+    def test_apps_have_their_own_metrics(self):
+        local = {'REMOTE_ADDR': '127.0.0.1'}
+        metrics.enable(app)
+        self.addCleanup(metrics.reset, app)
+        self.addCleanup(metrics.disable, app)
+        # enabled from its config while the first app has the hooks already
+        other = self.other_app(METRICS_ENABLED=True)
+        self.addCleanup(metrics.disable, other)
+        other.startup_seconds['total'] = 1234.5
+        self.assertIn('Server-Timing', other.test_client().get('/register/').headers)
+        body = self.app.get('/metrics', environ_base=local).data.decode()
+        self.assertNotIn('users.register', body)
+        self.assertNotIn('1234.5', body)
+        body = other.test_client().get('/metrics', environ_base=local).data.decode()
+        self.assertIn('flasktaskr_request_seconds_count{endpoint="users.register"} 1', body)
+        self.assertIn('flasktaskr_startup_seconds{phase="total"} 1234.5', body)
+        metrics.disable(other)
+        self.assertIn(b'Sorry. There\'s nothing here.', other.test_client().get('/metrics', environ_base=local).data)
+        self.assertEqual(self.app.get('/metrics', environ_base=local).status_code, 200)
+
+    def test_scripts_can_build_an_app_without_blueprints(self):
+        other = self.other_app(blueprints=False)
+        self.assertEqual(other.blueprints, {})
+        self.assertEqual(sorted(other.startup_seconds), ['blueprints', 'extensions', 'import', 'total'])
+
     def test_index(self):
         # Ensure flask was set up correctly.
         response = self.app.get('/', content_type='html/text')
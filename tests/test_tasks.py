@@ -1,43 +1,24 @@
+import json
 import os
+import shutil
+import sqlite3
+import tempfile
 import unittest
-
-from project import app, db, bcrypt
-from project._config import basedir
-from project.models import User
-
-TEST_DB = 'test.db'
-
-class AllTests(unittest.TestCase):
-
-    #############################
-    #### setup and tear down ####
-    #############################
-
-    # executed prior to each test
-
-    # Flask exposes the Werkzeug test client and handles the context locals.
-    # It is important to set TESTING configuration setting to True,
-    # to propagate the exceptions to the test client.
-    def setUp(self):
-        app.config['TESTING'] = True
-        app.config['WTF_CSRF_ENABLED'] = False
-        app.config['DEBUG'] = False
-        # change the test database from flasktaskr.db to test.db
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, TEST_DB)
-        # http://flask.pocoo.org/docs/0.11/api/#flask.Flask.testing
-        # test_client(use_cookies=True, **kwargs) Creates a test client for Flask application.
-        self.app = app.test_client()
-        # create a test database initialised with the setting in the parent database db
-        db.create_all()
-        self.assertEquals(app.debug, False)
-
-    # executed after each test
-    def tearDown(self):
-        # need to destroy the session otherwise the configs set in the setUp() would be
-        # auto-commited
-        db.session.remove()
-        # delete tables in the test database
-        db.drop_all()
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+from base import AppTestCase, app, not_transactional, password_hash
+from project import db, changes, reminders, summary
+from project.models import Reminder, ReminderMark, Task, User
+from project.pagination import encode_token, keyset
+from project.queries import open_tasks, closed_tasks, _one, _owned
+from project.serializers import task_rows
+import db_migrate
+import db_upgrade
+
+# the test client, the in-memory database and the per-test transaction come from
+# tests/base.py
+class AllTests(AppTestCase):
 
     ##########################
     #### Helper functions ####
@@ -63,7 +44,7 @@ class AllTests(unittest.TestCase):
         new_user = User(
             name=name,
             email=email,
-            password=bcrypt.generate_password_hash(password)
+            password=password_hash(password)
         )
         db.session.add(new_user)
         db.session.commit()
@@ -82,12 +63,36 @@ class AllTests(unittest.TestCase):
         new_user = User(
             name='Superman',
             email='admin@realpython.com',
-            password=bcrypt.generate_password_hash('allpowerful'),
+            password=password_hash('allpowerful'),
             role='admin'
         )
         db.session.add(new_user)
         db.session.commit()
 
+    # one open and one closed task for each of `count` new users
+    def create_tasks_for_new_users(self, count):
+        first = db.session.query(User).count()
+        for n in range(first, first + count):
+            user = User('user{}'.format(n), 'user{}@example.com'.format(n), 'password')
+            db.session.add(user)
+            db.session.flush()
+            db.session.add(Task('open {}'.format(n), date(2017, 1, 1), 1, date(2016, 12, 1), 1, user.id))
+            db.session.add(Task('closed {}'.format(n), date(2017, 1, 1), 1, date(2016, 12, 1), 0, user.id))
+        db.session.commit()
+
+    # returns the response and the number of SQL statements it took
+    def count_statements(self, url):
+        with self.recorded_statements() as statements:
+            response = self.app.get(url)
+        return response, len(statements)
+
+    # sqlite's EXPLAIN QUERY PLAN output for a Query, as one string
+    def query_plan(self, query):
+        statement = getattr(query, 'statement', query)      # a Query or a Core select
+        compiled = statement.compile(dialect=db.engine.dialect)
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+        rows = db.session.connection().execute('EXPLAIN QUERY PLAN ' + str(compiled), params).fetchall()
+        return ' | '.join(row[-1] for row in rows)
 
     ########################
     #### Test functions ####
@@ -241,6 +246,334 @@ class AllTests(unittest.TestCase):
         self.assertIn(b'complete/2/', response.data)
         self.assertIn(b'delete/2/', response.data)
 
+    def test_tasks_page_statement_count_does_not_grow_with_tasks(self):
+        self.create_user('testuser1', 'test1@gmail.com', '111111')
+        self.login('testuser1', '111111')
+        self.create_tasks_for_new_users(2)
+        response, few = self.count_statements('/tasks/')
+        self.assertEqual(response.status_code, 200)
+        self.create_tasks_for_new_users(20)
+        response, many = self.count_statements('/tasks/')
+        self.assertIn(b'user21', response.data)
+        # posters are loaded with the tasks, not one SELECT per row
+        self.assertEqual(few, many)
+
+    def test_task_listings_use_the_status_due_date_index(self):
+        for query in (open_tasks(), closed_tasks()):
+            plan = self.query_plan(query)
+            self.assertIn('ix_tasks_status_due_date', plan)
+            # rows come out of the index already sorted
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_cursor_pages_are_index_ranges(self):
+        cursor = encode_token(['2017-01-01', 5])
+        for query, index in ((task_rows(), 'ix_tasks_due_date_task_id'),
+                             (open_tasks(), 'ix_tasks_status_due_date'),
+                             (closed_tasks(), 'ix_tasks_status_due_date')):
+            for descending in (False, True):
+                plan = self.query_plan(keyset(query, cursor, 10, descending))
+                self.assertIn('SEARCH', plan)
+                self.assertIn(index, plan)
+                self.assertIn('due_date', plan.split(index)[1])
+                self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_ownership_checks_are_primary_key_lookups(self):
+        # the queries behind complete_task/delete_task and complete_tasks/delete_tasks
+        for query in (_one(1, 2, False).filter(Task.status == 1), _owned([1, 2, 3], 2, False)):
+            self.assertIn('USING INTEGER PRIMARY KEY', self.query_plan(query))
+
+    def test_task_counts_use_the_user_id_status_index(self):
+        self.assertIn('SEARCH tasks USING COVERING INDEX ix_tasks_user_id_status',
+                      self.query_plan(summary.count_query(1)))
+        # the full load reads the index, not the table
+        self.assertIn('SCAN tasks USING COVERING INDEX ix_tasks_user_id_status',
+                      self.query_plan(summary.count_query()))
+
+    @not_transactional
+    def test_upgrade_adds_missing_indexes_to_an_existing_database(self):
+        for index in Task.__table__.indexes:
+            index.drop(db.engine)
+        created = db_upgrade.upgrade(db.engine)
+        self.assertEqual(sorted(created), ['ix_tasks_due_date_task_id', 'ix_tasks_status_due_date', 'ix_tasks_user_id_status'])
+        # running it again is a no-op
+        self.assertEqual(db_upgrade.upgrade(db.engine), [])
+
+    # input file for db_migrate in a temporary directory
+    def import_file(self, name, content):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(db_migrate.checkpoints.drop, db.engine, True)
+        path = os.path.join(directory, name)
+        with open(path, 'w') as stream:
+            stream.write(content)
+        return path
+
+    @not_transactional
+    def test_import_streams_csv_in_chunks_and_skips_what_is_done(self):
+        path = self.import_file('tasks.csv', 'name,due_date,priority\n' + ''.join(
+            'task {0},2017-01-0{0},{0}\n'.format(n) for n in range(1, 6)))
+        progress = []
+        report = lambda source, count, seconds: progress.append(count)
+        self.assertEqual(db_migrate.import_file('tasks', path, chunk_size=2, report=report), 5)
+        self.assertEqual(progress, [2, 4, 5])
+        self.assertEqual([t.name for t in open_tasks()], ['task {}'.format(n) for n in range(1, 6)])
+        # the checkpoint covers the whole file now
+        self.assertEqual(db_migrate.import_file('tasks', path, chunk_size=2, report=None), 0)
+        self.assertEqual(db_migrate.import_file('tasks', path, restart=True, report=None), 5)
+
+    @not_transactional
+    def test_import_reads_csv_with_the_keys_of_the_export(self):
+        path = self.import_file('tasks.csv', 'task_id,task name,due date,priority,posted date,status,user id\n'
+                                             '1,Exported,2017-01-01,5,2016-12-01,1,1\n')
+        self.assertEqual(db_migrate.import_file('tasks', path, report=None), 1)
+        self.assertEqual([(t.name, t.priority) for t in open_tasks()], [('Exported', 5)])
+
+    @not_transactional
+    def test_import_resumes_after_the_last_committed_chunk(self):
+        lines = [json.dumps({'task name': 'task {}'.format(n), 'due date': '2017-01-01', 'priority': 1,
+                             'status': 1, 'user id': 1}) for n in range(1, 6)]
+        path = self.import_file('tasks.ndjson', '\n'.join(lines[:3] + ['{"name": "broken"}'] + lines[4:]))
+        with self.assertRaises(db_migrate.ImportFailed):
+            db_migrate.import_file('tasks', path, chunk_size=2, report=None)
+        self.assertEqual(db.session.query(Task).count(), 2)
+        with open(path, 'w') as stream:
+            stream.write('\n'.join(lines))
+        self.assertEqual(db_migrate.import_file('tasks', path, chunk_size=2, report=None), 3)
+        self.assertEqual(db.session.query(Task).count(), 5)
+
+    @not_transactional
+    def test_import_from_a_legacy_sqlite_file(self):
+        path = self.import_file('old.db', '')
+        with sqlite3.connect(path) as connection:
+            connection.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT, email TEXT, password TEXT)')
+            connection.execute('CREATE TABLE tasks (task_id INTEGER PRIMARY KEY, name TEXT, due_date TEXT, '
+                               'priority INTEGER, status INTEGER)')
+            connection.execute("INSERT INTO users VALUES (7, 'olduser', 'old@example.com', 'x')")
+            connection.execute("INSERT INTO tasks VALUES (1, 'Finish this tutorial', '25/11/2016', 10, 1)")
+        counts = db_migrate.import_legacy(path, date_format='%d/%m/%Y', user_id=7, report=None)
+        self.assertEqual(counts, {'users': 1, 'tasks': 1})
+        task = db.session.query(Task).one()
+        self.assertEqual((task.due_date, task.poster.name), (date(2016, 11, 25), 'olduser'))
+
+    @not_transactional
+    def test_upgrade_adds_the_search_index_with_existing_tasks(self):
+        self.create_user('testuser1', 'test1@gmail.com', '111111')
+        self.login('testuser1', '111111')
+        self.create_task()
+        db.engine.execute('DROP TABLE tasks_fts')
+        for trigger in ('insert', 'delete', 'update'):
+            db.engine.execute('DROP TRIGGER tasks_fts_' + trigger)
+        self.assertEqual(db_upgrade.upgrade(db.engine), ['tasks_fts'])
+        response = self.app.get('/tasks/?q=bank')
+        self.assertIn(b'Tasks matching "bank"', response.data)
+        self.assertIn(b'<td width="200px">Go to the bank</td>', response.data)
+        response = self.app.get('/tasks/?q=nothing')
+        self.assertIn(b'No tasks found.', response.data)
+
+    def test_completing_a_missing_task_does_not_crash(self):
+        self.create_user('testuser1', 'test1@gmail.com', '111111')
+        self.login('testuser1', '111111')
+        response = self.app.get('/complete/42/', follow_redirects=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'That task does not exist.', response.data)
+
+    def test_deleting_a_missing_task_does_not_crash(self):
+        self.create_user('testuser1', 'test1@gmail.com', '111111')
+        self.login('testuser1', '111111')
+        response = self.app.get('/delete/42/', follow_redirects=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'That task does not exist.', response.data)
+
+    def test_complete_is_a_single_statement(self):
+        self.create_user('testuser1', 'test1@gmail.com', '111111')
+        self.login('testuser1', '111111')
+        self.create_task()
+        with self.recorded_statements() as statements:
+            self.app.get('/complete/1/')
+        # ownership check and write in one statement on tasks (plus the change version bump
+        # and the journal entry)
+        self.assertEqual([s.split()[0] for s in statements if 'tasks ' in s], ['UPDATE'])
+        self.assertEqual(len(statements), 3)
+        self.assertEqual(db.session.query(Task).get(1).status, 0)
+
+    def test_role_checks_come_from_the_identity_cache(self):
+        self.create_user('testuser1', 'test1@gmail.com', '111111')
+        self.login('testuser1', '111111')
+        self.create_task()
+        self.app.get('/logout/')
+        db.session.add(User('admin1', 'admin1@gmail.com', password_hash('111111'), 'admin'))
+        db.session.commit()
+        self.login('admin1', '111111')
+        with self.recorded_statements() as statements:
+            response = self.app.get('/complete/1/', follow_redirects=True)
+        self.assertIn(b'The task is complete. Nice.', response.data)
+        self.assertFalse([s for s in statements if 'FROM users' in s and 'tasks' not in s])
+
+    def test_revoked_roles_stop_working_in_every_worker(self):
+        self.use_config(IDENTITY_VERSION_POLL=0)
+        self.create_user('testuser1', 'test1@gmail.com', '111111')
+        self.login('testuser1', '111111')
+        self.create_task()
+        self.app.get('/logout/')
+        self.create_admin_user()
+        self.login('Superman', 'allpowerful')
+        self.app.get('/tasks/')
+        # another worker process revokes the role: this one never sees the ORM change
+        db.session.query(User).filter_by(name='Superman').update({'role': 'user'})
+        changes.bump([2], 'users')
+        db.session.commit()
+        response = self.app.get('/complete/1/', follow_redirects=True)
+        self.assertIn(b'You can only update tasks that belong to you.', response.data)
+
+    def test_changing_a_user_bumps_the_users_version(self):
+        self.create_user('testuser1', 'test1@gmail.com', '111111')
+        version, _ = changes.current('users')
+        user = db.session.query(User).filter_by(name='testuser1').one()
+        user.role = 'admin'
+        db.session.commit()
+        self.assertEqual(changes.current('users')[0], version + 1)
+        db.session.delete(user)
+        db.session.commit()
+        self.assertEqual(changes.current('users')[0], version + 2)
+
+    # open tasks due on these days, relative to the `today` given to reminders.tick()
+    def add_tasks_due(self, today, days, status=1):
+        self.create_user('testuser1', 'test1@gmail.com', '111111')
+        for n, day in enumerate(days):
+            db.session.add(Task('task {}'.format(n), today + timedelta(days=day), 1, today, status, 1))
+        db.session.commit()
+
+    def remind(self, today):
+        with app.app_context():
+            return reminders.tick(today)
+
+    def reminded(self, kind):
+        return sorted(r.task_id for r in db.session.query(Reminder).filter_by(kind=kind))
+
+    def test_reminders_for_tasks_coming_due_and_overdue(self):
+        today = date(2017, 3, 10)
+        # ids 1-6: far overdue, overdue, overdue, due today, due tomorrow, next week
+        self.add_tasks_due(today, [-30, -3, -1, 0, 1, 7])
+        db.session.add(Task('closed', today, 1, today, 0, 1))
+        db.session.commit()
+        self.assertEqual(self.remind(today), {'due_soon': 2, 'overdue': 2})
+        self.assertEqual(self.reminded('due_soon'), [4, 5])
+        self.assertEqual(self.reminded('overdue'), [2, 3])
+        # nothing twice
+        self.assertEqual(self.remind(today), {'due_soon': 0, 'overdue': 0})
+        # the next day: task 4 is overdue now, nothing new is coming due
+        self.assertEqual(self.remind(today + timedelta(days=1)), {'due_soon': 0, 'overdue': 1})
+        self.assertEqual(self.reminded('overdue'), [2, 3, 4])
+
+    def test_reminder_scan_resumes_from_its_mark_and_catches_up_new_tasks(self):
+        self.use_config(REMINDER_BATCH_SIZE=2, REMINDER_LEAD_DAYS=3)
+        today = date(2017, 3, 10)
+        self.add_tasks_due(today, [0, 1, 2, 3, 2])
+        self.assertEqual(self.remind(today)['due_soon'], 5)
+        mark = db.session.query(ReminderMark).get('due_soon')
+        self.assertEqual((mark.due_date, mark.task_id), (today + timedelta(days=3), 4))
+        # added after the scan went past its due date, and ahead of the mark
+        db.session.add(Task('late', today + timedelta(days=1), 1, today, 1, 1))
+        db.session.add(Task('ahead', today + timedelta(days=3), 1, today, 1, 1))
+        db.session.commit()
+        self.assertEqual(self.remind(today)['due_soon'], 2)
+        self.assertEqual(self.reminded('due_soon'), [1, 2, 3, 4, 5, 6, 7])
+        mark = db.session.query(ReminderMark).get('due_soon')
+        self.assertEqual((mark.due_date, mark.task_id, mark.max_task_id), (today + timedelta(days=3), 7, 7))
+        # and the outbox hands them out once
+        pending = reminders.pending(limit=3)
+        self.assertEqual([r.task_id for r in pending], [1, 2, 3])
+        reminders.mark_sent([r.id for r in pending])
+        self.assertEqual(len(reminders.pending()), 4)
+
+    def test_reminder_catch_up_finds_tasks_that_committed_after_a_higher_id(self):
+        today = date(2017, 3, 10)
+        self.add_tasks_due(today, [0, 1])
+        # id 4 commits first, as a server database allows, while id 3 is still in flight
+        task = Task('first to commit', today + timedelta(days=1), 1, today, 1, 1)
+        task.task_id = 4
+        db.session.add(task)
+        db.session.commit()
+        self.assertEqual(self.remind(today)['due_soon'], 3)
+        late = Task('late commit', today, 1, today, 1, 1)
+        late.task_id = 3
+        db.session.add(late)
+        db.session.commit()
+        self.assertEqual(self.remind(today)['due_soon'], 1)
+        self.assertEqual(self.reminded('due_soon'), [1, 2, 3, 4])
+        self.assertEqual(db.session.query(ReminderMark).get('due_soon').max_task_id, 4)
+
+    def test_reminders_of_completed_and_deleted_tasks_are_not_sent(self):
+        today = date(2017, 3, 10)
+        self.add_tasks_due(today, [0, 0, 0])
+        self.remind(today)
+        db.session.query(Task).filter_by(task_id=1).update({'status': 0})
+        db.session.query(Task).filter_by(task_id=2).delete()
+        db.session.commit()
+        self.assertEqual([r.task_id for r in reminders.pending()], [3])
+        # the next pass drops them from the outbox
+        self.remind(today)
+        self.assertEqual(self.reminded('due_soon'), [3])
+
+    def test_reminders_go_by_the_utc_date(self):
+        today = date(2017, 3, 10)
+        self.add_tasks_due(today, [-1, 0])
+        class Clock(datetime):
+            @classmethod
+            def utcnow(cls):
+                # half past midnight UTC, still the evening before in the americas
+                return datetime(2017, 3, 10, 0, 30)
+        with mock.patch.object(reminders, 'datetime', Clock):
+            self.assertEqual(self.remind(None), {'due_soon': 1, 'overdue': 1})
+        self.assertEqual(self.reminded('overdue'), [1])
+
+    def test_reminder_scan_uses_the_status_due_date_index(self):
+        mark = {'due_date': date(2017, 3, 10), 'task_id': 5, 'max_task_id': 0}
+        plan = self.query_plan(reminders.scan_query(date(2017, 3, 10), date(2017, 3, 11), mark, 500))
+        self.assertIn('ix_tasks_status_due_date', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_open_tasks_are_paginated(self):
+        self.use_config(TASKS_PER_PAGE=3)
+        self.create_user('testuser1', 'test1@gmail.com', '111111')
+        self.login('testuser1', '111111')
+        for day in range(1, 6):
+            db.session.add(Task('open task {}'.format(day), date(2017, 1, day), 1, date(2016, 12, 1), 1, 1))
+        db.session.commit()
+        response = self.app.get('/tasks/')
+        self.assertIn(b'open task 3', response.data)
+        self.assertNotIn(b'open task 4', response.data)
+        page = response.data.decode('utf-8')
+        start = page.index('open_cursor=') + len('open_cursor=')
+        cursor = page[start:page.index('"', start)]
+        response = self.app.get('/tasks/?open_cursor=' + cursor)
+        self.assertNotIn(b'open task 3', response.data)
+        self.assertIn(b'open task 4', response.data)
+        self.assertIn(b'open task 5', response.data)
+        self.assertNotIn(b'Next page', response.data)
+
+    def test_closed_tasks_are_collapsed_to_a_recent_window(self):
+        self.use_config(CLOSED_TASKS_WINDOW=2)
+        self.create_user('testuser1', 'test1@gmail.com', '111111')
+        self.login('testuser1', '111111')
+        for day in range(1, 5):
+            db.session.add(Task('closed task {}'.format(day), date(2017, 1, day), 1, date(2016, 12, 1), 0, 1))
+        db.session.commit()
+        response = self.app.get('/tasks/')
+        # most recent first
+        self.assertIn(b'closed task 4', response.data)
+        self.assertIn(b'closed task 3', response.data)
+        self.assertNotIn(b'closed task 2', response.data)
+        self.assertIn(b'Show all closed tasks', response.data)
+        response = self.app.get('/tasks/?closed=all')
+        self.assertIn(b'closed task 1', response.data)
+
+    def test_invalid_page_cursor(self):
+        self.create_user('testuser1', 'test1@gmail.com', '111111')
+        self.login('testuser1', '111111')
+        response = self.app.get('/tasks/?open_cursor=garbage')
+        self.assertEqual(response.status_code, 400)
+
     #def test_string_reprsentation_of_the_task_object(self):
 
 
@@ -1,43 +1,18 @@
-import os
+import sys
+import threading
+import types
 import unittest
+from unittest import mock
 
-from project import app, db, bcrypt
-from project._config import basedir
+from base import AppTestCase, app, not_transactional, password_hash
+from project import db, passwords
+from project.sessions import DatabaseSessionStore, MemorySessionStore, SQLiteSessionStore, \
+    ServerSideSessionInterface
 from project.models import User
 
-TEST_DB = 'test.db'
-
-class AllTests(unittest.TestCase):
-
-    #############################
-    #### setup and tear down ####
-    #############################
-
-    # executed prior to each test
-
-    # Flask exposes the Werkzeug test client and handles the context locals.
-    # It is important to set TESTING configuration setting to True,
-    # to propagate the exceptions to the test client.
-    def setUp(self):
-        app.config['TESTING'] = True
-        app.config['WTF_CSRF_ENABLED'] = False
-        app.config['DEBUG'] = False
-        # change the test database from flasktaskr.db to test.db
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, TEST_DB)
-        # http://flask.pocoo.org/docs/0.11/api/#flask.Flask.testing
-        # test_client(use_cookies=True, **kwargs) Creates a test client for Flask application.
-        self.app = app.test_client()
-            # create a test database initialised with the setting in the parent database db
-        db.create_all()
-        self.assertEquals(app.debug, False)
-
-    # executed after each test
-    def tearDown(self):
-        # need to destroy the session otherwise the configs set in the setUp() would be
-        # auto-commited
-        db.session.remove()
-        # delete tables in the test database
-        db.drop_all()
+# the test client, the in-memory database and the per-test transaction come from
+# tests/base.py
+class AllTests(AppTestCase):
 
     ##########################
     #### Helper functions ####
@@ -63,7 +38,7 @@ class AllTests(unittest.TestCase):
         new_user = User(
             name=name,
             email=email,
-            password=bcrypt.generate_password_hash(password)
+            password=password_hash(password)
         )
         db.session.add(new_user)
         db.session.commit()
@@ -163,6 +138,131 @@ class AllTests(unittest.TestCase):
         response = self.app.get('tasks/', follow_redirects=True)
         self.assertIn(b'testuser1', response.data)
 
+    def test_login_rehashes_password_when_cost_changes(self):
+        db.session.add(User('testuser1', 'test1@gmail.com', password_hash('111111')))
+        db.session.commit()
+        self.use_config(BCRYPT_LOG_ROUNDS=5)
+        response = self.login('testuser1', '111111')
+        self.assertIn(b'Welcome!', response.data)
+        user = db.session.query(User).filter_by(name='testuser1').one()
+        self.assertEqual(passwords.hash_rounds(user.password), 5)
+        # and the new hash still works
+        self.logout()
+        self.assertIn(b'Welcome!', self.login('testuser1', '111111').data)
+
+    def test_register_and_login_with_hashing_pool(self):
+        self.use_config(BCRYPT_LOG_ROUNDS=4, BCRYPT_HASH_WORKERS=2)
+        self.addCleanup(passwords.shutdown)
+        self.register('testuser1', 'test1@gmail.com', '111111', '111111')
+        response = self.login('testuser1', '111111')
+        self.assertIn(b'Welcome!', response.data)
+
+    def test_hashing_goes_to_the_gevent_threadpool_under_gevent(self):
+        # a stand-in for gevent after monkey.patch_all(): hashing inline or on a
+        # ThreadPoolExecutor would run on greenlets and block the whole worker
+        applied = []
+        threadpool = types.SimpleNamespace(
+            maxsize=10, apply=lambda function, args: applied.append(function) or function(*args))
+        gevent = types.SimpleNamespace(get_hub=lambda: types.SimpleNamespace(threadpool=threadpool))
+        monkey = types.SimpleNamespace(is_module_patched=lambda name: name == 'threading')
+        self.addCleanup(passwords.shutdown)
+        with mock.patch.dict(sys.modules, {'gevent': gevent, 'gevent.monkey': monkey}):
+            self.create_user('testuser1', 'test1@gmail.com', '111111')
+            self.assertIn(b'Welcome!', self.login('testuser1', '111111').data)
+        self.assertTrue(applied)
+        self.assertEqual(threadpool.maxsize, 1)
+
+    def test_login_is_refused_when_hashing_pool_is_saturated(self):
+        self.use_config(BCRYPT_HASH_WORKERS=1, BCRYPT_HASH_BACKLOG=0, BCRYPT_HASH_WAIT=0)
+        self.addCleanup(passwords.shutdown)
+        self.create_user('testuser1', 'test1@gmail.com', '111111')
+        started, release = threading.Event(), threading.Event()
+        def block():
+            started.set()
+            release.wait()
+        def occupy():
+            with app.app_context():
+                passwords.offload(block)
+        worker = threading.Thread(target=occupy)
+        worker.start()
+        started.wait()
+        try:
+            response = self.login('testuser1', '111111')
+        finally:
+            release.set()
+            worker.join()
+        self.assertEqual(response.status_code, 503)
+        self.assertIn(b'Too many logins right now', response.data)
+
+    def use_session_store(self, store):
+        previous = app.session_interface
+        app.session_interface = ServerSideSessionInterface(store, 3600)
+        self.addCleanup(setattr, app, 'session_interface', previous)
+        return app.session_interface
+
+    def session_cookie(self, client):
+        for cookie in client.cookie_jar:
+            if cookie.name == app.session_cookie_name:
+                return cookie.value
+
+    def test_session_cookie_only_carries_an_opaque_id(self):
+        interface = self.use_session_store(MemorySessionStore())
+        self.create_user('testuser1', 'test1@gmail.com', '111111')
+        self.login('testuser1', '111111')
+        sid = self.session_cookie(self.app)
+        self.assertEqual(len(sid), 40)
+        self.assertNotIn('testuser1', sid)
+        data, _ = interface.store.get(sid)
+        self.assertIn('"user_id": 1', data)
+        response = self.app.get('/tasks/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_logout_invalidates_the_session_id(self):
+        self.use_session_store(MemorySessionStore())
+        self.create_user('testuser1', 'test1@gmail.com', '111111')
+        self.login('testuser1', '111111')
+        sid = self.session_cookie(self.app)
+        self.logout()
+        self.assertNotEqual(self.session_cookie(self.app), sid)
+        # replaying the old cookie does not log anyone in
+        replay = app.test_client()
+        replay.set_cookie('localhost', app.session_cookie_name, sid)
+        response = replay.get('/tasks/', follow_redirects=True)
+        self.assertIn(b'You need to login first.', response.data)
+
+    def test_logout_everywhere_ends_the_other_sessions(self):
+        self.use_session_store(SQLiteSessionStore(':memory:'))
+        self.create_user('testuser1', 'test1@gmail.com', '111111')
+        other = app.test_client()
+        other.post('/', data=dict(name='testuser1', password='111111'))
+        self.login('testuser1', '111111')
+        self.assertEqual(other.get('/tasks/').status_code, 200)
+        self.app.get('/logout/?everywhere=1')
+        response = other.get('/tasks/', follow_redirects=True)
+        self.assertIn(b'You need to login first.', response.data)
+
+    @not_transactional
+    def test_sessions_ended_in_one_worker_leave_the_cache_of_the_others(self):
+        store = DatabaseSessionStore(db)
+        interface = self.use_session_store(store)
+        self.create_user('testuser1', 'test1@gmail.com', '111111')
+        self.login('testuser1', '111111')
+        sid = self.session_cookie(self.app)
+        # another worker process: its own cache, the same database
+        other = ServerSideSessionInterface(store, 3600, ended_poll=0)
+        with app.app_context():
+            self.assertIsNotNone(other._load(sid))
+            interface.end_user_sessions(1)
+            self.assertIsNone(other._load(sid))
+            store.purge()
+
+    def test_expired_sessions_are_not_loaded(self):
+        store = MemorySessionStore()
+        store.set('abc', '{}', 1, 0)
+        self.assertIsNone(store.get('abc'))
+        store.purge()
+        self.assertEqual(store.delete_user(1), [])
+
     #def test_duplicate_user_registeration_throws_error(self):
     #    self.register('takutaku', 'taku@takkun.com', 'ohmondieu', 'ohmondieu')
     #    response = self.register('takutaku', 'taku@takkun.com', 'ohmondieu', 'ohmondieu')